@@ -0,0 +1,75 @@
+"""
+Gradient check of the checkpointed temporal loop (CKPT_SEGMENT) on cpu, in float64.
+For each case (FF_CHUNK, NOISE_SEED), runs the same trial with and without
+CKPT_SEGMENT and reports the difference of the losses and the relative error
+of the gradients of the trained parameters. Exits with 1 if a case does not match.
+usage: python benchmarks/checkpoint.py [conf_name] [N_NEURON] [CKPT_SEGMENT]
+"""
+
+import os
+import sys
+import argparse
+
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.network import Network
+
+# FF_CHUNK, NOISE_SEED, chunks that do not divide CKPT_SEGMENT are the hard case
+CASES = [(0, None), (7, None), (10, None), (7, 3)]
+
+
+def grads(conf_name, **kwargs):
+    """returns the loss and the flat gradient of the parameters of one trial"""
+
+    torch.manual_seed(1)
+    model = Network(conf_name, REPO_ROOT, **kwargs)
+    params = [param for param in model.parameters() if param.requires_grad]
+
+    torch.manual_seed(2)
+    loss = model().pow(2).mean()
+    loss.backward()
+
+    return loss.item(), torch.cat([param.grad.flatten() for param in params])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("conf_name", nargs="?", default="config_train.yml")
+    parser.add_argument("N_NEURON", nargs="?", type=int, default=300)
+    parser.add_argument("CKPT_SEGMENT", nargs="?", type=int, default=10)
+    args = parser.parse_args()
+
+    torch.set_default_dtype(torch.float64)
+
+    kwargs = dict(
+        DEVICE="cpu",
+        FLOAT_PRECISION=64,
+        SPARSE="None",
+        N_NEURON=args.N_NEURON,
+        DURATION=1.0,
+        VERBOSE=0,
+    )
+
+    failed = False
+    for ff_chunk, noise_seed in CASES:
+        case = dict(kwargs, FF_CHUNK=ff_chunk, NOISE_SEED=noise_seed)
+
+        loss, grad = grads(args.conf_name, **case)
+        loss_, grad_ = grads(args.conf_name, CKPT_SEGMENT=args.CKPT_SEGMENT, **case)
+
+        error = ((grad - grad_).norm() / grad.norm()).item()
+        failed |= loss != loss_ or error > 1e-10
+
+        print(
+            "FF_CHUNK %d, NOISE_SEED %s: |dloss| %.2e, relative grad error %.2e"
+            % (ff_chunk, noise_seed, abs(loss - loss_), error)
+        )
+
+    sys.exit(int(failed))
+
+
+if __name__ == "__main__":
+    main()
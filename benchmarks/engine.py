@@ -0,0 +1,80 @@
+"""
+Benchmark of the time step engines of src/engine.py against Network.update_dynamics.
+Runs the same forward pass (same ff_input and initial state) with STEP_ENGINE
+'python', 'closure' and 'compile' on cpu and reports the time per step,
+the speedup and the max difference of the rates. For 'compile', the time
+of the first pass (compilation) and the number of graphs compiled by dynamo
+are reported too: the step is compiled once per configuration, shapes and
+grad mode (see get_step), so one graph here.
+usage: python benchmarks/engine.py [conf_name] [N_NEURON] [N_THREADS]
+"""
+
+import os
+import sys
+import argparse
+from time import perf_counter
+
+import torch
+from torch._dynamo.utils import counters
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.network import Network
+
+
+def run(conf_name, engine, ff_input=None, n_repeat=6, **kwargs):
+    model = Network(conf_name, REPO_ROOT, STEP_ENGINE=engine, **kwargs)
+
+    if ff_input is None:
+        ff_input = model.init_ff_input()
+
+    times = []
+    with torch.no_grad():
+        for _ in range(n_repeat):
+            torch.manual_seed(0)
+            start = perf_counter()
+            rates = model(ff_input=ff_input.clone())
+            times.append(perf_counter() - start)
+
+    # first run includes compilation
+    return rates, min(times[1:]) / model.N_STEPS, ff_input, times[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("conf_name", nargs="?", default="config_EI.yml")
+    parser.add_argument("N_NEURON", nargs="?", type=int, default=2000)
+    parser.add_argument("N_THREADS", nargs="?", type=int, default=1)
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.N_THREADS)
+
+    kwargs = dict(
+        DEVICE="cpu",
+        FLOAT_PRECISION=32,
+        SPARSE="None",
+        N_NEURON=args.N_NEURON,
+        N_BATCH=1,
+        DURATION=0.5,
+        DT=0.001,
+    )
+
+    rates, t_ref, ff_input, _ = run(args.conf_name, "python", **kwargs)
+    print("python: %.1f us/step" % (t_ref * 1e6))
+
+    for engine in ["closure", "compile"]:
+        rates_, t, _, t_first = run(args.conf_name, engine, ff_input, **kwargs)
+        print(
+            "%s: %.1f us/step, speedup x%.2f, max |drates| %.2e"
+            % (engine, t * 1e6, t_ref / t, (rates - rates_).abs().max())
+        )
+
+    print(
+        "compile: first pass %.1f s, %d graph(s) compiled"
+        % (t_first, counters["stats"]["unique_graphs"])
+    )
+
+
+if __name__ == "__main__":
+    main()
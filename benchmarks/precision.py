@@ -0,0 +1,155 @@
+"""
+Accuracy versus throughput of the precision policies (FLOAT_PRECISION for the
+state, WEIGHT_PRECISION for the weights and the recurrent products) on cpu.
+Every policy runs with the weights, ff input and initial state of the float64
+reference and reports the memory of the weights, the forward steps per second
+without grad, the max error of the rates and the drift of the bump of the
+excitatory population at the end of the trial (mean rate m0, amplitude m1, phase).
+usage: python benchmarks/precision.py [--conf config_EI.yml] [--N 2000]
+                                      [--policies 64 32 32/16b 32/16 64/32] [--out precision.json]
+"""
+
+import os
+import sys
+import json
+import argparse
+from time import perf_counter
+
+import numpy as np
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from src.network import Network
+from src.decode import decode_bump
+
+# FLOAT_PRECISION/WEIGHT_PRECISION, the weights are in FLOAT_PRECISION without /
+POLICIES = ["64", "32", "32/16b", "32/16", "64/32", "16b"]
+
+
+def parse_policy(policy):
+    """returns FLOAT_PRECISION and WEIGHT_PRECISION of 'float/weight'"""
+
+    def parse(value):
+        return value if value == "16b" else int(value)
+
+    float_precision, _, weight_precision = policy.partition("/")
+    return parse(float_precision), parse(weight_precision) if weight_precision else None
+
+
+def build(conf_name, policy, ref=None, **kwargs):
+    """returns the model of policy, with the weights of ref"""
+
+    float_precision, weight_precision = parse_policy(policy)
+
+    torch.manual_seed(0)
+    model = Network(
+        conf_name,
+        REPO_ROOT,
+        FLOAT_PRECISION=float_precision,
+        WEIGHT_PRECISION=weight_precision,
+        **kwargs,
+    )
+
+    if ref is not None:
+        model.Wab_T = ref.Wab_T.to(model.WEIGHT_FLOAT)
+        if model.IF_STP:
+            model.W_stp_T = ref.W_stp_T.to(model.WEIGHT_FLOAT)
+
+    return model
+
+
+def run(model, ff_input, n_repeat=3):
+    """returns the rates (float64) and the best time of forward"""
+
+    times = []
+    with torch.no_grad():
+        for _ in range(n_repeat):
+            torch.manual_seed(1)
+            start = perf_counter()
+            rates = model(ff_input=ff_input.to(model.FLOAT))
+            times.append(perf_counter() - start)
+
+    return rates.double(), min(times)
+
+
+def bump(model, rates):
+    """returns m0, m1 and the phase (degrees) of the excitatory rates at the last record"""
+    m0, m1, phi = decode_bump(rates[:, -1, model.slices[0]].cpu().numpy())
+    return m0.mean(), m1.mean(), np.degrees(phi).mean()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conf", default="config_EI.yml")
+    parser.add_argument("--N", type=int, default=2000)
+    parser.add_argument("--engine", default="closure")
+    parser.add_argument("--policies", nargs="+", default=POLICIES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--out", default=None, help="json of the results")
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+
+    kwargs = dict(
+        DEVICE="cpu",
+        SPARSE="None",
+        N_NEURON=args.N,
+        N_BATCH=1,
+        VERBOSE=0,
+        STEP_ENGINE=args.engine,
+    )
+
+    ref = build(args.conf, "64", **kwargs)
+    ff_input = ref.init_ff_input()
+    rates_ref, _ = run(ref, ff_input, 1)
+    bump_ref = bump(ref, rates_ref)
+
+    print(
+        "reference float64: m0 %.3f, m1 %.3f, phase %.1f deg, %d steps"
+        % (bump_ref + (ref.N_STEPS,))
+    )
+
+    results = []
+    for policy in args.policies:
+        model = build(args.conf, policy, ref, **kwargs)
+        rates, time = run(model, ff_input, args.repeat)
+        m0, m1, phase = bump(model, rates)
+
+        # phase difference on the circle
+        drift = (phase - bump_ref[2] + 180.0) % 360.0 - 180.0
+
+        result = {
+            "policy": policy,
+            "weights_mb": model.Wab_T.numel() * model.Wab_T.element_size() / 2**20,
+            "steps_per_s": model.N_STEPS / time,
+            "max_error": ((rates - rates_ref).abs().max() / rates_ref.abs().max()).item(),
+            "m0_error": abs(m0 - bump_ref[0]) / bump_ref[0],
+            "m1_error": abs(m1 - bump_ref[1]) / bump_ref[1],
+            "phase_drift": abs(drift),
+        }
+        results.append(result)
+
+        print(
+            "%-7s weights %7.1f MB, %7.0f steps/s, max |drates| %.1e, m0 %.1e, m1 %.1e, phase %.2f deg"
+            % (
+                policy,
+                result["weights_mb"],
+                result["steps_per_s"],
+                result["max_error"],
+                result["m0_error"],
+                result["m1_error"],
+                result["phase_drift"],
+            )
+        )
+
+    if args.out is not None:
+        meta = {"conf": args.conf, "N_NEURON": args.N, "engine": args.engine, "torch": torch.__version__}
+        with open(args.out, "w") as f:
+            json.dump({"meta": meta, "reference": bump_ref, "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
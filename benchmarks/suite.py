@@ -0,0 +1,329 @@
+"""
+Benchmark suite of Network and LIFNetwork on cpu across scales and modes.
+Each case runs in its own process (peak RSS and thread count per case) and reports
+the construction time of the network and of initWeights, the forward steps per
+second without grad, the forward + backward time with LR_TRAIN and the peak RSS.
+Cases sweep one parameter of SWEEP at a time around BASE (all combinations with
+--product) for each mode of MODES. Results are written as json, --compare prints
+the speedups against a previous json.
+usage: python benchmarks/suite.py [--modes rate train lif] [--sweep N_NEURON=1000,4000]
+                                  [--product] [--quick] [--out results.json] [--compare old.json]
+"""
+
+import os
+import sys
+import json
+import argparse
+import platform
+import itertools
+import resource
+import subprocess
+from time import perf_counter, strftime
+
+import torch
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# configuration and measure of each mode
+MODES = {
+    "rate": {"conf_name": "config_EI.yml", "backward": 0},
+    "train": {"conf_name": "config_train.yml", "backward": 1},
+    "lif": {"conf_name": "config_2pop.yml", "backward": 0},
+}
+
+BASE = {
+    "N_NEURON": 1000,
+    "K": 200.0,
+    "N_BATCH": 1,
+    "SPARSE": "None",
+    "CON_TYPE": "sparse",
+    "IF_STP": 0,
+    "IF_NMDA": 0,
+    "LIVE_FF_UPDATE": 0,
+    "N_THREADS": 1,
+}
+
+SWEEP = {
+    "N_NEURON": [1000, 2000, 4000],
+    "K": [100.0, 200.0, 400.0],
+    "N_BATCH": [1, 16],
+    "SPARSE": ["None", "full"],
+    "CON_TYPE": ["sparse", "all2all"],
+    "IF_STP": [0, 1],
+    "IF_NMDA": [0, 1],
+    "LIVE_FF_UPDATE": [0, 1],
+    "N_THREADS": [1, 4],
+}
+
+# parameters of the simulations, not swept
+SIM = {"DEVICE": "cpu", "FLOAT_PRECISION": 32, "VERBOSE": 0, "DT": 0.001}
+
+
+def get_cases(modes, sweep, product=0):
+    """returns the list of cases, dicts with the mode and the values of BASE"""
+
+    cases = []
+    for mode in modes:
+        if product:
+            keys = list(sweep)
+            for values in itertools.product(*[sweep[key] for key in keys]):
+                cases.append(dict(BASE, mode=mode, **dict(zip(keys, values))))
+        else:
+            cases.append(dict(BASE, mode=mode))
+            for key, values in sweep.items():
+                for value in values:
+                    if value != BASE[key]:
+                        cases.append(dict(BASE, mode=mode, **{key: value}))
+
+    return cases
+
+
+def peak_rss():
+    """returns the peak resident set size of this process in MB (ru_maxrss is in kB on linux)"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss = rss / 1024
+    return rss / 1024
+
+
+def build(case, duration):
+    """returns the model of case and the time spent in initWeights"""
+
+    from src.network import Network
+    from src.lif_network import LIFNetwork
+
+    mode = MODES[case["mode"]]
+    kwargs = {key: value for key, value in case.items() if key not in ("mode", "N_THREADS")}
+    kwargs.update(SIM, DURATION=duration)
+
+    timer = {}
+
+    def timed(cls):
+        class Timed(cls):
+            def initWeights(self):
+                start = perf_counter()
+                super().initWeights()
+                timer["init_weights"] = perf_counter() - start
+
+        return Timed
+
+    if case["mode"] == "lif":
+        model = timed(LIFNetwork)(mode["conf_name"], "bench", REPO_ROOT, **kwargs)
+    else:
+        if mode["backward"]:
+            kwargs["LR_TRAIN"] = 1
+        model = timed(Network)(mode["conf_name"], REPO_ROOT, **kwargs)
+
+    return model, timer["init_weights"]
+
+
+def run_case(case, duration=0.5, n_repeat=3):
+    """runs case in this process, returns the dict of measures"""
+
+    torch.set_num_threads(case["N_THREADS"])
+    result = {"base_rss_mb": peak_rss()}
+
+    start = perf_counter()
+    model, result["init_weights_s"] = build(case, duration)
+    result["build_s"] = perf_counter() - start
+
+    N_STEPS = int(model.N_STEPS)
+    result["n_steps"] = N_STEPS
+
+    # ff inputs are generated in forward with LIVE_FF_UPDATE
+    ff_input = None
+    if not getattr(model, "LIVE_FF_UPDATE", 0):
+        ff_input = model.init_ff_input()
+
+    def forward():
+        torch.manual_seed(0)
+        return model(ff_input=None if ff_input is None else ff_input.clone())
+
+    times = []
+    with torch.no_grad():
+        for _ in range(n_repeat):
+            start = perf_counter()
+            forward()
+            times.append(perf_counter() - start)
+
+    # the first run includes warm up (compilation, caches)
+    result["forward_s"] = min(times[1:] or times)
+    result["steps_per_s"] = N_STEPS / result["forward_s"]
+
+    if MODES[case["mode"]]["backward"]:
+        times = []
+        for _ in range(n_repeat):
+            model.zero_grad()
+            start = perf_counter()
+            loss = forward().float().square().mean()
+            loss.backward()
+            times.append(perf_counter() - start)
+
+        result["forward_backward_s"] = min(times[1:] or times)
+
+    result["peak_rss_mb"] = peak_rss()
+
+    return result
+
+
+def spawn(case, duration, n_repeat, timeout):
+    """runs case in a new process, returns the case with its measures or its error"""
+
+    cmd = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--case",
+        json.dumps(case),
+        "--duration",
+        str(duration),
+        "--repeat",
+        str(n_repeat),
+    ]
+
+    out = dict(case)
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout, cwd=REPO_ROOT)
+    except subprocess.TimeoutExpired:
+        out["error"] = "timeout after %d s" % timeout
+        return out
+
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        out["error"] = lines[-1] if lines else "exit code %d" % proc.returncode
+        return out
+
+    out.update(json.loads(proc.stdout.strip().splitlines()[-1]))
+    return out
+
+
+def case_key(case):
+    return json.dumps({key: case[key] for key in ["mode"] + list(BASE)}, sort_keys=True)
+
+
+def compare(results, path):
+    """prints the speedups of results against the results in path"""
+
+    with open(path) as f:
+        old = {case_key(case): case for case in json.load(f)["results"]}
+
+    for case in results:
+        ref = old.get(case_key(case))
+        if ref is None:
+            continue
+
+        ratios = []
+        for name in ["steps_per_s", "forward_backward_s", "build_s", "peak_rss_mb"]:
+            if name in case and name in ref:
+                ratio = case[name] / ref[name] if name == "steps_per_s" else ref[name] / case[name]
+                ratios.append("%s x%.2f" % (name, ratio))
+
+        if ratios:
+            print(describe(case), ", ".join(ratios))
+
+
+def describe(case):
+    """returns the mode and the parameters of case that differ from BASE"""
+    diff = ["%s=%s" % (key, case[key]) for key in BASE if case[key] != BASE[key]]
+    return "%s %s" % (case["mode"], " ".join(diff) or "base")
+
+
+def parse_sweep(items):
+    """returns SWEEP updated by items KEY=v1,v2 (values parsed as json, else str)"""
+
+    sweep = dict(SWEEP)
+    for item in items:
+        key, values = item.split("=")
+        if key not in BASE:
+            raise ValueError("can not sweep %s, parameters are %s" % (key, list(BASE)))
+
+        parsed = []
+        for value in values.split(","):
+            try:
+                parsed.append(json.loads(value))
+            except json.JSONDecodeError:
+                parsed.append(value)
+
+        sweep[key] = parsed
+
+    return sweep
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    parser.add_argument("--sweep", nargs="*", default=[], help="KEY=v1,v2 replaces SWEEP[KEY]")
+    parser.add_argument("--only", nargs="*", default=None, help="parameters to sweep")
+    parser.add_argument("--product", action="store_true", help="all combinations of SWEEP")
+    parser.add_argument("--quick", action="store_true", help="base cases only")
+    parser.add_argument("--duration", type=float, default=0.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--timeout", type=int, default=600)
+    parser.add_argument("--out", default=os.path.join(REPO_ROOT, "benchmarks", "results.json"))
+    parser.add_argument("--compare", default=None, help="json of a previous run")
+    parser.add_argument("--case", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # child process
+    if args.case is not None:
+        result = run_case(json.loads(args.case), args.duration, args.repeat)
+        print(json.dumps(result))
+        return
+
+    sweep = parse_sweep(args.sweep)
+    if args.only is not None:
+        sweep = {key: sweep[key] for key in args.only}
+    if args.quick:
+        sweep = {}
+
+    results = []
+    for case in get_cases(args.modes, sweep, args.product):
+        out = spawn(case, args.duration, args.repeat, args.timeout)
+        results.append(out)
+
+        if "error" in out:
+            print(describe(out), "error:", out["error"])
+        else:
+            print(
+                "%s: build %.2fs (initWeights %.2fs), %.0f steps/s, peak RSS %.0f MB%s"
+                % (
+                    describe(out),
+                    out["build_s"],
+                    out["init_weights_s"],
+                    out["steps_per_s"],
+                    out["peak_rss_mb"],
+                    ", fwd+bwd %.2fs" % out["forward_backward_s"] if "forward_backward_s" in out else "",
+                )
+            )
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=REPO_ROOT
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    meta = {
+        "commit": commit,
+        "date": strftime("%Y-%m-%d %H:%M:%S"),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "duration": args.duration,
+        "repeat": args.repeat,
+        "sim": SIM,
+    }
+
+    with open(args.out, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=1)
+
+    print("results saved to", args.out)
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import math
 import torch
 from torch import nn
 
@@ -17,3 +18,27 @@ class Activation(nn.Module):
             ) * (x < 1.0)
         else:
             return thresh * 0.5 * (1.0 + torch.erf(x / torch.sqrt(torch.tensor(2.0))))
+
+
+def get_activation(func_name="relu", thresh=15):
+    """
+    returns the transfer function func_name as a plain function of x.
+    Same maths as Activation, but the dispatch on func_name is done once.
+    """
+
+    if func_name == "relu":
+        if isinstance(thresh, (int, float)) and thresh == 0:
+            return torch.relu
+        return lambda x: torch.relu(x - thresh)
+
+    sqrt_2 = math.sqrt(2.0)
+
+    if func_name == "erf":
+        return lambda x: torch.erf(x / sqrt_2)
+
+    if func_name == "sqrt":
+        return lambda x: (x >= 1.0) * torch.sqrt(torch.abs(4.0 * x - 3.0)) + x * x * (
+            x >= 0
+        ) * (x < 1.0)
+
+    return lambda x: thresh * 0.5 * (1.0 + torch.erf(x / sqrt_2))
@@ -1,3 +1,6 @@
+import os
+import copy
+
 from yaml import safe_load
 import numpy as np
 
@@ -6,29 +9,63 @@ from torch.distributions import MultivariateNormal
 
 from src.utils import set_seed
 
+# parsed yaml files: path -> (modification time, parameters), see load_yaml
+YAML_CACHE = {}
+
+
+def load_yaml(path):
+    """returns a copy of the parameters in the yaml file path, parsed again only if the file changed"""
+
+    mtime = os.path.getmtime(path)
+
+    cached = YAML_CACHE.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "r") as f:
+            cached = (mtime, safe_load(f))
+        YAML_CACHE[path] = cached
+
+    return copy.deepcopy(cached[1])
+
+
+def get_float(precision):
+    """returns the dtype of a precision of the configuration files: 16, '16b' (bfloat16), 32 or 64"""
+    if precision == 32:
+        return torch.float
+    if precision == 16:
+        return torch.float16
+    if precision == "16b":
+        return torch.bfloat16
+    return torch.float64
+
 
 class Configuration:
     def __init__(self, conf_name, repo_root):
         self.conf_file = repo_root + "/conf/" + conf_name
         self.defaults = repo_root + "/conf/defaults.yml"
 
-    def forward(self, **kwargs):
-        parameters = safe_load(open(self.defaults, "r"))
-        config = safe_load(open(self.conf_file, "r"))
+    def parameters(self, **kwargs):
+        """returns the parameters from defaults.yml, the conf file and kwargs, in that order"""
+        parameters = load_yaml(self.defaults)
+        config = load_yaml(self.conf_file)
         parameters.update(config)
         parameters.update(kwargs)
 
+        return parameters
+
+    def forward(self, **kwargs):
+        parameters = self.parameters(**kwargs)
+
         self.__dict__.update(parameters)
 
+        self.FLOAT = get_float(self.FLOAT_PRECISION)
         if self.FLOAT_PRECISION == 32:
-            self.FLOAT = torch.float
             torch.set_float32_matmul_precision('medium')
-        elif self.FLOAT_PRECISION == 16:
-            self.FLOAT = torch.float16
-        elif self.FLOAT_PRECISION == "16b":
-            self.FLOAT = torch.bfloat16
+
+        # weights can be stored in a lower precision than the state, see engine.get_matmul
+        if self.WEIGHT_PRECISION in (None, "None"):
+            self.WEIGHT_FLOAT = self.FLOAT
         else:
-            self.FLOAT = torch.float64
+            self.WEIGHT_FLOAT = get_float(self.WEIGHT_PRECISION)
 
         self.device = torch.device(self.DEVICE)
         torch.set_default_dtype(self.FLOAT)
@@ -21,8 +21,8 @@ class Connectivity:
         self.verbose = verbose
         self.device = device
 
-    def low_rank_proba(self, kappa, lr_mean, lr_cov, ksi=None, **kwargs):
-        """returns Low rank probability of connection"""
+    def get_ksi(self, lr_mean, lr_cov, ksi=None):
+        """sets self.ksi, the low rank vectors (sampled if ksi is None)"""
 
         if ksi is None:
             if self.verbose:
@@ -47,6 +47,13 @@ class Connectivity:
         if self.verbose:
             print("ksi", self.ksi.shape)
 
+        return self.ksi
+
+    def low_rank_proba(self, kappa, lr_mean, lr_cov, ksi=None, **kwargs):
+        """returns Low rank probability of connection"""
+
+        self.get_ksi(lr_mean, lr_cov, ksi)
+
         if self.ksi.shape[0] == 4:
             Lij = torch.outer(self.ksi[0], self.ksi[1])
             Lij = Lij + torch.outer(self.ksi[2], self.ksi[3])
@@ -132,6 +139,62 @@ class Connectivity:
 
         return Pij
 
+    def get_con_factors(self, proba_type, **kwargs):
+        """
+        returns the low rank factors of get_con_proba, U (Na, rank) and V (Nb, rank)
+        such that Pij = 1 + U @ V.T (None, None for uniform probability).
+        cosine: cos(theta_i - phi_j - phase) is the sum of two outer products.
+        """
+
+        if "cos" in proba_type:
+            kappa, phase = kwargs["kappa"], kwargs["phase"]
+            if "spec" in proba_type:
+                kappa, phase = kwargs["kappa"] / torch.sqrt(self.Kb), 0.0
+
+            theta = torch.linspace(0, 2.0 * torch.pi, self.Na + 1, device=self.device)[:-1]
+            phi = torch.linspace(0, 2.0 * torch.pi, self.Nb + 1, device=self.device)[:-1]
+
+            U = kappa * torch.stack((torch.cos(theta - phase), torch.sin(theta - phase)), -1)
+            V = torch.stack((torch.cos(phi), torch.sin(phi)), -1)
+
+            return U, V
+
+        if "lr" == proba_type:
+            ksi = self.get_ksi(kwargs["lr_mean"], kwargs["lr_cov"], kwargs.get("ksi"))
+            kappa = kwargs["kappa"] / torch.sqrt(self.Kb)
+
+            if ksi.shape[0] == 4:
+                return kappa * torch.stack((ksi[0], ksi[2]), -1), torch.stack((ksi[1], ksi[3]), -1)
+
+            return kappa * ksi.T, ksi.T
+
+        if "von_mises" in proba_type or "gaussian" in proba_type:
+            raise ValueError("%s probability has no low rank form" % proba_type)
+
+        return None, None
+
+    def get_con_kernel(self, proba_type, L, **kwargs):
+        """
+        returns the ring kernel of get_con_proba, P(theta_i - phi_j) at the L angles
+        2 pi m / L (None for uniform probability), for circulant operators.
+        """
+
+        delta = torch.linspace(0, 2.0 * torch.pi, L + 1, device=self.device)[:-1]
+
+        if "cos" in proba_type:
+            if "spec" in proba_type:
+                return 1.0 + kwargs["kappa"] / torch.sqrt(self.Kb) * torch.cos(delta)
+            return 1.0 + kwargs["kappa"] * torch.cos(delta - kwargs["phase"])
+
+        if "von_mises" in proba_type:
+            kappa = torch.as_tensor(kwargs["kappa"], device=self.device)
+            return torch.exp(kappa * torch.cos(delta)) / torch.special.i0(kappa) / 2.0 / torch.pi
+
+        if "lr" == proba_type or "gaussian" in proba_type:
+            raise ValueError("%s probability is not circulant" % proba_type)
+
+        return None
+
     def forward(self, con_type, proba_type, **kwargs):
         """
         returns connectivity Cij
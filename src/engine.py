@@ -0,0 +1,478 @@
+import operator
+import types
+
+import torch
+
+from src.activation import get_activation
+from src.profiler import profiled
+from src.sweep import sweep_mm
+
+
+def int_slice(sl):
+    """returns a slice with python int bounds (tensor bounds are converted at every use)"""
+    return slice(int(sl.start), int(sl.stop))
+
+
+def mixed_precision(mm):
+    """
+    returns mm(x, W) computed in the precision of W (WEIGHT_PRECISION)
+    and returned in the precision of x (FLOAT_PRECISION)
+    """
+
+    def mixed_mm(x, W):
+        if x.dtype == W.dtype:
+            return mm(x, W)
+        return mm(x.to(W.dtype), W).to(x.dtype)
+
+    return mixed_mm
+
+
+def get_matmul(model, mm=operator.matmul):
+    """
+    returns mm, in mixed precision if WEIGHT_PRECISION differs from FLOAT_PRECISION
+    (x @ W by default, W can be an operator, see operators.py)
+    """
+    if model.WEIGHT_FLOAT == model.FLOAT:
+        return mm
+    return mixed_precision(mm)
+
+
+def get_recurrent(model):
+    """
+    returns the function (rates, Wab_T) -> rates @ Wab_T for the layout of Wab_T
+    (SPARSE, OPERATOR) and the batched Jab blocks of a sweep, in mixed precision
+    with WEIGHT_PRECISION
+    """
+
+    # batched Jab blocks (model.Jab_scale is read at each step)
+    if model.Jab_scale is not None:
+
+        def recurrent(rates, Wab_T):
+            return sweep_mm(model, rates, Wab_T)
+
+    elif model.SPARSE == "full":
+        recurrent = torch.sparse.mm
+    elif model.SPARSE == "semi":
+
+        def recurrent(rates, Wab_T):
+            return (Wab_T @ rates.T).T
+
+    elif model.OPERATOR in ("lr", "fft", "bits"):
+
+        def recurrent(rates, Wab_T):
+            return rates @ Wab_T
+
+    else:
+        recurrent = torch.matmul
+
+    return get_matmul(model, recurrent)
+
+
+def split_rows(Wab_T, start, stop, col_start):
+    """returns the block Wab_T[start:stop, col_start:] of a sparse Wab_T, in the layout of Wab_T"""
+
+    W = Wab_T.to_sparse_coo().coalesce()
+    rows, cols = W.indices()
+    keep = (rows >= start) & (rows < stop) & (cols >= col_start)
+
+    block = torch.sparse_coo_tensor(
+        torch.stack((rows[keep] - start, cols[keep] - col_start)),
+        W.values()[keep],
+        (stop - start, Wab_T.shape[1] - col_start),
+    ).coalesce()
+
+    if Wab_T.layout == torch.sparse_csc:
+        return block.to_sparse_csc()
+    return block
+
+
+def get_presynaptic(model):
+    """
+    returns the function (rates, Wab_T, out=None) -> hidden, hidden_E computing the
+    recurrent input by presynaptic population: the product of the excitatory rates
+    hidden_E = rates_E @ Wab_T[E] is computed once, added to the other populations'
+    in hidden = rates @ Wab_T and routed to the NMDA channel (route_nmda).
+    With STP or batched J, the EtoE block of Wab_T is 0 (moved to W_stp_T or W_batch_T)
+    and is skipped: hidden_E only has the postsynaptic neurons from N_E.
+    out is a buffer for hidden (dense Wab_T in FLOAT_PRECISION).
+    returns None without NMDA and STP, for sweeps and SPARSE 'semi' (one product)
+    """
+
+    if not (model.IF_NMDA or model.IF_STP):
+        return None
+
+    if model.Jab_scale is not None:
+        return None
+
+    N_E = int(model.Na[0])
+    E_POST = N_E if (model.IF_STP or model.IF_BATCH_J) else 0
+
+    if model.SPARSE == "full":
+        DENSE = False
+        mm = torch.sparse.mm
+
+        # the blocks are extracted once for each Wab_T
+        def blocks(Wab_T):
+            cache = model.__dict__.get("presynaptic_cache")
+            if cache is None or cache[0] is not Wab_T:
+                N = Wab_T.shape[0]
+                W_E = split_rows(Wab_T, 0, N_E, E_POST)
+                W_I = split_rows(Wab_T, N_E, N, 0)
+                cache = (Wab_T, W_E, W_I)
+                model.__dict__["presynaptic_cache"] = cache
+            return cache[1], cache[2]
+
+    elif model.SPARSE == "semi":
+        return None
+    elif model.OPERATOR in ("lr", "fft", "bits"):
+        DENSE = False
+
+        def blocks(Wab_T):
+            return Wab_T[:N_E, E_POST:], Wab_T[N_E:]
+
+        def mm(x, W):
+            return x @ W
+
+    else:
+        DENSE = True
+        mm = torch.matmul
+
+        def blocks(Wab_T):
+            return Wab_T[:N_E, E_POST:], Wab_T[N_E:]
+
+    # products in the precision of the weights are not written in the state buffers
+    if model.WEIGHT_FLOAT != model.FLOAT:
+        DENSE = False
+        mm = mixed_precision(mm)
+
+    def presynaptic(rates, Wab_T, out=None):
+        W_E, W_I = blocks(Wab_T)
+
+        hidden_E = mm(rates[:, :N_E], W_E)
+
+        if DENSE and out is not None:
+            hidden = torch.matmul(rates[:, N_E:], W_I, out=out)
+        else:
+            hidden = mm(rates[:, N_E:], W_I)
+
+        hidden[:, E_POST:].add_(hidden_E)
+
+        return hidden, hidden_E
+
+    return presynaptic
+
+
+def route_nmda(hidden_E, hidden_stp, N, out=None):
+    """
+    returns the input of the NMDA channel (N neurons) from hidden_E of get_presynaptic,
+    with the stp input (or 0) on the excitatory neurons when the EtoE block is skipped
+    """
+
+    E_POST = N - hidden_E.shape[1]
+    if E_POST == 0:
+        return hidden_E
+
+    if hidden_stp is None:
+        hidden_stp = hidden_E.new_zeros((hidden_E.shape[0], E_POST))
+
+    if out is None:
+        return torch.cat((hidden_stp, hidden_E), 1)
+
+    out[:, :E_POST].copy_(hidden_stp)
+    out[:, E_POST:].copy_(hidden_E)
+
+    return out
+
+
+def make_step(model, workspace=None):
+    """
+    Builds Network.update_dynamics specialized once for the configuration of model.
+    Branches on SPARSE, OPERATOR, Jab_scale, lr_UV, IF_STP, IF_BATCH_J, SYN_DYN, IF_NMDA, RATE_DYN and TF_TYPE
+    are resolved here, population slices have int bounds and the transfer
+    function is a plain function. Elementwise updates use fused addcmul.
+    The products of the excitatory rates are shared by the AMPA, NMDA and STP
+    channels (get_presynaptic). Products with the weights are computed in
+    WEIGHT_PRECISION (get_matmul). With PROFILE, the recurrent, stp, nmda and activation phases are timed.
+    With a workspace (autograd off), the hidden state, net input and rates are
+    buffers of the workspace updated in place: the returned rates are overwritten
+    by the next step.
+    returns:
+    step: function (rates, ff_input, rec_input, Wab_T, W_stp_T) -> rates, rec_input
+    """
+
+    s0 = int_slice(model.slices[0])
+    non_linear = get_activation(model.TF_TYPE, thresh=0)
+
+    N = model.N_NEURON
+    recurrent = get_recurrent(model)
+    matmul = get_matmul(model)
+    IF_SWEEP = model.Jab_scale is not None
+
+    IF_STP = bool(model.IF_STP)
+    # factored low rank term (model.lr_UV is read at each step)
+    IF_LR = model.lr_UV is not None
+    IF_BATCH_J = bool(model.IF_BATCH_J)
+    SYN_DYN = bool(model.SYN_DYN)
+    IF_NMDA = bool(model.IF_NMDA)
+    RATE_DYN = bool(model.RATE_DYN)
+
+    stp_name = {"hansel": "hansel_stp", "mato": "mato_stp"}.get(
+        getattr(model, "STP_TYPE", "markram"), "markram_stp"
+    )
+
+    EXP_DT_TAU_SYN, DT_TAU_SYN = model.EXP_DT_TAU_SYN, model.DT_TAU_SYN
+    EXP_DT_TAU, DT_TAU = model.EXP_DT_TAU, model.DT_TAU
+
+    if IF_NMDA:
+        EXP_DT_TAU_NMDA = model.EXP_DT_TAU_NMDA
+        R_DT_TAU_NMDA = model.R_NMDA * model.DT_TAU_NMDA
+
+    def stp_input(rates_E, W_stp_T):
+        Aux = getattr(model.stp, stp_name)(rates_E)
+        return Aux, matmul(model.J_STP * Aux, W_stp_T)
+
+    presynaptic = get_presynaptic(model)
+
+    if presynaptic is not None:
+
+        def nmda_input(rates, Wab_T, hidden_E, hidden_stp, out=None):
+            return route_nmda(hidden_E, hidden_stp, N, out)
+
+    else:
+
+        def presynaptic(rates, Wab_T, out=None):
+            return recurrent(rates, Wab_T), None
+
+        def nmda_input(rates, Wab_T, hidden_E, hidden_stp, out=None):
+            hidden = matmul(rates[:, s0], Wab_T[s0])
+
+            if IF_SWEEP:
+                hidden = hidden * model.Jab_scale[0]
+
+            if IF_STP:
+                hidden[:, s0] = hidden[:, s0] + hidden_stp
+
+            return hidden
+
+    if workspace is not None:
+        return make_step_inplace(model, workspace, presynaptic, stp_input, nmda_input, matmul)
+
+    if model.PROFILE:
+        presynaptic = profiled(model, "recurrent", presynaptic)
+        stp_input = profiled(model, "stp", stp_input)
+        nmda_input = profiled(model, "nmda", nmda_input)
+        non_linear = profiled(model, "activation", non_linear)
+
+    def step(rates, ff_input, rec_input, Wab_T, W_stp_T):
+        # update hidden state
+        hidden, hidden_E = presynaptic(rates, Wab_T)
+
+        if IF_LR and not IF_STP:
+            U, V = model.lr_UV
+            hidden = hidden + (rates @ V) @ U.T
+
+        # update stp variables
+        hidden_stp = None
+        if IF_STP:
+            Aux, hidden_stp = stp_input(rates[:, s0], W_stp_T)
+
+            if IF_LR:
+                U, V = model.lr_UV
+                hidden_stp = hidden_stp + (model.J_STP * Aux @ V) @ U.T
+
+            hidden[:, s0] = hidden[:, s0] + hidden_stp
+
+        # update batched EtoE
+        if IF_BATCH_J:
+            hidden[:, s0].add_(matmul(model.Jab_batch * rates[:, s0], model.W_batch_T))
+
+        # update reccurent input
+        if SYN_DYN:
+            rec_input[0] = torch.addcmul(rec_input[0] * EXP_DT_TAU_SYN, hidden, DT_TAU_SYN)
+        else:
+            rec_input[0] = hidden
+
+        # compute net input
+        net_input = ff_input + rec_input[0]
+
+        if IF_NMDA:
+            hidden = nmda_input(rates, Wab_T, hidden_E, hidden_stp)
+
+            if IF_LR and not IF_STP:
+                U, V = model.lr_UV
+                hidden = hidden + (rates[:, s0] @ V[s0]) @ U.T
+
+            rec_input[1] = torch.addcmul(
+                rec_input[1] * EXP_DT_TAU_NMDA, hidden, R_DT_TAU_NMDA
+            )
+            net_input = net_input + rec_input[1]
+
+        # update rates
+        if RATE_DYN:
+            return torch.addcmul(rates * EXP_DT_TAU, non_linear(net_input), DT_TAU), rec_input
+
+        return non_linear(net_input), rec_input
+
+    return step
+
+
+def make_step_inplace(model, workspace, presynaptic, stp_input, nmda_input, matmul):
+    """
+    returns the step of make_step updating the buffers of workspace in place
+    (same operations, same results), for forward passes without autograd
+    """
+
+    s0 = int_slice(model.slices[0])
+
+    # the relu is applied in place on the net input
+    if model.TF_TYPE == "relu":
+        non_linear = torch.relu_
+    else:
+        non_linear = get_activation(model.TF_TYPE, thresh=0)
+
+    if model.PROFILE:
+        presynaptic = profiled(model, "recurrent", presynaptic)
+        stp_input = profiled(model, "stp", stp_input)
+        nmda_input = profiled(model, "nmda", nmda_input)
+        non_linear = profiled(model, "activation", non_linear)
+
+    IF_STP = bool(model.IF_STP)
+    IF_LR = model.lr_UV is not None
+    IF_BATCH_J = bool(model.IF_BATCH_J)
+    SYN_DYN = bool(model.SYN_DYN)
+    IF_NMDA = bool(model.IF_NMDA)
+    RATE_DYN = bool(model.RATE_DYN)
+
+    EXP_DT_TAU_SYN, DT_TAU_SYN = model.EXP_DT_TAU_SYN, model.DT_TAU_SYN
+    EXP_DT_TAU, DT_TAU = model.EXP_DT_TAU, model.DT_TAU
+
+    if IF_NMDA:
+        EXP_DT_TAU_NMDA = model.EXP_DT_TAU_NMDA
+        R_DT_TAU_NMDA = model.R_NMDA * model.DT_TAU_NMDA
+
+    def step(rates, ff_input, rec_input, Wab_T, W_stp_T):
+        shape, dtype = rates.shape, rates.dtype
+
+        # update hidden state
+        hidden, hidden_E = presynaptic(rates, Wab_T, workspace("hidden", shape, dtype))
+
+        if IF_LR and not IF_STP:
+            U, V = model.lr_UV
+            hidden.add_((rates @ V) @ U.T)
+
+        # update stp variables
+        hidden_stp = None
+        if IF_STP:
+            Aux, hidden_stp = stp_input(rates[:, s0], W_stp_T)
+
+            if IF_LR:
+                U, V = model.lr_UV
+                hidden_stp = hidden_stp + (model.J_STP * Aux @ V) @ U.T
+
+            hidden[:, s0].add_(hidden_stp)
+
+        # update batched EtoE
+        if IF_BATCH_J:
+            hidden[:, s0].add_(matmul(model.Jab_batch * rates[:, s0], model.W_batch_T))
+
+        # update reccurent input
+        if SYN_DYN:
+            rec_input[0].mul_(EXP_DT_TAU_SYN).addcmul_(hidden, DT_TAU_SYN)
+        else:
+            rec_input[0].copy_(hidden)
+
+        # compute net input
+        net_input = torch.add(ff_input, rec_input[0], out=workspace("net_input", shape, dtype))
+
+        if IF_NMDA:
+            hidden = nmda_input(rates, Wab_T, hidden_E, hidden_stp, hidden)
+
+            if IF_LR and not IF_STP:
+                U, V = model.lr_UV
+                hidden.add_((rates[:, s0] @ V[s0]) @ U.T)
+
+            rec_input[1].mul_(EXP_DT_TAU_NMDA).addcmul_(hidden, R_DT_TAU_NMDA)
+            net_input.add_(rec_input[1])
+
+        # update rates, in their own buffer (rates is the input of the next step)
+        out = workspace("rates", shape, dtype)
+
+        if RATE_DYN:
+            if out is not rates:
+                out = torch.mul(rates, EXP_DT_TAU, out=out)
+            else:
+                out.mul_(EXP_DT_TAU)
+            return out.addcmul_(non_linear(net_input), DT_TAU), rec_input
+
+        return out.copy_(non_linear(net_input)), rec_input
+
+    return step
+
+
+# code objects of the compiled steps, by configuration, shapes and grad mode
+STEP_CODES = {}
+
+
+def own_code(func, key):
+    """
+    returns a copy of func with the code object of key. torch.compile caches the
+    graphs on the code object, shared by all the closures of make_step: steps of
+    different keys keep their own graphs and recompile limit, steps of the same
+    key (models of the same configuration) share them.
+    """
+    code = STEP_CODES.setdefault(key, func.__code__.replace())
+    return types.FunctionType(code, func.__globals__, func.__name__, func.__defaults__, func.__closure__)
+
+
+def get_step(model, workspace=None):
+    """
+    returns the time step function selected by model.STEP_ENGINE:
+    'python' (Network.update_dynamics), 'closure' (make_step) or
+    'compile' (make_step compiled with torch.compile).
+    The specialized step is cached on the model for its configuration and grad mode.
+    With 'compile', the step is compiled once per configuration, shapes and grad mode
+    and the graph is shared by the models of the same configuration.
+    The workspace (see workspace.py) is used by 'closure' only.
+    """
+
+    if model.STEP_ENGINE == "python":
+        return model.update_dynamics
+
+    if model.STEP_ENGINE != "closure":
+        workspace = None
+
+    key = (
+        model.STEP_ENGINE,
+        model.SPARSE,
+        model.OPERATOR,
+        model.IF_STP,
+        model.IF_BATCH_J,
+        model.SYN_DYN,
+        model.IF_NMDA,
+        model.RATE_DYN,
+        model.TF_TYPE,
+        model.DT,
+        model.Jab_scale is not None,
+        model.lr_UV is not None,
+        bool(model.PROFILE),
+    )
+
+    cache = model.__dict__.get("step_cache")
+    if cache is None or cache[0] != key:
+        cache = (key, {})
+        model.__dict__["step_cache"] = cache
+
+    # dynamo guards on the grad mode: one step per grad mode
+    mode = (torch.is_grad_enabled(), workspace)
+    steps = cache[1]
+
+    if mode not in steps:
+        step = make_step(model, workspace)
+
+        if model.STEP_ENGINE == "compile":
+            shapes = (model.N_BATCH, model.N_NEURON)
+            step = torch.compile(own_code(step, key + shapes + mode[:1]), dynamic=False)
+
+        steps[mode] = step
+
+    return steps[mode]
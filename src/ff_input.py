@@ -3,95 +3,210 @@ import numpy as np
 
 from src.stimuli import Stimuli
 from src.lr_utils import get_theta
+from src.noise import get_noise, PHASE_NOISE
 
 
-def live_ff_input(model, step, ff_input):
-    noise = 0
-    if model.VAR_FF[0, 0, 0] > 0:
-        noise = torch.randn((model.N_BATCH, model.N_NEURON), device=model.device)
-        for i_pop in range(model.N_POP):
-            noise[:, model.slices[i_pop]].mul_(model.VAR_FF[:, i_pop])
+def ff_noise(model, start, stop, noise=None):
+    """
+    returns the unit gaussian noise (N_BATCH, stop - start, N_NEURON) of the steps start to stop,
+    from the global generator or from noise (NoiseStream of NOISE_SEED)
+    """
+    if noise is None:
+        return torch.randn((model.N_BATCH, stop - start, model.N_NEURON), device=model.device)
+    return noise.steps(start, stop, model.N_NEURON)
+
+
+def random_phase(model, noise=None, index=0):
+    """returns random phases (N_BATCH, 1) of the 'rand' tasks, index: stimulus presentation"""
+    if noise is None:
+        return torch.rand((model.N_BATCH, 1), device=model.device) * 2.0 * torch.pi
+    return noise.trial((1,), PHASE_NOISE, index, torch.rand) * 2.0 * torch.pi
+
+
+def get_live_stimuli(model):
+    """
+    Creates the live ff input of population 0 during each stimulus presentation (N_STIM_ON),
+    Ja0 plus the stimulus in the units of the scaled Ja0. The 'rand' tasks draw a new phase
+    for each presentation, model.phase is the phase of the last one.
+    returns:
+    stimuli: list of tensors (N_BATCH, Na[0]), one per N_STIM_ON (None after the trial),
+             [] without TASK
+    """
+
+    stimuli = []
+    if model.TASK == "None":
+        return stimuli
+
+    size = (model.N_BATCH, model.Na[0])
+    Stimulus = Stimuli(model.TASK, size, device=model.device)
+    noise = get_noise(model)
+
+    theta = None
+    if "dual" in model.TASK:
+        theta = get_theta(model.PHI0[0], model.PHI0[2]).unsqueeze(0)
+
+    for i, on in enumerate(model.N_STIM_ON):
+        if on >= model.N_STEPS:
+            stimuli.append(None)
+            continue
+
+        Stimulus.task = model.TASK
+
+        if "rand" in model.TASK:
+            model.phase = random_phase(model, noise, i)
+
+            Stimulus.task = "odr"
+            stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.phase, theta=theta)
+
+        elif "dual" in model.TASK:
+            if "odr" in model.TASK:
+                phase = torch.ones((size[0], 1), device=model.device)
+                phase = phase * model.PHI1[i]
+
+                if i == 0:
+                    Stimulus.task = "dual"
+                    stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.PHI0[2 * i + 1])
+                else:
+                    Stimulus.task = "odr"
+                    stimulus = Stimulus(model.I0[i], model.SIGMA0[i], phase, theta=theta)
+            else:
+                if model.LR_TRAIN:
+                    if model.I0[i] > 0:
+                        stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.odors[i])
+                    else:
+                        stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.odors[5 + i])
+                else:
+                    stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.PHI0[2 * i + 1])
+
+                    if i == 0:
+                        # multiply last half of stimulus by -1 to get two samples A/B
+                        stimulus = model.stim_mask[:, i] * stimulus
+        else:
+            stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.PHI0[:, i])
+
+        stimulus = model.Ja0[:, 0] + torch.sqrt(model.Ka[0]) * model.M0 * stimulus
+        stimuli.append(stimulus.expand(size))
+
+    return stimuli
+
+
+def cat_stimuli(*stimuli):
+    """
+    returns the stimuli of several models (get_live_stimuli) along the batch dimension,
+    so that trials of different tasks, phases or amplitudes run in one batch, e.g.
+    cat_stimuli(get_live_stimuli(model.with_overrides(TASK='odr', N_BATCH=8)), ...)
+    """
+    return [
+        None if presentation[0] is None else torch.cat(presentation)
+        for presentation in zip(*stimuli)
+    ]
+
+
+class StimulusTimeline:
+    """
+    Class: StimulusTimeline
+    Schedule of the live ff input (LIVE_FF_UPDATE) compiled once per trial:
+    the steps where the input changes and the precomputed values written
+    to each population, so that a step without event is a dict lookup.
+    Parameters:
+        model: Network
+        stimuli: list of tensors (N_BATCH, Na[0]), the input of population 0 during
+                 each stimulus presentation, get_live_stimuli(model) if None.
+                 Rows can differ in task, phase and amplitude (see cat_stimuli).
+    """
+
+    def __init__(self, model, stimuli=None):
+        if stimuli is None:
+            stimuli = get_live_stimuli(model)
+
+        for stimulus in stimuli:
+            if stimulus is not None and stimulus.shape[0] != model.N_BATCH:
+                raise ValueError(
+                    "stimuli have %d trials, N_BATCH is %d" % (stimulus.shape[0], model.N_BATCH)
+                )
+
+        # step -> {i_pop: value}, the last write of a step wins
+        self.events = {}
+        self.slices = model.slices
 
-    if step == 0:
         for i_pop in range(model.N_POP):
             if model.BUMP_SWITCH[i_pop]:
-                ff_input[:, model.slices[i_pop]] = model.Ja0[:, i_pop] / torch.sqrt(
-                    model.Ka[0]
-                )
+                self.write(0, i_pop, model.Ja0[:, i_pop] / torch.sqrt(model.Ka[0]))
             else:
-                ff_input[:, model.slices[i_pop]] = model.Ja0[:, i_pop]
+                self.write(0, i_pop, model.Ja0[:, i_pop])
 
-    if step == model.N_STIM_ON[0]:
         for i_pop in range(model.N_POP):
-            ff_input[:, model.slices[i_pop]] = model.Ja0[:, i_pop]
+            self.write(model.N_STIM_ON[0], i_pop, model.Ja0[:, i_pop])
 
-    if model.TASK != "None":
-        if step in model.N_STIM_ON:
-            i = np.where(model.N_STIM_ON == step)[0][0]
+        if stimuli:
+            # a repeated onset presents its first stimulus
+            onsets = set()
+            for on, stimulus in zip(model.N_STIM_ON, stimuli):
+                if stimulus is not None and on not in onsets:
+                    self.write(on, 0, stimulus)
+                    onsets.add(on)
 
-            size = (model.N_BATCH, model.Na[0])
-            Stimulus = Stimuli(model.TASK, size, device=model.device)
+            for off in model.N_STIM_OFF:
+                self.write(off, 0, model.Ja0[:, 0])
 
-            if "rand" in model.TASK:
-                model.phase = (
-                    torch.rand((size[0], 1), device=model.device) * 2.0 * torch.pi
-                )
+        # std of the ff noise per neuron, unit noise drawn by blocks with NOISE_SEED
+        self.noise = get_noise(model)
+        self.noise_start, self.noise_block = None, None
 
-            theta = None
-            if "dual" in model.TASK:
-                theta = get_theta(model.PHI0[0], model.PHI0[2]).unsqueeze(0)
+        self.noise_std = None
+        if model.VAR_FF[0, 0, 0] > 0:
+            self.noise_std = torch.empty((model.VAR_FF.shape[0], model.N_NEURON), device=model.device)
+            for i_pop in range(model.N_POP):
+                self.noise_std[:, model.slices[i_pop]] = model.VAR_FF[:, i_pop]
 
-            if "rand" in model.TASK:
-                Stimulus.task = "odr"
-                stimulus = Stimulus(
-                    model.I0[i], model.SIGMA0[i], model.phase, theta=theta
-                )
+        self.model = model
 
-            elif "dual" in model.TASK:
-                if "odr" in model.TASK:
-                    phase = torch.ones((size[0], 1), device=model.device)
-                    phase = phase * model.PHI1[i]
+    def write(self, step, i_pop, value):
+        """sets the input of population i_pop from step on"""
+        self.events.setdefault(int(step), {})[i_pop] = value
 
-                    if i == 0:
-                        Stimulus.task = "dual"
-                        stimulus = Stimulus(
-                            model.I0[i], model.SIGMA0[i], model.PHI0[2 * i + 1]
-                        )
-                    else:
-                        Stimulus.task = "odr"
-                        stimulus = Stimulus(
-                            model.I0[i], model.SIGMA0[i], phase, theta=theta
-                        )
-                else:
-                    if model.LR_TRAIN:
-                        if model.I0[i] > 0:
-                            stimulus = Stimulus(
-                                model.I0[i], model.SIGMA0[i], model.odors[i])
-                        else:
-                            stimulus = Stimulus(
-                                model.I0[i], model.SIGMA0[i], model.odors[5+i])
-                    else:
-                        stimulus = Stimulus(
-                            model.I0[i], model.SIGMA0[i], model.PHI0[2 * i + 1]
-                        )
+    def noise_step(self, step):
+        """returns the unit ff noise (N_BATCH, N_NEURON) of step"""
 
-                        if i == 0:
-                            # multiply last half of stimulus by -1 to get two samples A/B
-                            stimulus = model.stim_mask[:, i] * stimulus
-            else:
-                stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.PHI0[:, i])
+        if self.noise is None:
+            return ff_noise(self.model, step, step + 1)[:, 0]
 
-            ff_input[:, model.slices[0]] = (
-                model.Ja0[:, 0] + torch.sqrt(model.Ka[0]) * model.M0 * stimulus
-            )
+        block = self.noise.block
+        if self.noise_start is None or not (self.noise_start <= step < self.noise_start + block):
+            self.noise_start = step - step % block
+            self.noise_block = ff_noise(self.model, self.noise_start, self.noise_start + block, self.noise)
+
+        return self.noise_block[:, step - self.noise_start]
+
+    def __call__(self, step, ff_input):
+        """
+        returns ff_input (N_BATCH, N_NEURON) at step, updated in place,
+        and the ff noise of the step (0 without VAR_FF)
+        """
+
+        noise = 0
+        if self.noise_std is not None:
+            noise = self.noise_step(step) * self.noise_std
+
+        writes = self.events.get(step)
+        if writes is not None:
+            for i_pop, value in writes.items():
+                ff_input[:, self.slices[i_pop]] = value
+
+        return ff_input, noise
 
-        if step in model.N_STIM_OFF:
-            ff_input[:, model.slices[0]] = model.Ja0[:, 0]
 
-    return ff_input, noise
+def live_ff_input(model, step, ff_input):
+    """returns ff_input at step and the ff noise, from the timeline of the trial (StimulusTimeline)"""
+
+    # compiled by init_ff_live or initRates (ff inputs given to forward)
+    if getattr(model, "timeline", None) is None:
+        model.timeline = StimulusTimeline(model)
+
+    return model.timeline(step, ff_input)
 
 
-def init_ff_live(model):
+def init_ff_live(model, stimuli=None):
     # Here, ff_input is (N_BATCH, N_NEURON) and is updated at each timestep.
     # Otherwise, ff_input is (N_BATCH, N_STEP, N_NEURON).
     # Live FF update is recommended when dealing with large batch size.
@@ -100,6 +215,9 @@ def init_ff_live(model):
 
     model.stim_mask[model.N_BATCH // 2 :] = -1
 
+    # the schedule of the trial, with its stimuli
+    model.timeline = StimulusTimeline(model, stimuli)
+
     ff_input = torch.zeros((model.N_BATCH, model.N_NEURON), device=model.device)
 
     ff_input, _ = live_ff_input(model, 0, ff_input)
@@ -107,41 +225,21 @@ def init_ff_live(model):
     return ff_input
 
 
-def init_ff_seq(model):
+def get_stimuli(model):
     """
-    Creates ff input to the network for all timesteps.
-    Inputs can be noisy or not and depends on the task.
+    Creates the stimulus vectors of each stimulus presentation (N_STIM_ON).
     returns:
-    ff_input: tensorfloat of size (N_BATCH, N_STEPS, N_NEURON)
+    stimuli: list of stimuli added to population 0 between N_STIM_ON[i] and N_STIM_OFF[i]
     """
 
-    ff_input = torch.randn(
-        (model.N_BATCH, model.N_STEPS, model.N_NEURON),
-        device=model.device,
-    )
-
-    for i_pop in range(model.N_POP):
-        ff_input[..., model.slices[i_pop]].mul_(model.VAR_FF[:, i_pop])
-
-    for i_pop in range(model.N_POP):
-        if model.BUMP_SWITCH[i_pop]:
-            ff_input[:, : model.N_STIM_ON[0], model.slices[i_pop]].add_(
-                model.Ja0[:, i_pop] / torch.sqrt(model.Ka[0])
-            )
-        else:
-            ff_input[:, : model.N_STIM_ON[0], model.slices[i_pop]].add_(
-                model.Ja0[:, i_pop]
-            )
-
-    for i_pop in range(model.N_POP):
-        ff_input[:, model.N_STIM_ON[0] :, model.slices[i_pop]].add_(model.Ja0[:, i_pop])
+    stimuli = []
 
     if model.TASK != "None":
         size = (model.N_BATCH, model.Na[0])
         Stimulus = Stimuli(model.TASK, size, device=model.device)
 
         if "rand" in model.TASK:
-            model.phase = torch.rand((size[0], 1), device=model.device) * 2.0 * torch.pi
+            model.phase = random_phase(model, get_noise(model))
 
             theta = None
             if "dual" in model.TASK:
@@ -176,18 +274,167 @@ def init_ff_seq(model):
                 stimulus = Stimulus(model.I0[i], model.SIGMA0[i], model.PHI0[:, i])
 
             # reshape stimulus to be (N_BATCH, 1, NE) adding dummy time dimension
-            # stimulus = stimulus.unsqueeze(1)
+            if torch.is_tensor(stimulus) and stimulus.dim() == 2:
+                stimulus = stimulus.unsqueeze(1)
             # print(stimulus.shape)
 
-            if model.N_STIM_ON[i] < model.N_STEPS:
-                ff_input[:, model.N_STIM_ON[i] : model.N_STIM_OFF[i], model.slices[0]].add_(
-                    stimulus
-                )
-            del stimulus
+            stimuli.append(stimulus)
+
+    return stimuli
+
+
+def add_ff_schedule(model, ff_input, stimuli, start=0):
+    """
+    Adds the baseline inputs Ja0 and the stimuli to ff_input in place.
+    ff_input: tensorfloat of size (N_BATCH, N_CHUNK, N_NEURON) holding the steps
+    start to start + N_CHUNK of the trial.
+    """
+
+    stop = start + ff_input.shape[1]
+
+    # steps before the first stimulus, relative to start
+    n_pre = min(max(model.N_STIM_ON[0] - start, 0), stop - start)
+
+    # Ja0[:, i_pop, None] is (N_BATCH, 1, 1) for the time dimension
+    for i_pop in range(model.N_POP):
+        if model.BUMP_SWITCH[i_pop]:
+            ff_input[:, :n_pre, model.slices[i_pop]].add_(
+                model.Ja0[:, i_pop, None] / torch.sqrt(model.Ka[0])
+            )
+        else:
+            ff_input[:, :n_pre, model.slices[i_pop]].add_(model.Ja0[:, i_pop, None])
+
+    for i_pop in range(model.N_POP):
+        ff_input[:, n_pre:, model.slices[i_pop]].add_(model.Ja0[:, i_pop, None])
+
+    for i, stimulus in enumerate(stimuli):
+        if model.N_STIM_ON[i] < model.N_STEPS:
+            on = max(model.N_STIM_ON[i], start) - start
+            off = min(model.N_STIM_OFF[i], stop) - start
+
+            if on < off:
+                ff_input[:, on:off, model.slices[0]].add_(stimulus)
+
+    return ff_input
+
+
+def init_ff_seq(model):
+    """
+    Creates ff input to the network for all timesteps.
+    Inputs can be noisy or not and depends on the task.
+    returns:
+    ff_input: tensorfloat of size (N_BATCH, N_STEPS, N_NEURON)
+    """
+
+    ff_input = ff_noise(model, 0, model.N_STEPS, get_noise(model))
+
+    for i_pop in range(model.N_POP):
+        ff_input[..., model.slices[i_pop]].mul_(model.VAR_FF[:, i_pop])
+
+    stimuli = get_stimuli(model)
+    add_ff_schedule(model, ff_input, stimuli)
+    del stimuli
 
     return ff_input * torch.sqrt(model.Ka[0]) * model.M0
 
 
+def mean_ff_input(model, step=0, stimuli=None):
+    """
+    returns the ff input at step without noise (N_BATCH, N_NEURON):
+    the baseline inputs Ja0 and the stimuli that are on at step
+    stimuli: list of get_stimuli(model), created if None
+    """
+
+    if stimuli is None:
+        stimuli = get_stimuli(model)
+
+    ff_input = torch.zeros((model.N_BATCH, 1, model.N_NEURON), device=model.device)
+    add_ff_schedule(model, ff_input, stimuli, step)
+
+    # the live ff input is in the units of the scaled Ja0
+    if not model.LIVE_FF_UPDATE:
+        ff_input = ff_input * torch.sqrt(model.Ka[0]) * model.M0
+
+    return ff_input[:, 0]
+
+
+class FFStream:
+    """
+    Streams the ff input of init_ff_seq in chunks of N_CHUNK time steps,
+    so that peak memory is O(N_BATCH * N_CHUNK * N_NEURON) whatever the
+    duration of the trial. Same stimulus schedule and noise statistics.
+    Indexed like the full tensor, ff_input[:, step] returns (N_BATCH, N_NEURON).
+    """
+
+    def __init__(self, model, N_CHUNK):
+        self.model = model
+        self.N_CHUNK = int(N_CHUNK)
+        self.shape = (model.N_BATCH, model.N_STEPS, model.N_NEURON)
+        self.device = model.device
+
+        self.stimuli = get_stimuli(model)
+        self.noise = get_noise(model)
+
+        self.start = None
+        self.chunk = None
+
+    def get_chunk(self, start):
+        """returns ff input for steps start to start + N_CHUNK"""
+
+        model = self.model
+        n_steps = min(self.N_CHUNK, model.N_STEPS - start)
+
+        ff_input = ff_noise(model, start, start + n_steps, self.noise)
+
+        for i_pop in range(model.N_POP):
+            ff_input[..., model.slices[i_pop]].mul_(model.VAR_FF[:, i_pop])
+
+        add_ff_schedule(model, ff_input, self.stimuli, start)
+
+        return ff_input.mul_(torch.sqrt(model.Ka[0]) * model.M0)
+
+    def __getitem__(self, idx):
+        step = idx[1]
+
+        if self.start is None or not (self.start <= step < self.start + self.N_CHUNK):
+            self.start = step - step % self.N_CHUNK
+            self.chunk = self.get_chunk(self.start)
+
+        return self.chunk[:, step - self.start]
+
+    def segment(self, start, stop):
+        """returns the ff input of steps start to stop as an FFSegment (drawn now, not when it is indexed)"""
+        return FFSegment(torch.stack([self[:, step] for step in range(start, stop)], 1), start)
+
+    def to(self, device):
+        return self
+
+    def __len__(self):
+        return self.shape[0]
+
+
+class FFSegment:
+    """
+    ff input of the steps start to start + ff_input.shape[1] of an FFStream,
+    indexed by the step like the stream. Checkpointed segments (CKPT_SEGMENT)
+    get it from outside of the checkpoint, so that the recomputation in the
+    backward pass uses the same noise and not draws of a chunk cache in another state.
+    """
+
+    def __init__(self, ff_input, start):
+        self.ff_input = ff_input
+        self.start = start
+
+    def __getitem__(self, idx):
+        return self.ff_input[:, idx[1] - self.start]
+
+    def to(self, device):
+        return self
+
+    def __len__(self):
+        return self.ff_input.shape[0]
+
+
 def rl_ff_udpdate(model, ff_input, rates, step, rwd):
     if step == model.N_STIM_ON[rwd]:
         size = (model.N_BATCH, model.Na[0])
@@ -226,7 +473,19 @@ def rl_ff_udpdate(model, ff_input, rates, step, rwd):
 
     return ff_input
 
-def init_ff_input(model):
+def init_ff_input(model, stimuli=None):
+    """
+    returns the ff input of a trial, stimuli: list of live stimuli per trial
+    (see StimulusTimeline), LIVE_FF_UPDATE only
+    """
     if model.LIVE_FF_UPDATE:
-        return init_ff_live(model)
+        return init_ff_live(model, stimuli)
+
+    if stimuli is not None:
+        raise ValueError("stimuli per trial need LIVE_FF_UPDATE")
+
+    # the rl update writes into the full ff input
+    if model.FF_CHUNK and not (model.LR_TRAIN and model.IF_RL):
+        return FFStream(model, model.FF_CHUNK)
+
     return init_ff_seq(model)
@@ -0,0 +1,312 @@
+from contextlib import contextmanager
+
+import torch
+
+from src.activation import Activation
+from src.engine import get_step
+from src.ff_input import mean_ff_input
+
+
+def pack(model, rates, rec_input):
+    """returns the state of the dynamics as one vector per trial (N_BATCH, D)"""
+
+    z = [rates, rec_input.transpose(0, 1).reshape(rates.shape[0], -1)]
+    if model.IF_STP:
+        z += [model.stp.u_stp, model.stp.x_stp]
+
+    return torch.cat(z, 1)
+
+
+def unpack(model, z):
+    """returns rates, rec_input and sets the stp variables of model from z"""
+
+    N_BATCH, N = z.shape[0], model.N_NEURON
+    N_REC = model.IF_NMDA + 1
+
+    rates = z[:, :N]
+    rec_input = z[:, N : N * (N_REC + 1)].reshape(N_BATCH, N_REC, N).transpose(0, 1)
+
+    if model.IF_STP:
+        Na = int(model.Na[0])
+        u_stp = z[:, N * (N_REC + 1) : N * (N_REC + 1) + Na]
+        x_stp = z[:, N * (N_REC + 1) + Na :]
+        model.stp.u_stp, model.stp.x_stp = u_stp, x_stp
+
+    return rates, rec_input
+
+
+def lstsq(A, b):
+    """
+    returns argmin |A x - b| for each batch of A (N_BATCH, M, K) and b (N_BATCH, M, 1),
+    in double precision. A can be rank deficient: gelsd (svd) on cpu, and the
+    pseudo inverse on cuda (gels needs full rank) or if the solve fails.
+    """
+
+    A, b = A.double(), b.double()
+
+    # diverged trials (nan, inf) get x = 0 instead of failing the batch
+    finite = (torch.isfinite(A).all((1, 2)) & torch.isfinite(b).all((1, 2)))[:, None, None]
+    A, b = torch.where(finite, A, 0.0), torch.where(finite, b, 0.0)
+
+    if A.device.type == "cpu":
+        try:
+            return torch.linalg.lstsq(A, b, driver="gelsd").solution
+        except RuntimeError:
+            pass
+
+    return torch.linalg.pinv(A) @ b
+
+
+def ridge(A, b, reg=1e-10):
+    """
+    returns argmin |A x - b|^2 + reg |A|_F^2 |x|^2 (batched as lstsq) by normal equations
+    in double precision, the damping of the Anderson mixing. Singular systems go to lstsq.
+    """
+
+    A, b = A.double(), b.double()
+
+    AtA = A.transpose(1, 2) @ A
+    lam = reg * AtA.diagonal(dim1=1, dim2=2).sum(-1)
+    AtA = AtA + lam[:, None, None] * torch.eye(A.shape[-1], device=A.device, dtype=A.dtype)
+
+    try:
+        return torch.linalg.solve(AtA, A.transpose(1, 2) @ b)
+    except RuntimeError:
+        return lstsq(A, b)
+
+
+def anderson(func, z, tol=1e-5, max_iter=1000, m=5, beta=1.0, verbose=0):
+    """
+    Anderson acceleration (type II) of the iteration z = func(z), batched:
+    each row of z is an independent problem with its own history.
+    returns:
+    z (N_BATCH, D), residual (N_BATCH,) max |func(z) - z|, number of iterations
+    """
+
+    f = func(z) - z
+    residual = f.abs().amax(1)
+
+    dZ, dF = [], []
+    for n_iter in range(max_iter + 1):
+        converged = residual < tol
+        if converged.all() or n_iter == max_iter:
+            break
+
+        z_new = z + beta * f
+
+        if dZ:
+            DZ, DF = torch.stack(dZ, -1), torch.stack(dF, -1)
+
+            # min |f - DF gamma| per trial, damped as the history is often nearly collinear
+            gamma = ridge(DF, f.unsqueeze(-1)).to(z.dtype)
+            z_new = z_new - ((DZ + beta * DF) @ gamma).squeeze(-1)
+
+        # converged trials are not updated
+        z_new = torch.where(converged[:, None], z, z_new)
+        f_new = func(z_new) - z_new
+
+        dZ.append(z_new - z)
+        dF.append(f_new - f)
+        if len(dZ) > m:
+            dZ.pop(0)
+            dF.pop(0)
+
+        z, f = z_new, f_new
+        residual = f.abs().amax(1)
+
+        if verbose and n_iter % 10 == 0:
+            print("iter", n_iter, "residual", residual.max().item())
+
+    return z, residual, n_iter
+
+
+def gmres(A, b, n_iter=20):
+    """
+    Solves A(x) = b by GMRES without restart from x = 0, batched:
+    A acts on each row of x independently (block diagonal Jacobian).
+    returns x (N_BATCH, D)
+    """
+
+    tiny = torch.finfo(b.dtype).tiny
+    beta = b.norm(dim=1)
+
+    Q = [b / beta.clamp_min(tiny)[:, None]]
+    H = torch.zeros((b.shape[0], n_iter + 1, n_iter), device=b.device, dtype=b.dtype)
+
+    # Arnoldi with modified Gram-Schmidt
+    for k in range(n_iter):
+        w = A(Q[k])
+        for j in range(k + 1):
+            H[:, j, k] = (Q[j] * w).sum(1)
+            w = w - H[:, j, k, None] * Q[j]
+
+        H[:, k + 1, k] = w.norm(dim=1)
+        Q.append(w / H[:, k + 1, k].clamp_min(tiny)[:, None])
+
+    # min |beta e1 - H y|
+    e1 = torch.zeros((b.shape[0], n_iter + 1, 1), device=b.device, dtype=b.dtype)
+    e1[:, 0, 0] = beta
+
+    y = lstsq(H, e1).to(b.dtype)
+
+    return (torch.stack(Q[:n_iter], -1) @ y).squeeze(-1)
+
+
+def newton_krylov(func, z, tol=1e-5, max_iter=50, n_krylov=20, verbose=0):
+    """
+    Newton iteration on func(z) - z = 0, the Newton steps are solved by GMRES with
+    Jacobian-vector products of func (forward mode autodiff), batched over trials.
+    Steps are halved until the residual of each trial decreases, trials where
+    no step decreases it are stopped (stalled) and keep their last iterate.
+    returns:
+    z (N_BATCH, D), residual (N_BATCH,) max |func(z) - z|, number of iterations
+    """
+
+    f = func(z) - z
+    residual = f.abs().amax(1)
+    stalled = torch.zeros_like(residual, dtype=torch.bool)
+
+    for n_iter in range(max_iter + 1):
+        converged = residual < tol
+        done = converged | stalled
+        if done.all() or n_iter == max_iter:
+            break
+
+        def jvp(v):
+            return torch.func.jvp(func, (z,), (v,))[1] - v
+
+        dz = gmres(jvp, -f, n_krylov)
+        dz = torch.where(done[:, None], torch.zeros_like(dz), dz)
+
+        # backtracking, per trial
+        z_new, f_new, res_new = z, f, residual
+        todo = ~done
+        step = 1.0
+        for _ in range(6):
+            z_try = z + step * dz
+            f_try = func(z_try) - z_try
+            res_try = f_try.abs().amax(1)
+
+            better = todo & (res_try < residual)
+            z_new = torch.where(better[:, None], z_try, z_new)
+            f_new = torch.where(better[:, None], f_try, f_new)
+            res_new = torch.where(better, res_try, res_new)
+
+            todo = todo & ~better
+            if not todo.any():
+                break
+            step = step / 2.0
+
+        # no decrease: the trial keeps z and stops (precision limit or bad Newton step)
+        stalled = stalled | todo
+
+        z, f, residual = z_new, f_new, res_new
+
+        if verbose:
+            print("iter", n_iter, "residual", residual.max().item(), "stalled", int(stalled.sum()))
+
+    return z, residual, n_iter
+
+
+@contextmanager
+def highest_matmul_precision():
+    """float32 matmuls in full precision within the context"""
+    precision = torch.get_float32_matmul_precision()
+    torch.set_float32_matmul_precision("highest")
+    try:
+        yield
+    finally:
+        torch.set_float32_matmul_precision(precision)
+
+
+def fixed_point(
+    model,
+    ff_input=None,
+    state=None,
+    step=0,
+    method="newton",
+    tol=1e-5,
+    max_iter=None,
+    m=5,
+    beta=1.0,
+    n_krylov=20,
+    verbose=0,
+):
+    """
+    Finds steady states of model directly, as fixed points of its time step
+    (update_dynamics with a constant ff input), batched over N_BATCH.
+    The Jacobian goes through the transfer function, STP and the synaptic dynamics
+    as they are, so the fixed points are the ones time stepping converges to (if stable).
+    args:
+    :param ff_input: float (N_BATCH, N_NEURON), constant ff input, mean_ff_input(model, step) if None.
+    :param state: dict, initial guess (model.state, snapshot.load_snapshot, ...),
+                  random rec_input as in forward if None.
+    :param step: int, step of the returned state, forward(state=state) continues from it.
+    :param method: 'newton' (Newton-Krylov) or 'anderson' (Anderson acceleration, cheaper
+                   iterations but slow when the time step is small compared to the time constants).
+    :param tol: float, tolerance on max |step(z) - z| of each trial
+                (not reachable in half precision, about the limit of FLOAT_PRECISION 32).
+    :param max_iter: int, 1000 for 'anderson', 50 for 'newton' if None.
+    :param m: int, history of Anderson acceleration.
+    :param beta: float, mixing of Anderson acceleration.
+    :param n_krylov: int, GMRES iterations per Newton step.
+    returns:
+    state: dict with rates, rec_input, stp u and x (and the live ff input), see snapshot.get_state
+    info: dict with converged (N_BATCH,) bool, residual (N_BATCH,) and n_iter
+    """
+
+    if method not in ("anderson", "newton"):
+        raise ValueError("method should be 'anderson' or 'newton', got %s" % method)
+
+    # tol is below the error of float32 matmuls in bfloat16 ('medium', see FLOAT_PRECISION 32)
+    with torch.no_grad(), highest_matmul_precision():
+        if ff_input is None:
+            ff_input = mean_ff_input(model, step)
+
+        Wab_T, W_stp_T = model.init_dynamics()
+        update_dynamics = get_step(model)
+
+        if state is None:
+            rec_input = torch.randn(
+                (model.IF_NMDA + 1, model.N_BATCH, model.N_NEURON), device=model.device
+            )
+            rates = Activation()(
+                ff_input + rec_input[0], func_name=model.TF_TYPE, thresh=model.thresh
+            )
+        else:
+            rates, rec_input = state["rates"], state["rec_input"]
+            if model.IF_STP:
+                model.stp.u_stp, model.stp.x_stp = state["u_stp"], state["x_stp"]
+
+        def func(z):
+            rates, rec_input = unpack(model, z)
+            rates, rec_input = update_dynamics(
+                rates, ff_input, rec_input.clone(), Wab_T, W_stp_T
+            )
+            return pack(model, rates, rec_input)
+
+        z = pack(model, rates, rec_input)
+
+        if method == "anderson":
+            z, residual, n_iter = anderson(
+                func, z, tol, max_iter or 1000, m=m, beta=beta, verbose=verbose
+            )
+        else:
+            z, residual, n_iter = newton_krylov(
+                func, z, tol, max_iter or 50, n_krylov=n_krylov, verbose=verbose
+            )
+
+        rates, rec_input = unpack(model, z)
+
+    state = {"step": step, "rates": rates, "rec_input": rec_input.clone()}
+
+    if model.LIVE_FF_UPDATE:
+        state["ff_input"] = ff_input.clone()
+
+    if model.IF_STP:
+        state["u_stp"] = model.stp.u_stp.clone()
+        state["x_stp"] = model.stp.x_stp.clone()
+
+    info = {"converged": residual < tol, "residual": residual, "n_iter": n_iter}
+
+    return state, info
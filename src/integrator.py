@@ -0,0 +1,283 @@
+import torch
+
+from src.activation import get_activation
+from src.engine import get_recurrent, get_matmul, get_presynaptic, route_nmda
+from src.ff_input import get_stimuli, mean_ff_input
+from src.utils import print_activity
+
+# Bogacki-Shampine 3(2) tableau, the 4th stage is the derivative at the new point (FSAL)
+BS_A = [[1.0 / 2.0], [0.0, 3.0 / 4.0], [2.0 / 9.0, 1.0 / 3.0, 4.0 / 9.0]]
+BS_E = [-5.0 / 72.0, 1.0 / 12.0, 1.0 / 9.0, -1.0 / 8.0]
+
+
+def axpy(y, h, coefs, ks):
+    """returns y + h * sum(c * k) over coefs and ks, for dicts of tensors (y None is 0)"""
+    out = {}
+    for name in ks[0]:
+        acc = 0 if y is None else y[name]
+        for c, k in zip(coefs, ks):
+            if c != 0.0:
+                acc = acc + (h * c) * k[name]
+        out[name] = acc
+    return out
+
+
+def get_breaks(model, start):
+    """returns the steps from start to N_STEPS where the ff input changes (stimuli on and off)"""
+    steps = {start, model.N_STEPS}
+    for step in list(model.N_STIM_ON) + list(model.N_STIM_OFF):
+        if start < step < model.N_STEPS:
+            steps.add(int(step))
+    return sorted(steps)
+
+
+class Derivatives:
+    """
+    Class: Derivatives
+    Right hand side of the rate dynamics in continuous time, the limit DT -> 0 of
+    Network.update_dynamics: rates (RATE_DYN), AMPA (SYN_DYN) and NMDA currents
+    and STP variables are state variables, the others are instantaneous.
+    Parameters:
+        model: Network
+        Wab_T, W_stp_T: weights of Network.init_dynamics
+    """
+
+    def __init__(self, model, Wab_T, W_stp_T):
+        self.model = model
+        self.Wab_T, self.W_stp_T = Wab_T, W_stp_T
+
+        self.recurrent = get_recurrent(model)
+        self.matmul = get_matmul(model)
+        self.presynaptic = get_presynaptic(model)
+        self.non_linear = get_activation(model.TF_TYPE, thresh=0)
+        self.s0 = slice(int(model.slices[0].start), int(model.slices[0].stop))
+
+        # rates 1 / tau of each variable
+        DT = model.DT
+        self.RATE_TAU = model.DT_TAU / DT
+        self.RATE_TAU_SYN = model.DT_TAU_SYN / DT
+
+        if model.IF_NMDA:
+            self.RATE_TAU_NMDA = model.DT_TAU_NMDA / DT
+
+        if model.IF_STP:
+            stp = model.stp
+            if stp.stp_type == "mato":
+                raise ValueError("the adaptive integrator does not support STP_TYPE 'mato'")
+
+            self.RATE_TAU_REC = stp.DT_TAU_REC / DT
+            self.RATE_TAU_FAC = stp.DT_TAU_FAC / DT
+
+    def init_state(self, rates, rec_input):
+        """returns the state variables as a dict"""
+        model = self.model
+
+        y = {}
+        if model.RATE_DYN:
+            y["rates"] = rates
+        if model.SYN_DYN:
+            y["syn"] = rec_input[0]
+        if model.IF_NMDA:
+            y["nmda"] = rec_input[1]
+        if model.IF_STP:
+            y["u_stp"] = model.stp.u_stp
+            y["x_stp"] = model.stp.x_stp
+
+        return y
+
+    def get_rates(self, y, ff_input):
+        """returns the rates, instantaneous without RATE_DYN"""
+        if self.model.RATE_DYN:
+            return y["rates"]
+
+        rec_nmda = y["nmda"] if self.model.IF_NMDA else 0
+        return self.non_linear(ff_input + y["syn"] + rec_nmda)
+
+    def __call__(self, y, ff_input):
+        """returns dy/dt and the instantaneous variables (rates, AMPA input)"""
+        model, s0 = self.model, self.s0
+
+        rec_nmda = y["nmda"] if model.IF_NMDA else 0
+        rates = self.get_rates(y, ff_input)
+
+        hidden_E = None
+        if self.presynaptic is not None:
+            hidden, hidden_E = self.presynaptic(rates, self.Wab_T)
+        else:
+            hidden = self.recurrent(rates, self.Wab_T)
+
+        if model.lr_UV is not None and not model.IF_STP:
+            U, V = model.lr_UV
+            hidden = hidden + (rates @ V) @ U.T
+
+        dy = {}
+        if model.IF_STP:
+            stp = model.stp
+            u, x, rates_E = y["u_stp"], y["x_stp"], rates[:, s0]
+
+            if stp.stp_type == "hansel":
+                Aux = u * x
+                dy["x_stp"] = -(x - 1.0) * self.RATE_TAU_REC - x * u * rates_E
+                dy["u_stp"] = -(u - stp.USE) * self.RATE_TAU_FAC + stp.USE * (1.0 - u) * rates_E
+            else:
+                u_plus = u + stp.USE * (1.0 - u)
+                Aux = u_plus * x * rates_E
+                dy["x_stp"] = (1.0 - x) * self.RATE_TAU_REC - u_plus * x * rates_E
+                dy["u_stp"] = -u * self.RATE_TAU_FAC + stp.USE * (1.0 - u) * rates_E
+
+            hidden_stp = self.matmul(model.J_STP * Aux, self.W_stp_T)
+            if model.lr_UV is not None:
+                U, V = model.lr_UV
+                hidden_stp = hidden_stp + (model.J_STP * Aux @ V) @ U.T
+
+            hidden = hidden.clone()
+            hidden[:, s0] = hidden[:, s0] + hidden_stp
+
+        if model.IF_BATCH_J:
+            hidden = hidden.clone()
+            hidden[:, s0] = hidden[:, s0] + self.matmul(model.Jab_batch * rates[:, s0], model.W_batch_T)
+
+        if model.SYN_DYN:
+            syn = y["syn"]
+            dy["syn"] = (hidden - syn) * self.RATE_TAU_SYN
+        else:
+            syn = hidden
+
+        if model.IF_NMDA:
+            if hidden_E is not None:
+                hidden = route_nmda(hidden_E, hidden_stp if model.IF_STP else None, model.N_NEURON)
+            else:
+                hidden = self.matmul(rates[:, s0], self.Wab_T[s0])
+
+                if model.Jab_scale is not None:
+                    hidden = hidden * model.Jab_scale[0]
+
+                if model.IF_STP:
+                    hidden = hidden.clone()
+                    hidden[:, s0] = hidden[:, s0] + hidden_stp
+
+            if model.lr_UV is not None and not model.IF_STP:
+                U, V = model.lr_UV
+                hidden = hidden + (rates[:, s0] @ V[s0]) @ U.T
+
+            dy["nmda"] = (model.R_NMDA * hidden - y["nmda"]) * self.RATE_TAU_NMDA
+
+        if model.RATE_DYN:
+            dy["rates"] = (self.non_linear(ff_input + syn + rec_nmda) - rates) * self.RATE_TAU
+
+        return dy, rates, syn
+
+
+def error_norm(err, y0, y1, RTOL, ATOL):
+    """returns the max over trials of the rms scaled error"""
+    total, size = 0, 0
+    for name in err:
+        scale = ATOL + RTOL * torch.maximum(y0[name].abs(), y1[name].abs())
+        total = total + ((err[name] / scale) ** 2).sum(-1)
+        size += err[name].shape[-1]
+    return torch.sqrt(total / size).max()
+
+
+def hermite(y0, y1, f0, f1, h, theta):
+    """cubic Hermite interpolation between y0 and y1 at t0 + theta * h"""
+    h00 = (1.0 + 2.0 * theta) * (1.0 - theta) ** 2
+    h10 = theta * (1.0 - theta) ** 2
+    h01 = theta**2 * (3.0 - 2.0 * theta)
+    h11 = theta**2 * (theta - 1.0)
+
+    return {
+        name: h00 * y0[name] + h10 * h * f0[name] + h01 * y1[name] + h11 * h * f1[name]
+        for name in y0
+    }
+
+
+def integrate(model, recorder, start, rates, rec_input, Wab_T, W_stp_T):
+    """
+    Integrates the dynamics of model from step start to N_STEPS with the embedded
+    Runge-Kutta pair of Bogacki-Shampine (3rd order, error of the 2nd order one),
+    adaptive step size with tolerances RTOL and ATOL, one step size for all trials.
+    The ff input is the noise-free schedule (mean_ff_input), integration stops where
+    it changes. Steps are resampled on the DT grid by cubic Hermite interpolation
+    for the recorder, which records as with time stepping.
+    returns:
+    rates, rec_input at the end of the trial
+    """
+
+    if model.VAR_FF.max() > 0:
+        raise ValueError("the adaptive integrator needs a noise-free ff input (VAR_FF 0)")
+
+    if not (model.RATE_DYN or model.SYN_DYN):
+        raise ValueError("the adaptive integrator needs RATE_DYN or SYN_DYN")
+
+    func = Derivatives(model, Wab_T, W_stp_T)
+    RTOL, ATOL, DT = model.RTOL, model.ATOL, model.DT
+
+    # only the steps used by the records are interpolated
+    first_record = recorder.first_step()
+
+    y = func.init_state(rates, rec_input)
+    stimuli = get_stimuli(model)
+
+    h = DT
+    n_steps = n_rejected = 0
+
+    breaks = get_breaks(model, start)
+    for step_start, step_stop in zip(breaks[:-1], breaks[1:]):
+        ff_input = mean_ff_input(model, step_start, stimuli)
+
+        # time in units of DT, the state at step k of the records is at k + 1
+        t, t_stop = float(step_start), float(step_stop)
+        record = max(step_start, first_record)
+
+        k1, rates, syn = func(y, ff_input)
+
+        while t_stop - t > 1e-9:
+            h = min(h, (t_stop - t) * DT)
+
+            k2, _, _ = func(axpy(y, h, BS_A[0], [k1]), ff_input)
+            k3, _, _ = func(axpy(y, h, BS_A[1], [k1, k2]), ff_input)
+            y_new = axpy(y, h, BS_A[2], [k1, k2, k3])
+            k4, rates_new, syn_new = func(y_new, ff_input)
+
+            err = axpy(None, h, BS_E, [k1, k2, k3, k4])
+            err_norm = error_norm(err, y, y_new, RTOL, ATOL).item()
+
+            if err_norm <= 1.0:
+                t_new = min(t + h / DT, t_stop)
+
+                # records on the DT grid in (t, t_new]
+                while record < step_stop and record + 1 <= t_new + 1e-9:
+                    theta = (record + 1 - t) / (t_new - t)
+                    y_rec = hermite(y, y_new, k1, k4, h, theta)
+                    rates_rec = func.get_rates(y_rec, ff_input)
+
+                    values = {"rates": rates_rec, "ff": ff_input}
+                    if model.IF_STP:
+                        values["u_stp"], values["x_stp"] = y_rec["u_stp"], y_rec["x_stp"]
+
+                    recorder.update(record, **values)
+
+                    if model.VERBOSE:
+                        if record >= model.N_STEADY and record % model.N_WINDOW == 0:
+                            print_activity(model, record, rates_rec)
+
+                    record += 1
+
+                t = t_new
+                y, k1, rates, syn = y_new, k4, rates_new, syn_new
+                n_steps += 1
+            else:
+                n_rejected += 1
+
+            # step size control for a 3rd order method
+            h = h * min(5.0, max(0.2, 0.9 * max(err_norm, 1e-10) ** (-1.0 / 3.0)))
+
+    model.n_steps_adaptive = (n_steps, n_rejected)
+
+    if model.IF_STP:
+        model.stp.u_stp, model.stp.x_stp = y["u_stp"], y["x_stp"]
+
+    # rec_input as in the time steps: AMPA and NMDA inputs
+    rec_input = [syn] + ([y["nmda"]] if model.IF_NMDA else [])
+
+    return rates, torch.stack(rec_input)
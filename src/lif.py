@@ -6,6 +6,7 @@ from src.connectivity import Connectivity
 from src.activation import Activation
 from src.plasticity import Plasticity
 from src.ff_input import live_ff_input, init_ff_input
+from src.recorder import Recorder
 
 from src.utils import set_seed, clear_cache, print_activity
 from src.lr_utils import initLR
@@ -193,13 +194,33 @@ class LIFNetwork(nn.Module):
         
         return volts, rec_input, spikes
     
-    def forward(self, ff_input=None, REC_LAST_ONLY=0, RET_FF=0, RET_STP=0):
+    def init_recorder(self, REC_LAST_ONLY=0, RET_FF=0, RET_STP=0):
+        """returns the default Recorder: rates, volts, spikes, ff input and stp variables"""
+
+        variables = {}
+        if not REC_LAST_ONLY:
+            variables["rates"] = dict()
+            variables["volts"] = dict()
+            variables["spikes"] = dict(mean=False)
+
+            if self.LIVE_FF_UPDATE and RET_FF:
+                variables["ff"] = dict()
+
+            if self.IF_STP and RET_STP:
+                variables["x_stp"] = dict(mean=False)
+                variables["u_stp"] = dict(mean=False)
+
+        return Recorder(**variables)
+
+    def forward(self, ff_input=None, REC_LAST_ONLY=0, RET_FF=0, RET_STP=0, recorder=None):
         '''
         Main method of Network class, runs networks dynamics over set of timesteps
         and returns rates at each time point or just the last time point.
         args:
         :param ff_input: float (N_BATCH, N_STEP, N_NEURONS), ff inputs into the network.
         :param REC_LAST_ONLY: bool, wether to record the last timestep only.
+        :param recorder: Recorder, variables to record ('rates', 'volts', 'spikes', 'ff', 'x_stp', 'u_stp').
+                         If None, it is built from REC_LAST_ONLY, RET_FF and RET_STP.
         rates_list:
         :param rates_list: float (N_BATCH, N_STEP or 1, N_NEURONS), rates of the neurons.
         '''
@@ -214,15 +235,15 @@ class LIFNetwork(nn.Module):
         # Add STP
         if self.IF_STP:
             self.initSTP()
-            self.x_list, self.u_list = [], []
     
         if self.IF_BATCH_J or self.IF_STP:
             self.Wab_T[self.slices[0], self.slices[0]] = 0
 
-        # Moving average
-        
-        mv_volts, mv_rates, mv_ff = 0, 0, 0
-        volts_list, rates_list, spikes_list, ff_list = [], [], [], []
+        # Preallocated records
+        if recorder is None:
+            recorder = self.init_recorder(REC_LAST_ONLY, RET_FF, RET_STP)
+
+        recorder.init(self)
         
         # Temporal loop
         for step in range(self.N_STEPS):
@@ -234,64 +255,44 @@ class LIFNetwork(nn.Module):
             else:
                 volts, rec_input, spikes = self.update_dynamics(volts, ff_input[:, step], rec_input, spikes)
                 
-            # update moving average
-            mv_rates += spikes
-            mv_volts += volts
-            
-            if self.LIVE_FF_UPDATE and RET_FF:
-                mv_ff += ff_input + noise
-            
-            # Reset moving average to start at 0
-            if step == self.N_STEADY-self.N_WINDOW-1:
-                mv_volts = 0.0
-                mv_rates = 0.0
-                mv_ff = 0.0
-
-            # update output every N_WINDOW steps
-            if step >= self.N_STEADY:
-                if step % self.N_WINDOW == 0:
-
-                    spikes_list.append(spikes)
-                    
-                    if self.VERBOSE:
-                        print_activity(self, step, mv_rates)
-                        
-                    if not REC_LAST_ONLY:
-                        rates_list.append(mv_rates / self.N_WINDOW)
-                        volts_list.append(mv_volts / self.N_WINDOW)
-                        
-                        if self.LIVE_FF_UPDATE and RET_FF:
-                            ff_list.append(mv_ff / self.N_WINDOW)
-                        if self.IF_STP and RET_STP:
-                            self.x_list.append(self.stp.x_stp)
-                            self.u_list.append(self.stp.u_stp)
-
-                    # Reset moving average
-                    mv_volts, mv_rates, mv_ff = 0, 0, 0
+            # update moving averages and records
+            values = {"rates": spikes, "volts": volts, "spikes": spikes}
+            if "ff" in recorder:
+                if self.LIVE_FF_UPDATE:
+                    values["ff"] = ff_input + noise
+                else:
+                    values["ff"] = ff_input[:, step]
+            if self.IF_STP:
+                values["x_stp"] = self.stp.x_stp
+                values["u_stp"] = self.stp.u_stp
 
-        # returns last step
-        rates = mv_rates
-        volts = mv_volts
-        
-        # returns full sequence
-        if REC_LAST_ONLY==0:
-            # Stack list on 1st dim so that output is (N_BATCH, N_STEPS, N_NEURON)
-            rates = torch.stack(rates_list, dim=1)
-            del rates_list
+            recorder.update(step, **values)
 
-            volts = torch.stack(volts_list, dim=1)
-            del volts_list
+            if self.VERBOSE:
+                if step >= self.N_STEADY and step % self.N_WINDOW == 0:
+                    print_activity(self, step, spikes)
+
+        # wait for the records to be written
+        recorder.close()
 
-            spikes = torch.stack(spikes_list, dim=1)
-            del spikes_list
+        # returns last step
+        rates = spikes
+        
+        # returns full sequence, output is (N_BATCH, N_STEPS, N_NEURON)
+        if "rates" in recorder:
+            rates = recorder["rates"]
+        if "volts" in recorder:
+            volts = recorder["volts"]
+        if "spikes" in recorder:
+            spikes = recorder["spikes"]
             
-            if self.LIVE_FF_UPDATE and RET_FF:  # returns ff input
-                self.ff_input = torch.stack(ff_list, dim=1)
-                del ff_list
+        if "ff" in recorder:  # returns ff input
+            self.ff_input = recorder["ff"]
 
-            if self.IF_STP and RET_STP:  # returns stp u and x
-                self.u_list = torch.stack(self.u_list, dim=1)
-                self.x_list = torch.stack(self.x_list, dim=1)
+        if "u_stp" in recorder:  # returns stp u and x
+            self.u_list = recorder["u_stp"]
+        if "x_stp" in recorder:
+            self.x_list = recorder["x_stp"]
         
         # Add Linear readout (N_BATCH, N_EVAL_WIN, 1) on last few steps
         if self.LR_TRAIN:
@@ -11,8 +11,10 @@ from time import perf_counter
 from src.connectivity import Connectivity
 from src.activation import Activation
 from src.stimuli import Stimuli
+from src.sparse import event_mm
 from src.plasticity import Plasticity
-from src.utils import set_seed, clear_cache
+from src.profiler import NullProfiler, get_profiler
+from src.utils import set_seed
 
 import warnings
 warnings.filterwarnings("ignore")
@@ -45,6 +47,10 @@ class LIFNetwork(nn.Module):
         # Set seed for the connectivity/input vectors
         set_seed(self.SEED)
         
+        # timers of the phases of forward (PROFILE), stats in self.profile after forward
+        self.profiler = NullProfiler()
+        self.profile = None
+        
         # Rescale some parameters (time steps, time constants, ...)
         self.initConst()
         
@@ -113,7 +119,12 @@ class LIFNetwork(nn.Module):
         '''LIF Dynamics'''
         
         # update hidden state
-        hidden = spikes @ self.Wab_T
+        with self.profiler.phase("recurrent"):
+            if self.IF_EVENT:
+                # only the rows of the neurons that spiked
+                hidden = event_mm(spikes, self.Wab_T)
+            else:
+                hidden = spikes @ self.Wab_T
         
         # update recurrent input
         if self.SYN_DYN:
@@ -124,13 +135,14 @@ class LIFNetwork(nn.Module):
         # update net input
         net_input = ff_input + rec_input
 
-        # Update membrane voltage
-        volt = volt * self.EXP_DT_TAU + self.DT_TAU * net_input
-        
-        # Update spikes
-        spikes = volt>=self.V_THRESH
-        volt[spikes] = self.V_REST
-        spikes = spikes * 1.0
+        with self.profiler.phase("spikes"):
+            # Update membrane voltage
+            volt = volt * self.EXP_DT_TAU + self.DT_TAU * net_input
+            
+            # Update spikes
+            spikes = volt>=self.V_THRESH
+            volt[spikes] = self.V_REST
+            spikes = spikes * 1.0
         
         return volt, rec_input, spikes
     
@@ -143,13 +155,18 @@ class LIFNetwork(nn.Module):
         :param REC_LAST_ONLY: bool, wether to record the last timestep only.
         output:
         :param output: float (N_BATCH, N_TIME or 1, N_NEURONS), rates of the neurons. 
+        With PROFILE, the times, counters and memory of the phases are in self.profile.
         '''
         
         if self.VERBOSE:
             start = perf_counter()
         
+        # phases timed in this pass, a no-op unless PROFILE
+        self.profiler = get_profiler(self)
+        
         # Initialization (if  ff_input is None, ff_input is generated)
-        volt, ff_input, rec_input, spikes = self.initialization(ff_input)
+        with self.profiler.phase("init_rates"):
+            volt, ff_input, rec_input, spikes = self.initialization(ff_input)
         
         # Moving average of the rates
         mv_rates = 0
@@ -159,9 +176,11 @@ class LIFNetwork(nn.Module):
         for step in range(self.N_STEPS):
             # update dynamics
             volt, rec_input, spikes = self.update_dynamics(volt, ff_input[:, step], rec_input, spikes)
+            self.profiler.count("steps")
             
             # update moving average
-            mv_rates += spikes
+            with self.profiler.phase("record"):
+                mv_rates += spikes
             
             # Reset moving average to start at 0
             if step == self.N_STEADY-self.N_WINDOW-1:
@@ -184,6 +203,9 @@ class LIFNetwork(nn.Module):
             # Stack output list to 1st dim so that output is (N_BATCH, N_STEPS, N_NEURON)
             output = torch.stack(output, dim=1)
         
+        self.profile = self.profiler.stats()
+        self.profiler = NullProfiler()
+        
         # Add Linear readout (N_BATCH, N_EVAL_WIN, 1) on last few steps
         if self.LR_TRAIN:
             y_pred = self.linear(output[:, -self.lr_eval_win:, ...])
@@ -196,8 +218,6 @@ class LIFNetwork(nn.Module):
         self.ff_input = ff_input
         del volt, ff_input, rec_input, spikes
         
-        clear_cache()
-        
         if self.VERBOSE:
             end = perf_counter()
             print("Elapsed (with compilation) = {}s".format((end - start)))
@@ -220,6 +240,11 @@ class LIFNetwork(nn.Module):
         # if self.VERBOSE:
         #     print('Loading config from', conf_path)
         param = safe_load(open(conf_path, "r"))
+
+        # event driven spike propagation, off unless set in conf_file or kwargs
+        param.setdefault("IF_EVENT", 0)
+        # phase timers, see profiler.py
+        param.setdefault("PROFILE", 0)
         
         param["FILE_NAME"] = sim_name
         param.update(kwargs)
@@ -101,17 +101,16 @@ class LowRankWeights(nn.Module):
         else:
             self.lr_kappa = torch.tensor(5.0, device=self.device)
 
-        # Mask to train excitatory neurons only
-        self.lr_mask = torch.zeros((self.N_NEURON, self.N_NEURON), device=self.device)
+        # Mask to train excitatory neurons only,
+        # per neuron: the mask of lr is the outer product lr_mask lr_mask.T
+        self.lr_mask = torch.zeros(self.N_NEURON, device=self.device)
 
         if self.LR_MASK == 0:
-            self.lr_mask[self.slices[0], self.slices[0]] = 1.0
+            self.lr_mask[self.slices[0]] = 1.0
         if self.LR_MASK == 1:
-            self.lr_mask[self.slices[1], self.slices[1]] = 1.0
+            self.lr_mask[self.slices[1]] = 1.0
         if self.LR_MASK == -1:
-            self.lr_mask = torch.ones(
-                (self.N_NEURON, self.N_NEURON), device=self.device
-            )
+            self.lr_mask = torch.ones(self.N_NEURON, device=self.device)
 
         # Linear readout for supervised learning
         if self.LR_READOUT:
@@ -143,7 +142,7 @@ class LowRankWeights(nn.Module):
             else:
                 self.lr = self.lr_kappa * (self.U @ self.U.T)
 
-        self.lr = self.lr_mask * self.lr
+        self.lr = torch.outer(self.lr_mask, self.lr_mask) * self.lr
 
         self.lr = normalize_tensor(self.lr, 0, self.slices, self.Na)
         self.lr = normalize_tensor(self.lr, 1, self.slices, self.Na)
@@ -153,6 +152,31 @@ class LowRankWeights(nn.Module):
 
         return self.lr
 
+    def factors(self, LR_NORM=0):
+        """
+        returns U (N_NEURON, RANK) and V (N_NEURON, RANK) such that forward(LR_NORM) = U @ V.T
+        (without LR_CLAMP, which is elementwise). lr_kappa and lr_mask go into U and V,
+        the 1 / Na normalization of presynaptic populations into V.
+        """
+
+        if LR_NORM:
+            U, V = masked_normalize(self.U), masked_normalize(self.V)
+        elif self.LR_MN:
+            U, V = self.U, self.V
+        else:
+            U, V = self.U, self.U
+
+        # as in forward, only the first two populations are normalized
+        norm = torch.ones(self.N_NEURON, device=self.device)
+        for i_pop in range(2):
+            norm[self.slices[i_pop]] = 1.0 / self.Na[i_pop]
+
+        U = self.lr_kappa * U * self.lr_mask.unsqueeze(-1)
+        V = V * (self.lr_mask * norm).unsqueeze(-1)
+
+        return U, V
+
+
 def get_theta(a, b, IF_NORM=0):
     u, v = a, b
 
@@ -0,0 +1,131 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+import torch
+
+
+def get_rng_state(device):
+    """returns the state of the generator used to sample the weights on device"""
+    if device.type == "cuda":
+        return torch.cuda.get_rng_state(device)
+    return torch.get_rng_state()
+
+
+def set_rng_state(state, device):
+    if device.type == "cuda":
+        torch.cuda.set_rng_state(state, device)
+    else:
+        torch.set_rng_state(state)
+
+
+def weights_hash(model):
+    """
+    returns a hash of everything Wab_T depends on: sizes, Jab, connectivity
+    parameters, precision and the state of the random generator before sampling
+    (which holds SEED and the draws made by init_const).
+    """
+
+    sha = hashlib.sha1()
+
+    parameters = {}
+    for key in [
+        "N_NEURON",
+        "N_POP",
+        "Na",
+        "Ka",
+        "Jab",
+        "CON_TYPE",
+        "PROBA_TYPE",
+        "KAPPA",
+        "SIGMA",
+        "PHASE",
+        "PHI0",
+        "LR_MEAN",
+        "LR_COV",
+        "SPARSE",
+        "FIXED_K",
+        "FLOAT_PRECISION",
+        "SEED",
+    ]:
+        value = getattr(model, key, None)
+
+        # tensors (PHI0 can be (4, Na[0])) are hashed by value
+        if torch.is_tensor(value):
+            # numpy has no bfloat16, FLOAT_PRECISION is in the hash
+            if value.dtype == torch.bfloat16:
+                value = value.float()
+            value = value.detach().cpu().numpy()
+        if isinstance(value, np.ndarray):
+            if value.dtype.kind in "fiub":
+                sha.update(np.ascontiguousarray(value).tobytes())
+                value = [str(value.dtype), list(value.shape)]
+            else:
+                value = value.tolist()
+
+        parameters[key] = value
+
+    sha.update(json.dumps(parameters, sort_keys=True, default=str).encode())
+    sha.update(get_rng_state(model.device).cpu().numpy().tobytes())
+
+    return sha.hexdigest()[:16]
+
+
+def to_numpy(tensor):
+    return tensor.detach().cpu().numpy()
+
+
+def from_npy(path, device):
+    # copy on write: pages are read lazily and in place updates stay in memory
+    array = np.load(path, mmap_mode="c")
+    return torch.from_numpy(array).to(device)
+
+
+def save_weights(path, rng_state, Wab=None, csr=None):
+    """
+    saves the dense weights Wab (N_NEURON, N_NEURON) or the components of a CSR
+    matrix in the directory path, with the state of the generator after sampling
+    """
+
+    tmp = path + ".tmp%d" % os.getpid()
+    if not os.path.exists(tmp):
+        os.makedirs(tmp)
+
+    if csr is not None:
+        np.save(os.path.join(tmp, "crow.npy"), to_numpy(csr.crow_indices()))
+        np.save(os.path.join(tmp, "col.npy"), to_numpy(csr.col_indices()))
+        np.save(os.path.join(tmp, "values.npy"), to_numpy(csr.values()))
+    else:
+        np.save(os.path.join(tmp, "Wab.npy"), to_numpy(Wab))
+
+    torch.save(rng_state, os.path.join(tmp, "rng.pt"))
+
+    # a directory that exists is complete
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        # saved meanwhile by another process
+        shutil.rmtree(tmp)
+
+
+def load_weights(path, device):
+    """
+    returns the weights saved in path, a dense tensor or a CSR matrix, memory
+    mapped on cpu, and restores the state of the generator after sampling
+    """
+
+    if os.path.exists(os.path.join(path, "Wab.npy")):
+        weights = from_npy(os.path.join(path, "Wab.npy"), device)
+    else:
+        crow = from_npy(os.path.join(path, "crow.npy"), device)
+        col = from_npy(os.path.join(path, "col.npy"), device)
+        values = from_npy(os.path.join(path, "values.npy"), device)
+
+        size = (crow.shape[0] - 1, crow.shape[0] - 1)
+        weights = torch.sparse_csr_tensor(crow, col, values, size=size, device=device)
+
+    set_rng_state(torch.load(os.path.join(path, "rng.pt")), device)
+
+    return weights
@@ -1,22 +1,92 @@
+import os
+
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 from torch.sparse import to_sparse_semi_structured, SparseSemiStructuredTensor
 
 SparseSemiStructuredTensor._FORCE_CUTLASS = True
 
 from src.configuration import Configuration
 from src.connectivity import Connectivity
+from src.sparse import SparseMatrix, cat_blocks, split_block
 from src.activation import Activation
 from src.plasticity import Plasticity
 from src.lr_utils import LowRankWeights, clamp_tensor
-
-from src.ff_input import live_ff_input, init_ff_input, rl_ff_udpdate
-from src.utils import set_seed, clear_cache, print_activity
+from src.engine import get_step, get_recurrent, get_matmul, get_presynaptic, route_nmda
+from src.recorder import Recorder
+from src.sweep import set_sweep
+from src.operators import low_rank_operator, circulant_operator, binary_operator
+from src.matrix_cache import weights_hash, save_weights, load_weights, get_rng_state
+from src.snapshot import (
+    get_rng,
+    set_rng,
+    get_state,
+    save_snapshot,
+    load_snapshot,
+    warm_path,
+    warm_step,
+    TRIAL_KEYS,
+)
+
+from src.fixed_point import fixed_point
+from src.integrator import integrate
+from src.ff_input import live_ff_input, init_ff_input, rl_ff_udpdate, FFStream, StimulusTimeline
+from src.noise import get_noise, INIT_NOISE
+from src.profiler import NullProfiler, get_profiler
+from src.workspace import Workspace
+from src.utils import set_seed, print_activity
 
 import warnings
 
 warnings.filterwarnings("ignore")
 
+# parameters Wab_T, W_stp_T and PHI0 depend on, sampled again by with_overrides if overridden
+WEIGHTS_PARAMS = [
+    "N_NEURON",
+    "N_POP",
+    "frac",
+    "K",
+    "Jab",
+    "GAIN",
+    "CON_TYPE",
+    "PROBA_TYPE",
+    "KAPPA",
+    "SIGMA",
+    "PHASE",
+    "PHI0",
+    "LR_MEAN",
+    "LR_COV",
+    "TASK",
+    "SPARSE",
+    "FIXED_K",
+    "OPERATOR",
+    "IF_STP",
+    "IF_BATCH_J",
+    "FLOAT_PRECISION",
+    "WEIGHT_PRECISION",
+    "DEVICE",
+    "SEED",
+]
+
+# parameters of the trained low rank weights (LowRankWeights), shared by with_overrides otherwise
+LR_PARAMS = [
+    "N_NEURON",
+    "frac",
+    "LR_TRAIN",
+    "RANK",
+    "LR_MN",
+    "LR_KAPPA",
+    "LR_BIAS",
+    "LR_READOUT",
+    "LR_FIX_READ",
+    "DROP_RATE",
+    "LR_MASK",
+    "LR_CLASS",
+    "FLOAT_PRECISION",
+    "DEVICE",
+]
+
 
 class Network(nn.Module):
     """
@@ -28,22 +98,62 @@ class Network(nn.Module):
         repo_root: str, root path of the NeuroFlame repository.
         **kwargs: **dict, any parameter in conf_file can be passed here
                              and will then be overwritten.
+        parent: Network, network whose weights and constants are shared when
+                kwargs do not change them, see with_overrides.
     Returns:
            rates: tensorfloat of size (N_BATCH, N_STEPS or 1, N_NEURON).
     """
 
-    def __init__(self, conf_name, repo_root, **kwargs):
+    def __init__(self, conf_name, repo_root, parent=None, **kwargs):
         super().__init__()
 
         # Load parameters from configuration file and create networks constants
         config = Configuration(conf_name, repo_root)(**kwargs)
         self.__dict__.update(config.__dict__)
 
-        # Initialize weight matrix
-        self.initWeights()
+        # arguments of the network, see with_overrides
+        self.conf_name, self.repo_root, self.kwargs = conf_name, repo_root, kwargs
+
+        share_weights = parent is not None and parent.shares_weights(kwargs)
+        if parent is not None:
+            self.share_constants(parent, config)
+
+        # connectivity cache, see matrix_cache.py
+        self.MAT_PATH = repo_root + "/data/matrix/"
+
+        # warm start snapshots, see snapshot.py
+        self.SNAP_PATH = repo_root + "/data/snapshot/"
+
+        if share_weights:
+            self.PHI0, self.weights_key = parent.PHI0, parent.weights_key
+            self.share(parent, "Wab_T")
+        else:
+            # identifies the weights, even with SEED 0
+            self.weights_key = weights_hash(self)
+
+            # Initialize weight matrix
+            self.initWeights()
+
+        # Jab blocks batched along N_BATCH, see sweep.py
+        self.Jab_scale = None
+
+        # factors (U, V) of the trained low rank term, set in forward
+        self.lr_UV = None
+
+        # products with the weights, in WEIGHT_PRECISION, set in forward (see engine.py)
+        self.recurrent, self.matmul, self.presynaptic = None, None, None
+
+        # timers of the phases of forward (PROFILE), stats in self.profile after forward
+        self.profiler = NullProfiler()
+        self.profile = None
+
+        # buffers of the time steps without autograd, see workspace.py
+        self.workspace = Workspace(self.device)
 
         # Initialize low rank connectivity for training
-        if self.LR_TRAIN:
+        if self.LR_TRAIN and parent is not None and parent.shares_low_rank(kwargs):
+            self.odors, self.low_rank = parent.odors, parent.low_rank
+        elif self.LR_TRAIN:
             self.odors = torch.randn(
                 (10, self.Na[0]),
                 device=self.device,
@@ -67,11 +177,69 @@ class Network(nn.Module):
 
         # Add STP
         if self.IF_STP:
-            self.initSTP()
+            self.initSTP(parent.W_stp_T if share_weights else None)
+
+        # batched EtoE block, moved out of Wab_T once like W_stp_T (init_dynamics runs at every pass)
+        if self.IF_BATCH_J:
+            self.W_batch_T = parent.W_batch_T if share_weights else self.split_EtoE()
 
         # Reset the seed
         set_seed(0)
-        clear_cache()
+
+    def with_overrides(self, **overrides):
+        """
+        returns a Network with the parameters of this one and overrides, without
+        parsing the config files again (see configuration.load_yaml).
+        The weights Wab_T, W_stp_T, W_batch_T and PHI0 are shared unless overrides change a
+        parameter of WEIGHTS_PARAMS, the trained low rank weights unless they change
+        one of LR_PARAMS, and constants that overrides do not change are shared.
+        Sweeps (Network.sweep) are not copied. With shared weights, the random draws
+        made after the weights (odors, low rank init) differ from Network(...).
+        """
+        kwargs = dict(self.kwargs, **overrides)
+        return type(self)(self.conf_name, self.repo_root, parent=self, **kwargs)
+
+    def changed(self, kwargs, params):
+        """returns True if kwargs give one of params a value different from the kwargs of this network"""
+        for key in params:
+            new, old = kwargs.get(key, None), self.kwargs.get(key, None)
+            try:
+                same = bool(new == old)
+            except (RuntimeError, ValueError):
+                # tensors and arrays
+                same = new is old
+
+            if not same:
+                return True
+
+        return False
+
+    def shares_weights(self, kwargs):
+        """returns True if a network with kwargs has the weights of this one (with W_stp_T and W_batch_T)"""
+        return not self.changed(kwargs, WEIGHTS_PARAMS)
+
+    def shares_low_rank(self, kwargs):
+        return self.LR_TRAIN and not self.changed(kwargs, LR_PARAMS)
+
+    def share(self, parent, name):
+        """uses the tensor name of parent, as a buffer if it is one"""
+        if name in parent._buffers:
+            self.register_buffer(name, parent._buffers[name])
+        else:
+            setattr(self, name, getattr(parent, name))
+
+    def share_constants(self, parent, config):
+        """replaces the constants of config equal to the ones of parent by the tensors of parent"""
+        for key, value in config.__dict__.items():
+            other = parent.__dict__.get(key)
+            if torch.is_tensor(value) and torch.is_tensor(other):
+                if (
+                    value.shape == other.shape
+                    and value.dtype == other.dtype
+                    and value.device == other.device
+                    and torch.equal(value, other)
+                ):
+                    setattr(self, key, other)
 
     def initWeights(self):
         """
@@ -80,9 +248,74 @@ class Network(nn.Module):
         Relies on class Connectivity from connetivity.py
         """
 
+        half = self.WEIGHT_FLOAT in (torch.float16, torch.bfloat16)
+        if self.SPARSE == "full" and half and self.device.type == "cpu":
+            raise ValueError("SPARSE 'full' needs WEIGHT_PRECISION 32 or 64 on cpu (no half sparse products)")
+
+        # all2all blocks kept as mean + low rank factors
+        if self.OPERATOR == "lr":
+            self.Wab_T = low_rank_operator(self)
+            return
+
+        # all2all ring blocks kept as one kernel row, applied by FFT
+        if self.OPERATOR == "fft":
+            self.Wab_T = circulant_operator(self)
+            return
+
+        # sparse blocks kept as Jab and their adjacency packed in bits
+        if self.OPERATOR == "bits":
+            self.Wab_T = binary_operator(self)
+            return
+
+        # sparse nets are sampled directly in CSR format
+        if self.SPARSE == "full" and "sparse" in self.CON_TYPE:
+            return self.initSparseWeights()
+
         # # Scale synaptic weights as 1/sqrt(K) for sparse nets
         # self.scaleWeights()
 
+        cache_path = self.getCachePath()
+
+        if cache_path is not None and os.path.exists(cache_path):
+            self.register_buffer("Wab_T", load_weights(cache_path, self.device))
+        else:
+            self.sampleWeights()
+
+            if cache_path is not None:
+                save_weights(cache_path, get_rng_state(self.device), Wab=self.Wab_T)
+
+        # weights are sampled (and cached) in FLOAT_PRECISION, stored in WEIGHT_PRECISION
+        if self.WEIGHT_FLOAT != self.FLOAT:
+            self.Wab_T = self.Wab_T.to(self.WEIGHT_FLOAT)
+
+        if self.SPARSE == "full":
+            self.Wab_T = self.Wab_T.T.to_sparse()
+        elif self.SPARSE == "semi":
+            self.Wab_T = to_sparse_semi_structured(self.Wab_T)
+        else:
+            # take weights transpose for optim
+            self.Wab_T = self.Wab_T.T
+
+        if self.LR_TRAIN==0:
+            self.Wab_T = self.Wab_T
+
+    def getCachePath(self):
+        """
+        returns the directory of the cached weights in MAT_PATH, or None if
+        CACHE_WEIGHTS is off or the weights can not be reproduced (SEED 0 uses the clock)
+        """
+
+        if not self.CACHE_WEIGHTS or self.SEED == 0 or self.FLOAT == torch.bfloat16:
+            return None
+
+        if not os.path.exists(self.MAT_PATH):
+            os.makedirs(self.MAT_PATH)
+
+        return os.path.join(self.MAT_PATH, weights_hash(self))
+
+    def sampleWeights(self):
+        """Samples the dense matrix Wab (not yet transposed) block by block"""
+
         # in pytorch, Wij is i to j.
         self.register_buffer('Wab_T', torch.zeros((self.N_NEURON, self.N_NEURON), device=self.device))
         # self.Wab_T = torch.zeros((self.N_NEURON, self.N_NEURON), device=self.device)
@@ -111,34 +344,94 @@ class Network(nn.Module):
 
         del weights, weight_mat
 
-        if self.SPARSE == "full":
-            self.Wab_T = self.Wab_T.T.to_sparse()
-        elif self.SPARSE == "semi":
-            self.Wab_T = to_sparse_semi_structured(self.Wab_T)
+    def initSparseWeights(self):
+        """
+        Initializes the connectivity matrix self.Wab as a sparse CSR matrix.
+        Blocks are sampled row by row so that memory and time scale as O(N * K).
+        Relies on class SparseMatrix from sparse.py
+        """
+
+        cache_path = self.getCachePath()
+
+        if cache_path is not None and os.path.exists(cache_path):
+            Wab = load_weights(cache_path, self.device)
         else:
-            # take weights transpose for optim
-            self.Wab_T = self.Wab_T.T
+            Wab = self.sampleSparseWeights()
 
-        if self.LR_TRAIN==0:
-            self.Wab_T = self.Wab_T
+            if cache_path is not None:
+                save_weights(cache_path, get_rng_state(self.device), csr=Wab)
+
+        # the transpose of a CSR matrix is CSC, which is fast for rates @ Wab_T
+        self.register_buffer("Wab_T", Wab.t().to(self.WEIGHT_FLOAT))
+
+    def sampleSparseWeights(self):
+        """returns the CSR matrix Wab sampled block by block"""
 
-    def initSTP(self):
-        """Creates stp model for population 0"""
+        blocks = {}
+        for i_pop in range(self.N_POP):
+            for j_pop in range(self.N_POP):
+                weight_mat = SparseMatrix(
+                    self.Na[i_pop], self.Na[j_pop], self.Ka[j_pop], device=self.device
+                )
+
+                weights = weight_mat(
+                    self.PROBA_TYPE[i_pop][j_pop],
+                    fixed_degree=self.FIXED_K,
+                    kappa=self.KAPPA[i_pop][j_pop],
+                    phase=self.PHASE,
+                    ksi=self.PHI0,
+                )
+
+                weights.values().mul_(self.Jab[i_pop][j_pop])
+                blocks[(i_pop, j_pop)] = weights
+
+        del weights, weight_mat
+
+        return cat_blocks(blocks, self.csumNa, self.N_NEURON)
+
+    def initSTP(self, W_stp_T=None):
+        """
+        Creates stp model for population 0, the EtoE block of Wab_T is moved
+        to W_stp_T (unless W_stp_T is given, with weights already split)
+        """
         self.J_STP = torch.tensor(self.J_STP, device=self.device) * (
             self.GAIN / torch.sqrt(self.Ka[0])
         )
 
+        if W_stp_T is None:
+            W_stp_T = self.split_EtoE()
+
+        # operators (OPERATOR) are not tensors and can not be buffers
+        if torch.is_tensor(W_stp_T):
+            self.register_buffer('W_stp_T', W_stp_T)
+        else:
+            self.W_stp_T = W_stp_T
+
+    def split_EtoE(self):
+        """returns the EtoE block of Wab_T divided by Jab[0, 0], the block is set to 0 in Wab_T"""
+
+        s0 = self.slices[0]
+
+        # sparse layouts (SPARSE 'full') can not be sliced, the block is removed
+        if torch.is_tensor(self.Wab_T) and self.Wab_T.layout != torch.strided:
+            bounds = (int(s0.start), int(s0.stop))
+            self.Wab_T, W_EE = split_block(self.Wab_T, bounds, bounds)
+            W_EE.values().div_(self.Jab[0, 0])
+            return W_EE
+
         # NEED .clone() here otherwise BAD THINGS HAPPEN !!!
-        self.register_buffer('W_stp_T', torch.zeros((self.Na[0], self.Na[0]), device=self.device))
+        W_EE = self.Wab_T[s0, s0].clone() / self.Jab[0, 0]
+        self.Wab_T[s0, s0] = 0
 
-        self.W_stp_T = (
-            self.Wab_T[self.slices[0], self.slices[0]].clone() / self.Jab[0, 0]
-        )
+        return W_EE
 
-        self.Wab_T[self.slices[0], self.slices[0]] = 0
+    def init_ff_input(self, stimuli=None):
+        """returns the ff input of a trial, see ff_input.init_ff_input"""
+        return init_ff_input(self, stimuli)
 
-    def init_ff_input(self):
-        return init_ff_input(self)
+    def sweep(self, **params):
+        """sets parameters as vectors along the batch dimension, see sweep.set_sweep"""
+        return set_sweep(self, **params)
 
     def initRates(self, ff_input=None):
         if ff_input is None:
@@ -150,10 +443,18 @@ class Network(nn.Module):
             ff_input.to(self.device)
             self.N_BATCH = ff_input.shape[0]
 
-        rec_input = torch.randn(
-            (self.IF_NMDA + 1, self.N_BATCH, self.N_NEURON),
-            device=self.device,
-        )
+            # the timeline of the previous trial has its batch, phases and stimuli
+            if self.LIVE_FF_UPDATE:
+                self.timeline = StimulusTimeline(self)
+
+        noise = get_noise(self)
+        if noise is None:
+            rec_input = torch.randn(
+                (self.IF_NMDA + 1, self.N_BATCH, self.N_NEURON),
+                device=self.device,
+            )
+        else:
+            rec_input = noise.trial((self.IF_NMDA + 1, self.N_NEURON), INIT_NOISE).transpose(0, 1).contiguous()
 
         if self.LIVE_FF_UPDATE:
             rates = Activation()(
@@ -168,6 +469,200 @@ class Network(nn.Module):
 
         return rates, ff_input, rec_input
 
+    def init_recorder(self, REC_LAST_ONLY=0, RET_FF=0, RET_STP=0):
+        """returns the default Recorder: excitatory rates, ff input and stp variables"""
+
+        variables = {}
+        if not REC_LAST_ONLY:
+            variables["rates"] = dict(neurons=self.slices[0])
+
+            if self.LIVE_FF_UPDATE and RET_FF:
+                variables["ff"] = dict(neurons=self.slices[0])
+
+            if self.IF_STP and RET_STP:
+                variables["x_stp"] = dict(mean=False)
+                variables["u_stp"] = dict(mean=False)
+
+        return Recorder(**variables)
+
+    def init_dynamics(self):
+        """
+        returns the weights Wab_T and W_stp_T used by the time steps, with the
+        trained low rank term, and creates the stp variables
+        """
+
+        # Add STP
+        W_stp_T = None
+        if self.IF_STP:
+            # Need this here otherwise autograd complains
+            self.stp = Plasticity(
+                self.USE,
+                self.TAU_FAC,
+                self.TAU_REC,
+                self.DT,
+                (self.N_BATCH, self.Na[0]),
+                STP_TYPE=self.STP_TYPE,
+                device=self.device,
+            )
+
+            W_stp_T = self.W_stp_T
+
+        self.lr_UV = None
+        if self.LR_TRAIN and self.LR_FACTORED and not self.LR_CLAMP:
+            # keep lr = U @ V.T factored instead of adding it to the dense weights
+            U, V = self.low_rank.factors(self.LR_NORM)
+            U = U * torch.sqrt(self.Ka[0])
+
+            if self.IF_STP:
+                self.lr_UV = (U[self.slices[0]], V[self.slices[0]])
+            else:
+                self.lr_UV = (self.Wab_T[0, 0] * U, V)
+
+            Wab_T = self.Wab_T
+            if self.IF_STP:
+                W_stp_T = self.W_stp_T
+
+        elif self.LR_TRAIN:
+            self.lr = self.low_rank(self.LR_NORM, self.LR_CLAMP) * torch.sqrt(
+                self.Ka[0]
+            )
+
+            # self.lr = self.low_rank(self.LR_NORM, self.LR_CLAMP)
+
+            # this breaks autograd :s
+            # self.odors[2] = self.low_rank.linear.weight[0]
+
+            if self.IF_STP:
+                W_stp_T = self.W_stp_T + self.lr[self.slices[0], self.slices[0]].T
+                # W_stp_T = self.W_stp_T * (1.0 + self.lr[self.slices[0], self.slices[0]].T)
+                # # W_stp_T = clamp_tensor(W_stp_T, 0, self.slices)
+
+                Wab_T = self.Wab_T
+            else:
+                Wab_T = self.Wab_T + self.Wab_T[0, 0] * self.lr.T
+                # Wab_T = self.Wab_T * (1.0 + self.lr.T)
+
+            # Wab_T = clamp_tensor(Wab_T, 0, self.slices)
+            # Wab_T = clamp_tensor(Wab_T, 1, self.slices)
+
+        else:
+            Wab_T = self.Wab_T
+            if self.IF_STP:
+                W_stp_T = self.W_stp_T
+
+        self.recurrent = get_recurrent(self)
+        self.matmul = get_matmul(self)
+        self.presynaptic = get_presynaptic(self)
+
+        return Wab_T, W_stp_T
+
+    def fixed_point(self, **kwargs):
+        """finds steady states of the dynamics, see fixed_point.fixed_point"""
+        return fixed_point(self, **kwargs)
+
+    def time_step(self, step, names, update_dynamics, rates, ff_input, rec_input, Wab_T, W_stp_T):
+        """returns rates, ff_input, rec_input after step and the values to record (names)"""
+
+        self.profiler.count("steps")
+
+        # update dynamics
+        noise = 0
+        if self.LIVE_FF_UPDATE:
+            with self.profiler.phase("ff_input"):
+                ff_input, noise = live_ff_input(self, step, ff_input)
+
+            if self.RATE_NOISE:
+                rates, rec_input = update_dynamics(
+                    rates, ff_input, rec_input, Wab_T, W_stp_T
+                )
+                rates = rates + noise
+            else:
+                rates, rec_input = update_dynamics(
+                    self.low_rank.dropout(rates), ff_input + noise, rec_input, Wab_T, W_stp_T
+                )
+        else:
+            if self.LR_TRAIN:
+                # ff_input = rl_ff_udpdate(self, ff_input, rates, step, self.RWD-1)
+                if self.IF_RL:
+                    ff_input = rl_ff_udpdate(self, ff_input, rates, step, self.RWD)
+                else:
+                    self.RWD = 22
+
+            # streamed ff inputs (FF_CHUNK) are generated here
+            with self.profiler.phase("ff_input"):
+                ff_step = ff_input[:, step]
+
+            rates, rec_input = update_dynamics(rates, ff_step, rec_input, Wab_T, W_stp_T)
+
+        values = {"rates": rates}
+        if "ff" in names:
+            if self.LIVE_FF_UPDATE:
+                values["ff"] = ff_input + noise
+            else:
+                values["ff"] = ff_input[:, step]
+        if self.IF_STP:
+            values["x_stp"] = self.stp.x_stp
+            values["u_stp"] = self.stp.u_stp
+
+        return rates, ff_input, rec_input, values
+
+    def save_state(self, paths, step, rates, ff_input, rec_input, rng_init):
+        """saves the state before step to each of paths"""
+        with self.profiler.phase("snapshot"):
+            state = get_state(self, step, rates, ff_input, rec_input, rng_init)
+            for path in paths:
+                save_snapshot(path, state)
+
+    def detach_state(self, rates, ff_input, rec_input):
+        """truncates backpropagation through time (TBPTT_STEPS) at the current step"""
+
+        if self.IF_STP:
+            self.stp.u_stp = self.stp.u_stp.detach()
+            self.stp.x_stp = self.stp.x_stp.detach()
+
+        # the live ff input carries the stimuli, the full ff_input does not depend on the rates
+        if self.LIVE_FF_UPDATE:
+            ff_input = ff_input.detach()
+
+        return rates.detach(), ff_input, rec_input.detach()
+
+    def run_segment(
+        self, start, stop, names, update_dynamics, rates, ff_input, rec_input, Wab_T, W_stp_T, stp_state
+    ):
+        """
+        Runs steps start to stop of the temporal loop (checkpointed by CKPT_SEGMENT).
+        returns:
+        rates, ff_input, rec_input, stp_state after stop - 1 and
+        records: tuple of (N_BATCH, stop - start, ...) tensors with the values of names at each step
+        """
+
+        # inputs of a checkpoint are not modified in place
+        rec_input = rec_input.clone()
+        if self.LIVE_FF_UPDATE:
+            ff_input = ff_input.clone()
+
+        if self.IF_STP:
+            self.stp.u_stp, self.stp.x_stp = stp_state
+
+        records = {name: [] for name in names}
+        for step in range(start, stop):
+            if self.TBPTT_STEPS and step > 0 and step % self.TBPTT_STEPS == 0:
+                rates, ff_input, rec_input = self.detach_state(rates, ff_input, rec_input)
+
+            rates, ff_input, rec_input, values = self.time_step(
+                step, names, update_dynamics, rates, ff_input, rec_input, Wab_T, W_stp_T
+            )
+
+            for name in names:
+                records[name].append(values[name])
+
+        if self.IF_STP:
+            stp_state = (self.stp.u_stp, self.stp.x_stp)
+
+        records = tuple(torch.stack(records[name], 1) for name in names)
+
+        return rates, ff_input, rec_input, stp_state, records
+
     def scaleWeights(self):
         # scaling recurrent weights Jab as 1 / sqrt(Kb)
         if self.VERBOSE:
@@ -191,23 +686,35 @@ class Network(nn.Module):
         """Updates the dynamics of the model at each timestep"""
 
         # update hidden state
-        if self.SPARSE == "full":
-            hidden = torch.sparse.mm(rates, Wab_T)
-        elif self.SPARSE == "semi":
-            hidden = (Wab_T @ rates.T).T
-        else:
-            hidden = rates @ Wab_T
+        hidden_E = None
+        with self.profiler.phase("recurrent"):
+            if self.presynaptic is not None:
+                hidden, hidden_E = self.presynaptic(rates, Wab_T)
+            else:
+                # rates @ Wab_T for the layout of Wab_T, see engine.get_recurrent
+                hidden = self.recurrent(rates, Wab_T)
+
+            # add factored low rank term, O(N * RANK)
+            if self.lr_UV is not None and not self.IF_STP:
+                U, V = self.lr_UV
+                hidden = hidden + (rates @ V) @ U.T
 
         # update stp variables
         if self.IF_STP:
-            Aux = self.stp(rates[:, self.slices[0]])  # Aux is now u * x * rates
-            hidden_stp = self.J_STP * Aux @ W_stp_T  # / torch.sqrt(self.Ka[0])
+            with self.profiler.phase("stp"):
+                Aux = self.stp(rates[:, self.slices[0]])  # Aux is now u * x * rates
+                hidden_stp = self.matmul(self.J_STP * Aux, W_stp_T)  # / torch.sqrt(self.Ka[0])
+
+                if self.lr_UV is not None:
+                    U, V = self.lr_UV
+                    hidden_stp = hidden_stp + (self.J_STP * Aux @ V) @ U.T
+
             hidden[:, self.slices[0]] = hidden[:, self.slices[0]] + hidden_stp
 
         # update batched EtoE
         if self.IF_BATCH_J:
             hidden[:, self.slices[0]].add_(
-                self.Jab_batch * rates[:, self.slices[0]] @ self.W_batch_T
+                self.matmul(self.Jab_batch * rates[:, self.slices[0]], self.W_batch_T)
             )
 
         # update reccurent input
@@ -220,10 +727,24 @@ class Network(nn.Module):
         net_input = ff_input + rec_input[0]
 
         if self.IF_NMDA:
-            hidden = rates[:, self.slices[0]] @ Wab_T[self.slices[0]]
+            with self.profiler.phase("nmda"):
+                # the products of the excitatory rates are reused
+                if hidden_E is not None:
+                    hidden = route_nmda(
+                        hidden_E, hidden_stp if self.IF_STP else None, self.N_NEURON
+                    )
+                else:
+                    hidden = self.matmul(rates[:, self.slices[0]], Wab_T[self.slices[0]])
 
-            if self.IF_STP:
-                hidden[:, self.slices[0]] = hidden[:, self.slices[0]] + hidden_stp
+                    if self.Jab_scale is not None:
+                        hidden = hidden * self.Jab_scale[0]
+
+                    if self.IF_STP:
+                        hidden[:, self.slices[0]] = hidden[:, self.slices[0]] + hidden_stp
+
+                if self.lr_UV is not None and not self.IF_STP:
+                    U, V = self.lr_UV
+                    hidden = hidden + (rates[:, self.slices[0]] @ V[self.slices[0]]) @ U.T
 
             rec_input[1] = (
                 rec_input[1] * self.EXP_DT_TAU_NMDA
@@ -233,7 +754,8 @@ class Network(nn.Module):
             net_input = net_input + rec_input[1]
 
         # compute non linearity
-        non_linear = Activation()(net_input, func_name=self.TF_TYPE, thresh=0)
+        with self.profiler.phase("activation"):
+            non_linear = Activation()(net_input, func_name=self.TF_TYPE, thresh=0)
 
         # update rates
         if self.RATE_DYN:
@@ -248,147 +770,208 @@ class Network(nn.Module):
 
         return rates, rec_input
 
-    def forward(self, ff_input=None, REC_LAST_ONLY=0, RET_FF=0, RET_STP=0):
+    def forward(
+        self,
+        ff_input=None,
+        REC_LAST_ONLY=0,
+        RET_FF=0,
+        RET_STP=0,
+        recorder=None,
+        state=None,
+        snapshot=None,
+    ):
         """
         Main method of Network class, runs networks dynamics over set of timesteps
         and returns rates at each time point or just the last time point.
         args:
         :param ff_input: float (N_BATCH, N_STEP, N_NEURONS), ff inputs into the network.
         :param REC_LAST_ONLY: bool, wether to record the last timestep only.
+        :param recorder: Recorder, variables to record ('rates', 'ff', 'x_stp', 'u_stp').
+                         If None, it is built from REC_LAST_ONLY, RET_FF and RET_STP.
+        :param state: dict, resumes from a state of get_state (model.state or load_snapshot).
+                      The trial is continued exactly (same ff input and noise), except
+                      for streamed ff inputs (FF_CHUNK). Records before state['step'] are 0.
+        :param snapshot: str, path where the state is saved every SNAP_STEPS steps.
+        The state at the end of the trial is kept in model.state and with PROFILE
+        the times, counters and memory of its phases in model.profile (see profiler.py).
         rates_list:
         :param rates_list: float (N_BATCH, N_STEP or 1, N_NEURONS), rates of the neurons.
         """
 
-        # Initialization (if  ff_input is None, ff_input is generated)
-        rates, ff_input, rec_input = self.initRates(ff_input)
+        # phases timed in this pass, a no-op unless PROFILE
+        self.profiler = get_profiler(self)
 
-        # NEED .clone() here otherwise BAD THINGS HAPPEN
-        if self.IF_BATCH_J:
-            self.W_batch_T = (
-                self.Wab_T[self.slices[0], self.slices[0]].clone() / self.Jab[0, 0]
-            )
+        # warm start from the steady state of this configuration (see snapshot.py)
+        warm = None
+        if state is None and self.WARM_START:
+            warm = warm_path(self)
+            if os.path.exists(warm):
+                state, warm = load_snapshot(warm, self.device), None
 
-            self.Wab_T[self.slices[0], self.slices[0]] = 0
+                # a new trial: only the dynamical state is used
+                for key in TRIAL_KEYS:
+                    state.pop(key, None)
 
-        # Add STP
-        W_stp_T = None
-        if self.IF_STP:
-            # Need this here otherwise autograd complains
-            self.stp = Plasticity(
-                self.USE,
-                self.TAU_FAC,
-                self.TAU_REC,
-                self.DT,
-                (self.N_BATCH, self.Na[0]),
-                STP_TYPE=self.STP_TYPE,
-                device=self.device,
-            )
+        # generators at the start of the trial
+        if state is not None and "rng_init" in state:
+            set_rng(state["rng_init"], self.device)
+        rng_init = get_rng(self.device)
 
-            self.x_list, self.u_list = [], []
-            W_stp_T = self.W_stp_T
+        # Initialization (if  ff_input is None, ff_input is generated)
+        with self.profiler.phase("init_rates"):
+            rates, ff_input, rec_input = self.initRates(ff_input)
 
-        if self.LR_TRAIN:
-            self.lr = self.low_rank(self.LR_NORM, self.LR_CLAMP) * torch.sqrt(
-                self.Ka[0]
-            )
+        start = 0
+        if state is not None:
+            start = state["step"]
+            rates, rec_input = state["rates"], state["rec_input"].clone()
 
-            # self.lr = self.low_rank(self.LR_NORM, self.LR_CLAMP)
+            if self.LIVE_FF_UPDATE:
+                ff_input = state["ff_input"].clone()
+            if "phase" in state:
+                self.phase = state["phase"]
+            if "rng" in state:
+                set_rng(state["rng"], self.device)
+
+        # paths where the state is saved, by step
+        snap_paths = {}
+        if warm is not None and start <= warm_step(self):
+            snap_paths[warm_step(self)] = [warm]
+        if snapshot is not None and self.SNAP_STEPS:
+            # after the records of each multiple of SNAP_STEPS, so that a resumed run
+            # has the same records when SNAP_STEPS is a multiple of N_WINDOW
+            for step in range(self.SNAP_STEPS + 1, self.N_STEPS, self.SNAP_STEPS):
+                if step > start:
+                    snap_paths.setdefault(step, []).append(snapshot)
+
+        with self.profiler.phase("init_dynamics"):
+            Wab_T, W_stp_T = self.init_dynamics()
+
+        if self.IF_STP and state is not None:
+            self.stp.u_stp, self.stp.x_stp = state["u_stp"], state["x_stp"]
+
+        # time step, specialized for this configuration unless STEP_ENGINE is 'python',
+        # updating the buffers of the workspace in place without autograd
+        workspace = None if torch.is_grad_enabled() else self.workspace
+        update_dynamics = get_step(self, workspace)
+
+        # Preallocated records
+        if recorder is None:
+            recorder = self.init_recorder(REC_LAST_ONLY, RET_FF, RET_STP)
+
+        recorder.init(self, start)
+
+        names = ["rates"] + [name for name in ("ff", "x_stp", "u_stp") if name in recorder]
 
-            # this breaks autograd :s
-            # self.odors[2] = self.low_rank.linear.weight[0]
+        # Temporal loop
+        if self.INTEGRATOR == "rk23":
+            # adaptive steps, records on the DT grid
+            with self.profiler.phase("integrate"):
+                rates, rec_input = integrate(self, recorder, start, rates, rec_input, Wab_T, W_stp_T)
+
+            self.profiler.count("adaptive_steps", self.n_steps_adaptive[0])
+            self.profiler.count("rejected_steps", self.n_steps_adaptive[1])
+        elif self.CKPT_SEGMENT and torch.is_grad_enabled():
+            # segments are recomputed in the backward pass, memory does not grow with N_STEPS
+            if self.IF_RL:
+                raise ValueError("CKPT_SEGMENT does not support IF_RL (ff_input is updated in place)")
+
+            stp_state = (self.stp.u_stp, self.stp.x_stp) if self.IF_STP else ()
+
+            # segments also stop where the state is saved
+            bounds = set(range(start, self.N_STEPS, self.CKPT_SEGMENT))
+            bounds = sorted(bounds.union(snap_paths, [self.N_STEPS]))
+
+            for seg_start, seg_stop in zip(bounds[:-1], bounds[1:]):
+                if seg_start in snap_paths:
+                    if self.IF_STP:
+                        self.stp.u_stp, self.stp.x_stp = stp_state
+                    self.save_state(snap_paths[seg_start], seg_start, rates, ff_input, rec_input, rng_init)
+
+                # a streamed ff input is drawn here, its chunk cache is not restored by the recomputation
+                seg_input = ff_input
+                if isinstance(ff_input, FFStream):
+                    seg_input = ff_input.segment(seg_start, seg_stop)
+
+                rates, seg_input, rec_input, stp_state, records = checkpoint(
+                    self.run_segment,
+                    seg_start,
+                    seg_stop,
+                    names,
+                    update_dynamics,
+                    rates,
+                    seg_input,
+                    rec_input,
+                    Wab_T,
+                    W_stp_T,
+                    stp_state,
+                    use_reentrant=False,
+                )
 
-            if self.IF_STP:
-                W_stp_T = self.W_stp_T + self.lr[self.slices[0], self.slices[0]].T
-                # W_stp_T = self.W_stp_T * (1.0 + self.lr[self.slices[0], self.slices[0]].T)
-                # # W_stp_T = clamp_tensor(W_stp_T, 0, self.slices)
+                if not isinstance(ff_input, FFStream):
+                    ff_input = seg_input
 
-                Wab_T = self.Wab_T
-            else:
-                Wab_T = self.Wab_T + self.Wab_T[0, 0] * self.lr.T
-                # Wab_T = self.Wab_T * (1.0 + self.lr.T)
+                # records are made outside of the checkpoint, not again when it is recomputed
+                for i, step in enumerate(range(seg_start, seg_stop)):
+                    values = {name: record[:, i] for name, record in zip(names, records)}
+                    with self.profiler.phase("record"):
+                        recorder.update(step, **values)
 
-            # Wab_T = clamp_tensor(Wab_T, 0, self.slices)
-            # Wab_T = clamp_tensor(Wab_T, 1, self.slices)
+                    if self.VERBOSE:
+                        if step >= self.N_STEADY and step % self.N_WINDOW == 0:
+                            print_activity(self, step, values["rates"])
 
-        else:
-            Wab_T = self.Wab_T
             if self.IF_STP:
-                W_stp_T = self.W_stp_T
+                self.stp.u_stp, self.stp.x_stp = stp_state
+        else:
+            for step in range(start, self.N_STEPS):
+                if step in snap_paths:
+                    self.save_state(snap_paths[step], step, rates, ff_input, rec_input, rng_init)
 
-        # Moving average
-        mv_rates, mv_ff = 0, 0
-        rates_list, ff_list = [], []
+                if self.TBPTT_STEPS and step > 0 and step % self.TBPTT_STEPS == 0:
+                    rates, ff_input, rec_input = self.detach_state(rates, ff_input, rec_input)
 
-        # Temporal loop
-        for step in range(self.N_STEPS):
-            # update dynamics
-            if self.LIVE_FF_UPDATE:
-                ff_input, noise = live_ff_input(self, step, ff_input)
-                if self.RATE_NOISE:
-                    rates, rec_input = self.update_dynamics(
-                        rates, ff_input, rec_input, Wab_T, W_stp_T
-                    )
-                    rates = rates + noise
-                else:
-                    rates, rec_input = self.update_dynamics(
-                        self.low_rank.dropout(rates), ff_input + noise, rec_input, Wab_T, W_stp_T
-                    )
-            else:
-                if self.LR_TRAIN:
-                    # ff_input = rl_ff_udpdate(self, ff_input, rates, step, self.RWD-1)
-                    if self.IF_RL:
-                        ff_input = rl_ff_udpdate(self, ff_input, rates, step, self.RWD)
-                    else:
-                        self.RWD = 22
-
-                rates, rec_input = self.update_dynamics(
-                    rates, ff_input[:, step], rec_input, Wab_T, W_stp_T
+                rates, ff_input, rec_input, values = self.time_step(
+                    step, names, update_dynamics, rates, ff_input, rec_input, Wab_T, W_stp_T
                 )
 
-            # update moving average
-            mv_rates += rates
-            if self.LIVE_FF_UPDATE and RET_FF:
-                mv_ff += ff_input + noise
-
-            # Reset moving average to start at 0
-            if step == self.N_STEADY - self.N_WINDOW - 1:
-                mv_rates = 0.0
-                mv_ff = 0.0
+                # update moving averages and records
+                with self.profiler.phase("record"):
+                    recorder.update(step, **values)
 
-            # update output every N_WINDOW steps
-            if step >= self.N_STEADY:
-                if step % self.N_WINDOW == 0:
-                    if self.VERBOSE:
+                if self.VERBOSE:
+                    if step >= self.N_STEADY and step % self.N_WINDOW == 0:
                         print_activity(self, step, rates)
 
-                    if not REC_LAST_ONLY:
-                        rates_list.append(mv_rates[..., self.slices[0]] / self.N_WINDOW)
-                        if self.LIVE_FF_UPDATE and RET_FF:
-                            ff_list.append(mv_ff[..., self.slices[0]] / self.N_WINDOW)
-                        if self.IF_STP and RET_STP:
-                            self.x_list.append(self.stp.x_stp)
-                            self.u_list.append(self.stp.u_stp)
+        # wait for the records to be written
+        with self.profiler.phase("record"):
+            recorder.close()
 
-                    # Reset moving average
-                    mv_rates = 0
-                    mv_ff = 0
+        self.profile = self.profiler.stats()
+        self.profiler = NullProfiler()
+
+        # state at the end of the trial
+        self.state = get_state(self, self.N_STEPS, rates, ff_input, rec_input, rng_init)
 
         # returns last step
         rates = rates[..., self.slices[0]]
 
+        # the buffers of the workspace are overwritten by the next pass
+        if workspace is not None:
+            rates = rates.clone()
+
         # returns full sequence
-        if REC_LAST_ONLY == 0:
-            # Stack list on 1st dim so that output is (N_BATCH, N_STEPS, N_NEURON)
-            rates = torch.stack(rates_list, dim=1)
-            # del rates_list
+        if "rates" in recorder:
+            # output is (N_BATCH, N_STEPS, N_NEURON)
+            rates = recorder["rates"]
 
-            if self.LIVE_FF_UPDATE and RET_FF:  # returns ff input
-                self.ff_input = torch.stack(ff_list, dim=1)
-                # del ff_list
+        if "ff" in recorder:  # returns ff input
+            self.ff_input = recorder["ff"]
 
-            if self.IF_STP and RET_STP:  # returns stp u and x
-                self.u_list = torch.stack(self.u_list, dim=1)
-                self.x_list = torch.stack(self.x_list, dim=1)
+        if "u_stp" in recorder:  # returns stp u and x
+            self.u_list = recorder["u_stp"]
+        if "x_stp" in recorder:
+            self.x_list = recorder["x_stp"]
 
         # Add Linear readout (N_BATCH, N_EVAL_WIN, 1) on last few steps
         # if self.LR_READOUT:
@@ -396,7 +979,8 @@ class Network(nn.Module):
         #     # del rates
         #     return y_pred.squeeze(-1)
 
-        if self.LIVE_FF_UPDATE == 0 and RET_FF:
+        # a streamed ff input (FF_CHUNK) is not kept in memory
+        if self.LIVE_FF_UPDATE == 0 and RET_FF and torch.is_tensor(ff_input):
             self.ff_input = ff_input[..., self.slices[0]]
 
         # del ff_input, rec_input
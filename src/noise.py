@@ -0,0 +1,88 @@
+import torch
+
+MASK64 = (1 << 64) - 1
+
+# streams of a trial, drawn with different keys
+FF_NOISE = 0
+INIT_NOISE = 1
+PHASE_NOISE = 2
+
+
+def splitmix64(x):
+    """returns the splitmix64 hash of the 64 bits integer x"""
+    x = (x + 0x9E3779B97F4A7C15) & MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK64
+    return x ^ (x >> 31)
+
+
+def hash_key(*key):
+    """returns a 63 bits seed of the tuple of integers key"""
+    h = 0
+    for k in key:
+        h = splitmix64(h ^ (int(k) & MASK64))
+    return h >> 1
+
+
+class NoiseStream:
+    """
+    Class: NoiseStream
+    Counter-based noise: the noise of a trial at a step is a function of
+    (seed, stream, trial, step) only, not of the global generator nor of the
+    other trials of the batch. Steps are drawn in blocks of block steps, each
+    by a generator seeded with a hash of (seed, stream, trial, block index),
+    so any chunk of any trial can be drawn again on its own (philox on cuda,
+    mt19937 on cpu).
+    Parameters:
+        seed: int, NOISE_SEED
+        trials: list of int, the trial of each row of the batch
+        block: int, steps per block (NOISE_BLOCK), the noise depends on it
+        device: torch.device
+    """
+
+    def __init__(self, seed, trials, block, device):
+        self.seed = int(seed)
+        self.trials = list(trials)
+        self.block = int(block)
+        self.device = device
+        self.generator = torch.Generator(device=device)
+
+    def draw(self, stream, trial, index, size, func=torch.randn):
+        """returns func(size) drawn with the key (seed, stream, trial, index)"""
+        self.generator.manual_seed(hash_key(self.seed, stream, trial, index))
+        return func(size, generator=self.generator, device=self.device)
+
+    def steps(self, start, stop, n, stream=FF_NOISE):
+        """returns the gaussian noise (N_BATCH, stop - start, n) of the steps start to stop"""
+
+        out = torch.empty((len(self.trials), stop - start, n), device=self.device)
+
+        for index in range(start // self.block, (stop - 1) // self.block + 1):
+            first = index * self.block
+            lo, hi = max(start, first), min(stop, first + self.block)
+
+            for row, trial in enumerate(self.trials):
+                self.generator.manual_seed(hash_key(self.seed, stream, trial, index))
+
+                # whole blocks are drawn in place
+                if hi - lo == self.block:
+                    torch.randn((self.block, n), generator=self.generator, out=out[row, lo - start : hi - start])
+                else:
+                    noise = torch.randn((self.block, n), generator=self.generator, device=self.device)
+                    out[row, lo - start : hi - start] = noise[lo - first : hi - first]
+
+        return out
+
+    def trial(self, size, stream, index=0, func=torch.randn):
+        """returns the draws (N_BATCH, *size) of stream made once per trial (initial conditions, phases)"""
+        return torch.stack([self.draw(stream, trial, index, size, func) for trial in self.trials])
+
+
+def get_noise(model):
+    """returns the NoiseStream of the batch, None if NOISE_SEED is None (global generator)"""
+
+    if model.NOISE_SEED in (None, "None"):
+        return None
+
+    trials = range(model.NOISE_TRIAL, model.NOISE_TRIAL + model.N_BATCH)
+    return NoiseStream(model.NOISE_SEED, trials, model.NOISE_BLOCK, model.device)
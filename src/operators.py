@@ -0,0 +1,417 @@
+import math
+
+import torch
+
+from src.connectivity import Connectivity
+from src.sparse import SparseMatrix
+
+
+def to_range(idx, size):
+    """returns (start, stop) of a slice with step 1 (tensor bounds are converted)"""
+    start, stop, step = slice(
+        None if idx.start is None else int(idx.start),
+        None if idx.stop is None else int(idx.stop),
+        None if idx.step is None else int(idx.step),
+    ).indices(size)
+
+    if step != 1:
+        raise ValueError("operators only support slices with step 1")
+
+    return start, stop
+
+
+def overlap(a, b):
+    """returns the intersection of the ranges a and b or None"""
+    start, stop = max(a[0], b[0]), min(a[1], b[1])
+    if start < stop:
+        return start, stop
+    return None
+
+
+class LowRankBlock:
+    """
+    Block mean + V @ U.T of Wab_T, V (N_pre, rank) and U (N_post, rank) or None.
+    x @ block costs O(N * rank).
+    """
+
+    def __init__(self, pre, post, mean, U=None, V=None):
+        self.pre, self.post = pre, post
+        self.mean, self.U, self.V = mean, U, V
+
+    def matmul(self, x):
+        out = self.mean * x.sum(-1, keepdim=True)
+        if self.U is not None:
+            out = out + (x @ self.V) @ self.U.T
+        return out
+
+    def entry(self, i, j):
+        if self.U is None:
+            return self.mean
+        return self.mean + self.V[i] @ self.U[j]
+
+    def sub(self, pre, post):
+        """returns the block restricted to pre and post (ranges relative to the block)"""
+        if self.U is None:
+            return LowRankBlock(pre, post, self.mean)
+        return LowRankBlock(
+            pre, post, self.mean, self.U[post[0] : post[1]], self.V[pre[0] : pre[1]]
+        )
+
+    def scale(self, factor):
+        U = None if self.U is None else self.U * factor
+        return LowRankBlock(self.pre, self.post, self.mean * factor, U, self.V)
+
+
+class CirculantBlock:
+    """
+    Block of Wab_T whose weights only depend on theta_i - phi_j (ring networks).
+    Presynaptic rates are placed on a grid of L = lcm(N_pre, N_post) angles,
+    convolved with the kernel by real FFTs and read on the postsynaptic angles.
+    x @ block costs O(L log L) and the block O(L) memory.
+    """
+
+    def __init__(self, pre, post, kernel):
+        self.pre, self.post = pre, post
+        self.N_pre, self.N_post = pre[1] - pre[0], post[1] - post[0]
+        self.L = kernel.shape[-1]
+        self.kernel = kernel
+        self.kernel_fft = torch.fft.rfft(kernel)
+
+    def matmul(self, x):
+        # half precision FFTs are not supported on cpu
+        dtype = x.dtype
+        x = x.to(self.kernel.dtype)
+
+        step_pre, step_post = self.L // self.N_pre, self.L // self.N_post
+
+        if step_pre > 1:
+            z = torch.zeros(x.shape[:-1] + (self.L,), device=x.device, dtype=x.dtype)
+            z[..., ::step_pre] = x
+        else:
+            z = x
+
+        out = torch.fft.irfft(torch.fft.rfft(z) * self.kernel_fft, n=self.L)
+
+        return out[..., ::step_post].to(dtype)
+
+    def entry(self, i, j):
+        # i presynaptic, j postsynaptic
+        step_pre, step_post = self.L // self.N_pre, self.L // self.N_post
+        return self.kernel[(j * step_post - i * step_pre) % self.L]
+
+    def sub(self, pre, post):
+        if (pre, post) != ((0, self.N_pre), (0, self.N_post)):
+            raise ValueError("circulant blocks can only be used whole")
+        return CirculantBlock(pre, post, self.kernel)
+
+    def scale(self, factor):
+        return CirculantBlock(self.pre, self.post, self.kernel * factor)
+
+
+def byte_table(device, dtype):
+    """returns the (256, 8) table of the bits of each byte, bit k of byte b is column k"""
+    byte = torch.arange(256, device=device).unsqueeze(-1)
+    return ((byte >> torch.arange(8, device=device)) & 1).to(dtype)
+
+
+def unpack_bits(bits, n_cols, table):
+    """returns the (n, n_cols) 0/1 matrix of the rows bits (n, ceil(n_cols / 8)) in the dtype of table"""
+    C = torch.nn.functional.embedding(bits.reshape(-1).long(), table)
+    return C.view(bits.shape[0], -1)[:, :n_cols]
+
+
+class BinaryBlock:
+    """
+    Block J * C of Wab_T with a binary adjacency C (N_pre, N_post) packed in bits
+    along the postsynaptic neurons (uint8 (N_pre, ceil(N_post / 8))) and one weight J.
+    x @ block unpacks only the rows of the presynaptic neurons active in a trial,
+    chunk_size weights at a time. The block takes 1 bit per weight.
+    """
+
+    def __init__(self, pre, post, bits, J, chunk_size=2**22):
+        self.pre, self.post = pre, post
+        self.N_pre, self.N_post = pre[1] - pre[0], post[1] - post[0]
+        self.bits, self.J = bits, J
+        self.chunk_size = chunk_size
+
+    def matmul(self, x):
+        shape = x.shape[:-1]
+        x = x.reshape(-1, self.N_pre)
+
+        active = (x != 0).any(0).nonzero().squeeze(-1)
+        out = torch.zeros((x.shape[0], self.N_post), device=x.device, dtype=x.dtype)
+
+        # bytes are unpacked by lookup, faster than shifts
+        table = byte_table(x.device, x.dtype)
+
+        chunk = max(1, self.chunk_size // self.N_post)
+        for start in range(0, active.shape[0], chunk):
+            idx = active[start : start + chunk]
+            C = unpack_bits(self.bits[idx], self.N_post, table)
+            out = out.addmm(x[:, idx], C)
+
+        return (self.J * out).reshape(shape + (self.N_post,))
+
+    def entry(self, i, j):
+        return self.J * ((self.bits[i, j // 8] >> (j % 8)) & 1)
+
+    def sub(self, pre, post):
+        if post[0] % 8 != 0 or (post[1] != self.N_post and post[1] % 8 != 0):
+            raise ValueError("binary blocks can only be sliced on bytes of postsynaptic neurons")
+
+        bits = self.bits[pre[0] : pre[1], post[0] // 8 : (post[1] + 7) // 8]
+        return BinaryBlock(pre, post, bits, self.J, self.chunk_size)
+
+    def scale(self, factor):
+        return BinaryBlock(self.pre, self.post, self.bits, self.J * factor, self.chunk_size)
+
+
+class BlockOperator:
+    """
+    Class: BlockOperator
+    Recurrent weights Wab_T (N_PRE, N_POST) stored as structured blocks
+    (LowRankBlock, CirculantBlock, BinaryBlock) instead of a dense matrix.
+    Supports what the dynamics do with Wab_T: rates @ op, op[rows], op[rows, cols],
+    op[rows, cols] = 0 on whole blocks, op.clone() and op / scalar.
+    Parameters:
+        shape: (N_PRE, N_POST)
+        blocks: list of blocks with ranges pre=(start, stop) and post=(start, stop)
+        device: torch.device
+    """
+
+    def __init__(self, shape, blocks, device="cuda"):
+        self.shape = tuple(shape)
+        self.blocks = blocks
+        self.device = torch.device(device)
+        self.dtype = torch.get_default_dtype()
+
+    def __rmatmul__(self, rates):
+        """returns rates @ Wab_T, rates is (..., N_PRE)"""
+
+        hidden = torch.zeros(
+            rates.shape[:-1] + (self.shape[1],), device=rates.device, dtype=rates.dtype
+        )
+
+        for block in self.blocks:
+            x = rates[..., block.pre[0] : block.pre[1]]
+            hidden[..., block.post[0] : block.post[1]] += block.matmul(x)
+
+        return hidden
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple):
+            idx = (idx, slice(None))
+
+        rows, cols = idx
+
+        # single weight
+        if isinstance(rows, int) and isinstance(cols, int):
+            for block in self.blocks:
+                if block.pre[0] <= rows < block.pre[1] and block.post[0] <= cols < block.post[1]:
+                    return block.entry(rows - block.pre[0], cols - block.post[0])
+            return torch.zeros((), device=self.device, dtype=self.dtype)
+
+        rows, cols = to_range(rows, self.shape[0]), to_range(cols, self.shape[1])
+
+        blocks = []
+        for block in self.blocks:
+            pre, post = overlap(block.pre, rows), overlap(block.post, cols)
+            if pre is None or post is None:
+                continue
+
+            sub = block.sub(
+                (pre[0] - block.pre[0], pre[1] - block.pre[0]),
+                (post[0] - block.post[0], post[1] - block.post[0]),
+            )
+            sub.pre = (pre[0] - rows[0], pre[1] - rows[0])
+            sub.post = (post[0] - cols[0], post[1] - cols[0])
+
+            blocks.append(sub)
+
+        return BlockOperator((rows[1] - rows[0], cols[1] - cols[0]), blocks, self.device)
+
+    def __setitem__(self, idx, value):
+        """only zeroing whole blocks is supported (STP and batched J move the EtoE block out)"""
+
+        if not (isinstance(value, (int, float)) and value == 0):
+            raise ValueError("operators only support setting blocks to 0")
+
+        rows, cols = idx
+        rows, cols = to_range(rows, self.shape[0]), to_range(cols, self.shape[1])
+
+        blocks = []
+        for block in self.blocks:
+            pre, post = overlap(block.pre, rows), overlap(block.post, cols)
+            if pre is None or post is None:
+                blocks.append(block)
+            elif pre != block.pre or post != block.post:
+                raise ValueError("operators only support zeroing whole blocks")
+
+        self.blocks = blocks
+
+    def scale(self, factor):
+        return BlockOperator(
+            self.shape, [block.scale(factor) for block in self.blocks], self.device
+        )
+
+    def __truediv__(self, value):
+        return self.scale(1.0 / value)
+
+    def __mul__(self, value):
+        return self.scale(value)
+
+    __rmul__ = __mul__
+
+    def clone(self):
+        return self.scale(1.0)
+
+    def to_dense(self):
+        """returns the dense Wab_T (N_PRE, N_POST), O(N^2) memory"""
+        return torch.eye(self.shape[0], device=self.device, dtype=self.dtype) @ self
+
+
+def get_norm(model, i_pop, j_pop):
+    """all2all weights scale as 1 / Nb (1 / sqrt(Nb) for 'dense' profiles)"""
+    if "dense" in model.PROBA_TYPE[i_pop][j_pop]:
+        return torch.sqrt(1.0 * model.Na[j_pop])
+    return 1.0 * model.Na[j_pop]
+
+
+def get_range(model, i_pop):
+    return int(model.csumNa[i_pop]), int(model.csumNa[i_pop + 1])
+
+
+def low_rank_operator(model):
+    """
+    Builds the recurrent weights Wab_T of an all2all network as low rank blocks.
+    Each block Jab * (1 + kappa * f) / Nb is kept as a mean and the low rank
+    factors of f (see Connectivity.get_con_factors).
+    """
+
+    if "all2all" not in model.CON_TYPE:
+        raise ValueError("OPERATOR 'lr' needs CON_TYPE 'all2all'")
+
+    blocks = []
+    for i_pop in range(model.N_POP):
+        for j_pop in range(model.N_POP):
+            if model.Jab[i_pop][j_pop] == 0:
+                continue
+
+            weight_mat = Connectivity(
+                model.Na[i_pop], model.Na[j_pop], model.Ka[j_pop], device=model.device
+            )
+
+            U, V = weight_mat.get_con_factors(
+                model.PROBA_TYPE[i_pop][j_pop],
+                kappa=model.KAPPA[i_pop][j_pop],
+                phase=model.PHASE,
+                lr_mean=model.LR_MEAN,
+                lr_cov=model.LR_COV,
+                ksi=model.PHI0,
+            )
+
+            mean = model.Jab[i_pop][j_pop] / get_norm(model, i_pop, j_pop)
+            if U is not None:
+                U = mean * U
+
+            blocks.append(
+                LowRankBlock(get_range(model, j_pop), get_range(model, i_pop), mean, U, V)
+            )
+
+    return BlockOperator((model.N_NEURON, model.N_NEURON), blocks, model.device)
+
+
+def circulant_operator(model):
+    """
+    Builds the recurrent weights Wab_T of an all2all ring network as circulant blocks.
+    Each block Jab * P(theta_i - phi_j) / Nb is kept as one kernel row
+    (see Connectivity.get_con_kernel). Uniform blocks are kept as a mean.
+    """
+
+    if "all2all" not in model.CON_TYPE:
+        raise ValueError("OPERATOR 'fft' needs CON_TYPE 'all2all'")
+
+    blocks = []
+    for i_pop in range(model.N_POP):
+        for j_pop in range(model.N_POP):
+            if model.Jab[i_pop][j_pop] == 0:
+                continue
+
+            Na, Nb = int(model.Na[i_pop]), int(model.Na[j_pop])
+            L = Na * Nb // math.gcd(Na, Nb)
+
+            if L > 16 * max(Na, Nb):
+                raise ValueError(
+                    "OPERATOR 'fft' needs population sizes with a small common multiple, got %d and %d"
+                    % (Na, Nb)
+                )
+
+            weight_mat = Connectivity(Na, Nb, model.Ka[j_pop], device=model.device)
+
+            kernel = weight_mat.get_con_kernel(
+                model.PROBA_TYPE[i_pop][j_pop],
+                L,
+                kappa=model.KAPPA[i_pop][j_pop],
+                phase=model.PHASE,
+            )
+
+            scale = model.Jab[i_pop][j_pop] / get_norm(model, i_pop, j_pop)
+            pre, post = get_range(model, j_pop), get_range(model, i_pop)
+
+            if kernel is None:
+                blocks.append(LowRankBlock(pre, post, scale))
+            else:
+                # FFTs in at least single precision
+                dtype = torch.promote_types(torch.get_default_dtype(), torch.float32)
+                blocks.append(CirculantBlock(pre, post, (scale * kernel).to(dtype)))
+
+    return BlockOperator((model.N_NEURON, model.N_NEURON), blocks, model.device)
+
+
+def binary_operator(model):
+    """
+    Builds the recurrent weights Wab_T of a sparse network as binary blocks:
+    each block Jab * Cij is kept as Jab and the adjacency Cij packed in bits.
+    Connections are sampled as with SPARSE 'full' (see SparseMatrix.sample),
+    chunk of rows by chunk of rows, and set in the bits without a dense matrix.
+    """
+
+    if "sparse" not in model.CON_TYPE:
+        raise ValueError("OPERATOR 'bits' needs CON_TYPE 'sparse'")
+
+    blocks = []
+    for i_pop in range(model.N_POP):
+        for j_pop in range(model.N_POP):
+            Na, Nb = int(model.Na[i_pop]), int(model.Na[j_pop])
+            weight_mat = SparseMatrix(Na, Nb, model.Ka[j_pop], device=model.device)
+
+            # presynaptic rows, n_bytes bytes of postsynaptic neurons each
+            n_bytes = (Na + 7) // 8
+            bits = torch.zeros(Nb * n_bytes, device=model.device, dtype=torch.uint8)
+
+            for rows, cols in weight_mat.sample(
+                model.PROBA_TYPE[i_pop][j_pop],
+                fixed_degree=model.FIXED_K,
+                kappa=model.KAPPA[i_pop][j_pop],
+                phase=model.PHASE,
+                ksi=model.PHI0,
+            ):
+                # connections are distinct, the sum of their bits is their bitwise or
+                values = torch.ones(rows.shape, device=model.device, dtype=torch.uint8)
+                values = values << (rows % 8).to(torch.uint8)
+                bits.index_add_(0, cols * n_bytes + rows // 8, values)
+
+            # blocks with Jab 0 are sampled all the same, as with SPARSE 'full'
+            if model.Jab[i_pop][j_pop] == 0:
+                continue
+
+            blocks.append(
+                BinaryBlock(
+                    get_range(model, j_pop),
+                    get_range(model, i_pop),
+                    bits.view(Nb, n_bytes),
+                    model.Jab[i_pop][j_pop],
+                )
+            )
+
+    return BlockOperator((model.N_NEURON, model.N_NEURON), blocks, model.device)
@@ -0,0 +1,207 @@
+import os
+from contextlib import nullcontext
+from time import perf_counter
+
+import torch
+from torch.autograd.profiler import record_function
+
+NULL_CONTEXT = nullcontext()
+
+
+PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 2**20 if hasattr(os, "sysconf") else None
+
+
+def rss_mb():
+    """returns the current resident set size of the process in MB, None if not available (no /proc)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_MB
+    except (OSError, TypeError, ValueError):
+        return None
+
+
+class Profile:
+    """
+    Class: Profile
+    Stats of one forward pass collected by Profiler, kept in model.profile.
+    Parameters:
+        phases: dict, name -> {'time': s, 'calls': int, 'peak_mb': float, 'rss_mb': float}
+                (times are inclusive of nested phases, memory with PROFILE 2 only,
+                None if not measurable: peak_mb on cpu, rss_mb without /proc)
+        counters: dict, name -> int
+        total: float, time of the forward pass in s
+    """
+
+    def __init__(self, phases, counters, total):
+        self.phases = phases
+        self.counters = counters
+        self.total = total
+
+    def __getitem__(self, name):
+        return self.phases[name]
+
+    def as_dict(self):
+        return {"phases": self.phases, "counters": self.counters, "total": self.total}
+
+    def __repr__(self):
+        lines = ["forward %.3f s" % self.total]
+        for name, phase in sorted(self.phases.items(), key=lambda item: -item[1]["time"]):
+            line = "  %-14s %9.4f s %5.1f %% %8d calls" % (
+                name,
+                phase["time"],
+                100.0 * phase["time"] / max(self.total, 1e-12),
+                phase["calls"],
+            )
+            if "peak_mb" in phase:
+                line += " peak " + format_mb(phase["peak_mb"], "%8.1f MB", "n/a on cpu")
+                line += ", rss " + format_mb(phase["rss_mb"], "%+.1f MB", "n/a")
+            lines.append(line)
+
+        for name, count in self.counters.items():
+            lines.append("  %-14s %d" % (name, count))
+
+        return "\n".join(lines)
+
+
+def format_mb(value, fmt, missing):
+    """returns value formatted with fmt, missing if it could not be measured (None)"""
+    return missing if value is None else fmt % value
+
+
+class NullProfiler:
+    """profiler of PROFILE 0, phases are a shared nullcontext"""
+
+    def phase(self, name):
+        return NULL_CONTEXT
+
+    def count(self, name, n=1):
+        pass
+
+    def stats(self):
+        return None
+
+
+class Profiler:
+    """
+    Class: Profiler
+    Named timers, counters and peak memory per phase of the forward pass.
+    Phases are also torch.profiler ranges (record_function), so that they show
+    in traces of torch.profiler.profile. Phases can be nested.
+    Parameters:
+        device: torch.device, cuda is synchronized at the bounds of the phases.
+        memory: bool, tracks the peak memory of each phase (torch allocator, cuda only)
+                and the change of the current RSS over the phase. The cpu allocator
+                has no stats, so the peak of cpu tensors is not measurable (None).
+    """
+
+    def __init__(self, device, memory=False):
+        self.device = device
+        self.memory = memory
+        self.cuda = device.type == "cuda"
+
+        self.phases = {}
+        self.counters = {}
+        self.stack = []
+
+        self.start = perf_counter()
+
+    def sync(self):
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def allocated(self):
+        """returns the memory allocated now and the peak since the last reset in bytes (cuda)"""
+        return torch.cuda.memory_allocated(self.device), torch.cuda.max_memory_allocated(self.device)
+
+    def reset_peak(self):
+        """resets the peak of the allocator, the peak so far is kept by the enclosing phases"""
+        _, peak = self.allocated()
+        for frame in self.stack:
+            frame["peak"] = max(frame["peak"], peak)
+
+        torch.cuda.reset_peak_memory_stats(self.device)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def enter(self, name):
+        self.sync()
+
+        frame = {"name": name}
+        if self.memory:
+            if self.cuda:
+                self.reset_peak()
+                frame["allocated"], frame["peak"] = self.allocated()
+            frame["rss"] = rss_mb()
+
+        self.stack.append(frame)
+        frame["start"] = perf_counter()
+
+    def exit(self):
+        self.sync()
+        end = perf_counter()
+
+        frame = self.stack.pop()
+        stats = self.phases.setdefault(frame["name"], {"time": 0.0, "calls": 0})
+        stats["time"] += end - frame["start"]
+        stats["calls"] += 1
+
+        if self.memory:
+            stats.setdefault("peak_mb", None)
+            if self.cuda:
+                _, peak = self.allocated()
+                peak = max(frame["peak"], peak)
+
+                for outer in self.stack:
+                    outer["peak"] = max(outer["peak"], peak)
+
+                stats["peak_mb"] = max(stats["peak_mb"] or 0.0, (peak - frame["allocated"]) / 2**20)
+
+            # net change of the current RSS, summed over the calls
+            rss = rss_mb()
+            if rss is None or frame["rss"] is None:
+                stats["rss_mb"] = None
+            else:
+                stats["rss_mb"] = stats.get("rss_mb", 0.0) + rss - frame["rss"]
+
+    def stats(self):
+        """returns the Profile of the pass"""
+        self.sync()
+        return Profile(self.phases, self.counters, perf_counter() - self.start)
+
+
+class Phase:
+    """context of a named phase of Profiler, also a record_function range"""
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record = record_function(name)
+
+    def __enter__(self):
+        self.record.__enter__()
+        self.profiler.enter(self.name)
+
+    def __exit__(self, *args):
+        self.profiler.exit()
+        self.record.__exit__(*args)
+
+
+def get_profiler(model):
+    """returns the profiler of model.PROFILE: 0 off, 1 timers and counters, 2 also memory"""
+    if not model.PROFILE:
+        return NullProfiler()
+    return Profiler(model.device, memory=model.PROFILE > 1)
+
+
+def profiled(model, name, func):
+    """returns func timed as the phase name of model.profiler (read at each call)"""
+
+    def wrapped(*args, **kwargs):
+        with model.profiler.phase(name):
+            return func(*args, **kwargs)
+
+    return wrapped
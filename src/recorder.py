@@ -0,0 +1,329 @@
+import os
+import json
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+def int_index(neurons):
+    """returns neurons as an index usable on the last dim (slices get int bounds)"""
+
+    if neurons is None:
+        return slice(None)
+
+    if isinstance(neurons, slice):
+        start = None if neurons.start is None else int(neurons.start)
+        stop = None if neurons.stop is None else int(neurons.stop)
+        step = None if neurons.step is None else int(neurons.step)
+        return slice(start, stop, step)
+
+    if isinstance(neurons, int):
+        return slice(None, None, neurons)
+
+    return torch.as_tensor(neurons, dtype=torch.long)
+
+
+class Recorder:
+    """
+    Class: Recorder
+    Records variables of a network into buffers preallocated from N_STEPS
+    and N_STEADY and written in place during forward.
+    A variable is recorded every window steps after N_STEADY, either as its
+    moving average over the window (mean=True) or its value at that step.
+    Parameters:
+        **variables: name=dict(neurons=None, window=None, mean=True)
+        neurons: None (all), a slice, a list of indices or an int k (every k-th neuron)
+        window: int, number of steps between records (N_WINDOW if None)
+    Usage:
+        recorder = Recorder(rates=dict(neurons=model.slices[0]), u_stp=dict(mean=False))
+        model(recorder=recorder)
+        recorder['rates']  # (N_BATCH, N_REC, N_NEURON)
+    """
+
+    def __init__(self, **variables):
+        self.variables = {}
+        for name, spec in variables.items():
+            spec = dict(spec or {})
+            self.variables[name] = dict(
+                neurons=int_index(spec.get("neurons")),
+                window=spec.get("window"),
+                mean=spec.get("mean", True),
+            )
+
+        self.buffers = {}
+
+    def __contains__(self, name):
+        return name in self.variables
+
+    def __getitem__(self, name):
+        return self.buffers[name]
+
+    def n_records(self, model, window, start=0):
+        """number of steps >= N_STEADY (and start) that are multiples of window"""
+        first = -(-max(model.N_STEADY, start) // window) * window
+        return len(range(first, model.N_STEPS, window))
+
+    def init(self, model, start=0):
+        """
+        sets the windows and number of records, buffers are allocated at the first update.
+        start: first step of the run (resumed from a state), earlier records are skipped
+        """
+
+        self.model = model
+        self.start = start
+
+        for name, var in self.variables.items():
+            if var["window"] is None:
+                var["window"] = model.N_WINDOW
+            var["window"] = int(var["window"])
+            var["reset"] = model.N_STEADY - var["window"] - 1
+
+            var["n_rec"] = self.n_records(model, var["window"])
+            var["count"] = var["n_rec"] - self.n_records(model, var["window"], start)
+            var["acc"] = None
+
+        self.buffers = {}
+
+    def first_step(self):
+        """returns the first step whose values are used by the records (after init)"""
+
+        steps = [self.model.N_STEPS]
+        for var in self.variables.values():
+            if var["mean"]:
+                steps.append(var["reset"] + 1)
+            else:
+                steps.append(self.model.N_STEADY)
+
+        return max(0, min(steps))
+
+    def allocate(self, name, value):
+        """allocates the buffer of name, (..., N_REC, N_NEURON) with the dtype of value"""
+        var = self.variables[name]
+        value = value[..., var["neurons"]]
+
+        self.buffers[name] = torch.zeros(
+            value.shape[:-1] + (var["n_rec"],) + value.shape[-1:],
+            dtype=value.dtype,
+            device=value.device,
+        )
+
+        if var["mean"]:
+            var["acc"] = torch.zeros_like(value)
+
+    def update(self, step, **values):
+        """
+        Accumulates and records the variables at step.
+        values: name=tensor (N_BATCH, N_NEURON), only names in the recorder are used
+        """
+
+        for name, var in self.variables.items():
+            if name not in values:
+                continue
+
+            if name not in self.buffers:
+                self.allocate(name, values[name])
+
+            window = var["window"]
+
+            if var["mean"]:
+                var["acc"].add_(values[name][..., var["neurons"]])
+
+                # Reset moving average to start at 0
+                if step == var["reset"]:
+                    var["acc"] = torch.zeros_like(var["acc"])
+
+            if step >= self.model.N_STEADY and step % window == 0:
+                if var["count"] < var["n_rec"]:
+                    if var["mean"]:
+                        self.write(name, var["count"], var["acc"] / window)
+                    else:
+                        self.write(name, var["count"], values[name][..., var["neurons"]])
+                    var["count"] += 1
+
+                # Reset moving average
+                if var["mean"]:
+                    var["acc"] = torch.zeros_like(var["acc"])
+
+    def write(self, name, count, value):
+        """writes the record count of name"""
+        self.buffers[name][..., count, :] = value
+
+    def close(self):
+        """called at the end of forward, all records are written after it returns"""
+        pass
+
+    def results(self):
+        """returns a dict with the recorded buffers"""
+        return {name: self.buffers.get(name) for name in self.variables}
+
+
+def numpy_dtype(dtype):
+    """returns the numpy dtype of the records of a torch dtype (bfloat16, not in numpy, as float32)"""
+
+    if dtype == torch.bfloat16:
+        dtype = torch.float32
+
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+
+def json_config(model):
+    """returns the uppercase parameters of model that can be written to json"""
+
+    config = {}
+    for key, value in model.__dict__.items():
+        if not key.isupper():
+            continue
+
+        if torch.is_tensor(value) or isinstance(value, np.ndarray):
+            value = value.tolist()
+
+        try:
+            json.dumps(value)
+        except TypeError:
+            continue
+
+        config[key] = value
+
+    return config
+
+
+class DiskRecorder(Recorder):
+    """
+    Class: DiskRecorder
+    Recorder that streams the records to memory-mapped .npy files in path
+    instead of keeping them in memory. A background thread copies each record
+    to disk as it is produced, so memory use does not grow with N_STEPS and
+    the files can be read while the simulation runs.
+    path/header.json holds the config, the seed, the shapes and the number of
+    records written so far for every variable. bfloat16 records (FLOAT_PRECISION 16)
+    are stored as float32, the dtype of the network is kept in the header (torch_dtype).
+    Parameters:
+        path: str, output directory (created if needed)
+        max_queue: int, max number of records waiting for the writer
+        **variables: see Recorder
+    Usage:
+        recorder = DiskRecorder(repo_root + '/data/simul/run', rates=dict())
+        model(recorder=recorder)
+        np.load(path + '/rates.npy', mmap_mode='r')  # (N_BATCH, N_REC, N_NEURON)
+    """
+
+    def __init__(self, path, max_queue=64, **variables):
+        super().__init__(**variables)
+
+        self.path = path
+        self.max_queue = max_queue
+        self.writer = None
+        self.lock = threading.Lock()
+
+    def init(self, model, start=0):
+        """creates the directory, the header and starts the writer thread"""
+
+        super().init(model, start)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.header = {
+            "seed": model.SEED,
+            "config": json_config(model),
+            "variables": {},
+            "complete": False,
+        }
+        self.write_header()
+
+        self.error = None
+        self.queue = queue.Queue(maxsize=self.max_queue)
+        self.writer = threading.Thread(target=self.run_writer, daemon=True)
+        self.writer.start()
+
+    def write_header(self):
+        """writes header.json atomically so that it can be read during the run"""
+        tmp = os.path.join(self.path, "header.json.tmp")
+        with self.lock, open(tmp, "w") as f:
+            json.dump(self.header, f, indent=2)
+        os.replace(tmp, os.path.join(self.path, "header.json"))
+
+    def allocate(self, name, value):
+        """creates the memory-mapped file of name, (..., N_REC, N_NEURON)"""
+        var = self.variables[name]
+        value = value[..., var["neurons"]]
+
+        shape = value.shape[:-1] + (var["n_rec"],) + value.shape[-1:]
+        dtype = numpy_dtype(value.dtype)
+        var["dtype"] = torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+        # a resumed run writes into the files of the first run
+        file_name = os.path.join(self.path, name + ".npy")
+        mode = "r+" if self.start > 0 and os.path.exists(file_name) else "w+"
+
+        self.buffers[name] = np.lib.format.open_memmap(
+            file_name,
+            mode=mode,
+            dtype=dtype,
+            shape=tuple(shape),
+        )
+
+        with self.lock:
+            self.header["variables"][name] = dict(
+                shape=list(shape),
+                dtype=str(dtype),
+                torch_dtype=str(value.dtype),
+                window=var["window"],
+                count=var["count"],
+            )
+
+        if var["mean"]:
+            var["acc"] = torch.zeros_like(value)
+
+    def write(self, name, count, value):
+        """hands a copy of the record to the writer thread"""
+        if self.error is not None:
+            raise self.error
+
+        value = value.detach().to("cpu", dtype=self.variables[name]["dtype"], copy=True)
+        self.queue.put((name, count, value))
+
+    def run_writer(self):
+        """writer thread: copies the records into the memory maps"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            name, count, value = item
+            try:
+                self.buffers[name][..., count, :] = value.numpy()
+                self.header["variables"][name]["count"] = count + 1
+
+                # flush and update the header once the queue is empty
+                if self.queue.empty():
+                    self.flush()
+            except Exception as error:
+                self.error = error
+
+    def flush(self):
+        """flushes the memory maps and the header"""
+        for buffer in list(self.buffers.values()):
+            buffer.flush()
+        self.write_header()
+
+    def close(self):
+        """waits for the writer thread and marks the records as complete"""
+
+        if self.writer is None:
+            return
+
+        self.queue.put(None)
+        self.writer.join()
+        self.writer = None
+
+        if self.error is not None:
+            raise self.error
+
+        self.header["complete"] = True
+        self.flush()
+
+    def __getitem__(self, name):
+        return torch.from_numpy(self.buffers[name])
@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import multiprocessing as mp
+from itertools import product
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+from src.configuration import Configuration
+
+
+def expand_grid(grid):
+    """
+    returns the list of overrides of a grid, the first axis varies slowest.
+    grid: dict name=list of values (cartesian product) or list of dicts (used as is)
+    """
+
+    if isinstance(grid, dict):
+        names = list(grid.keys())
+        return [dict(zip(names, values)) for values in product(*grid.values())]
+
+    return [dict(overrides) for overrides in grid]
+
+
+def config_hash(conf_name, repo_root, func=None, **overrides):
+    """returns a hash of the resolved configuration (defaults, conf file, overrides) and func"""
+
+    parameters = Configuration(conf_name, repo_root).parameters(**overrides)
+
+    if func is not None:
+        parameters["__func__"] = func.__module__ + "." + func.__qualname__
+
+    text = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def run_forward(model):
+    """default func: rates of a forward pass on cpu"""
+    with torch.no_grad():
+        return model().cpu()
+
+
+def init_worker(n_threads):
+    torch.set_num_threads(n_threads)
+    torch.set_num_interop_threads(1)
+
+
+def run_point(conf_name, repo_root, func, overrides):
+    """worker: builds a Network with overrides and returns func(model)"""
+    from src.network import Network
+
+    model = Network(conf_name, repo_root, **overrides)
+    return func(model)
+
+
+def save_result(path, result):
+    # write then rename so that an interrupted run leaves no partial file
+    torch.save(result, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def run_grid(
+    conf_name,
+    repo_root,
+    grid,
+    func=run_forward,
+    n_workers=None,
+    n_threads=1,
+    cache_dir=None,
+    verbose=1,
+):
+    """
+    Runs Network(conf_name, repo_root, **overrides) for every point of grid
+    on a pool of processes and returns func(model) for each point.
+    Results are stored in cache_dir under a hash of the resolved configuration,
+    points already in the cache are loaded instead of being run again.
+    args:
+    :param grid: dict name=list of values or list of dicts of overrides, see expand_grid.
+    :param func: function (model) -> result, defined at module level so that it can be pickled.
+    :param n_workers: int, number of processes (os.cpu_count() // n_threads if None).
+    :param n_threads: int, torch threads per process.
+    :param cache_dir: str, repo_root/data/sweep/<conf_name> if None.
+    :param verbose: bool, prints progress and throughput.
+    returns:
+    results: list of func(model), in the order of expand_grid(grid)
+    """
+
+    points = expand_grid(grid)
+
+    if cache_dir is None:
+        cache_dir = os.path.join(repo_root, "data", "sweep", conf_name.replace(".yml", ""))
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    paths = [
+        os.path.join(cache_dir, config_hash(conf_name, repo_root, func, **p) + ".pt")
+        for p in points
+    ]
+
+    results = [None] * len(points)
+    todo = []
+    for i, path in enumerate(paths):
+        if os.path.exists(path):
+            results[i] = torch.load(path, weights_only=False)["result"]
+        else:
+            todo.append(i)
+
+    if verbose:
+        print(
+            "points", len(points), "cached", len(points) - len(todo), "to run", len(todo)
+        )
+
+    if not todo:
+        return results
+
+    if n_workers is None:
+        n_workers = max(1, (os.cpu_count() or 1) // n_threads)
+    n_workers = min(n_workers, len(todo))
+
+    start = perf_counter()
+
+    # spawn: forked workers can deadlock in torch thread pools and do not support cuda
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(n_threads,),
+    ) as pool:
+        futures = {
+            pool.submit(run_point, conf_name, repo_root, func, points[i]): i
+            for i in todo
+        }
+
+        for n_done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            results[i] = future.result()
+            save_result(paths[i], {"overrides": points[i], "result": results[i]})
+
+            if verbose:
+                elapsed = perf_counter() - start
+                rate = n_done / elapsed
+                print(
+                    "done %d/%d, %.2f points/s, %.1f s left"
+                    % (n_done, len(todo), rate, (len(todo) - n_done) / rate)
+                )
+
+    return results
@@ -0,0 +1,128 @@
+import os
+import json
+import hashlib
+
+import torch
+
+from src.recorder import json_config
+from src.sweep import SWEEP_ATTRS
+
+# parameters that do not change the dynamics up to the warm start step
+WARM_EXCLUDE = [
+    "VERBOSE",
+    "PROFILE",
+    "DURATION",
+    "N_STEPS",
+    "RWD",
+    "STEP_ENGINE",
+    "CKPT_SEGMENT",
+    "TBPTT_STEPS",
+    "WARM_START",
+    "SNAP_STEPS",
+    "CACHE_WEIGHTS",
+    "FF_CHUNK",
+]
+
+
+# entries of a snapshot specific to the trial that saved it (generators, stimulus phases),
+# dropped when the snapshot starts a new trial (WARM_START)
+TRIAL_KEYS = ["rng", "rng_init", "phase"]
+
+
+def get_rng(device):
+    """returns the states of the cpu generator and of the cuda generator of device"""
+    rng = {"cpu": torch.get_rng_state()}
+    if device.type == "cuda":
+        rng["cuda"] = torch.cuda.get_rng_state(device)
+    return rng
+
+
+def set_rng(rng, device):
+    torch.set_rng_state(rng["cpu"].cpu())
+    if "cuda" in rng and device.type == "cuda":
+        torch.cuda.set_rng_state(rng["cuda"].cpu(), device)
+
+
+def get_state(model, step, rates, ff_input, rec_input, rng_init):
+    """
+    returns the dynamical state of model before step as a dict of tensors:
+    rates, rec_input (AMPA and NMDA), the live ff input, stp u and x, the step
+    and the states of the generators now (rng) and at the start of the trial (rng_init)
+    """
+
+    state = {
+        "step": step,
+        "rates": rates.detach().clone(),
+        "rec_input": rec_input.detach().clone(),
+        "rng": get_rng(model.device),
+        "rng_init": rng_init,
+    }
+
+    # the full ff input is generated again from rng_init
+    if model.LIVE_FF_UPDATE:
+        state["ff_input"] = ff_input.detach().clone()
+
+    if model.IF_STP:
+        state["u_stp"] = model.stp.u_stp.detach().clone()
+        state["x_stp"] = model.stp.x_stp.detach().clone()
+
+    # stimulus phase of the 'rand' tasks
+    if torch.is_tensor(getattr(model, "phase", None)):
+        state["phase"] = model.phase.detach().clone()
+
+    return state
+
+
+def save_snapshot(path, state):
+    """saves state to path, written then renamed so that a preempted job leaves no partial file"""
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def load_snapshot(path, device):
+    """returns the state saved in path on device"""
+    return torch.load(path, map_location=device)
+
+
+def warm_hash(model):
+    """
+    returns a hash of everything the transient depends on: the configuration,
+    the weights (weights_key), the trained parameters and the swept parameters
+    """
+
+    sha = hashlib.sha1()
+
+    config = json_config(model)
+    for key in WARM_EXCLUDE:
+        config.pop(key, None)
+
+    sha.update(json.dumps(config, sort_keys=True, default=str).encode())
+    sha.update(model.weights_key.encode())
+
+    tensors = list(model.parameters())
+    tensors += [getattr(model, attr, None) for attr in SWEEP_ATTRS]
+
+    for tensor in tensors:
+        if torch.is_tensor(tensor):
+            sha.update(tensor.detach().cpu().reshape(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            sha.update(str(tensor).encode())
+
+    return sha.hexdigest()[:16]
+
+
+def warm_step(model):
+    """
+    returns the step of the warm start snapshot: the first step averaged in
+    the records at N_STEADY, so that records are unchanged by a warm start
+    """
+    return max(0, int(model.N_STEADY) - int(model.N_WINDOW))
+
+
+def warm_path(model):
+    return os.path.join(model.SNAP_PATH, warm_hash(model) + ".pt")
@@ -1,18 +1,360 @@
+import math
 import torch
+from torch.distributions import Geometric
 
-Class SparseMatrix():
-    def __init__(self, in_deg, n_cols, n_rows):
-        self.n_cols = n_cols
-        self.n_rows = n_rows
-        self.in_deg = in_deg
 
-        self.proba = in_deg / n_cols
+class SparseMatrix:
+    def __init__(self, Na, Nb, Kb, device="cuda", verbose=0, chunk_size=2**22):
+        """
+        Class: SparseMatrix
+        Creates a sparse connectivity block in CSR format without ever building
+        the dense (Na, Nb) matrix. Presynaptic indices are sampled row by row
+        (in chunks of rows) so that memory and time scale as O(Na * Kb).
+        Parameters:
+        Na : int, number of postsynaptic neurons
+        Nb : int, number of presynaptic neurons
+        Kb : float, in degree
+        chunk_size : int, max number of candidate entries drawn at once
+        """
 
-    def forward(self):
+        self.Na = int(Na)
+        self.Nb = int(Nb)
+        self.Kb = float(Kb)
 
-        indices
-        
-        for i in range(n_rows):
-            for j in range(n_cols):
-                if torch.rand(1) <= self.proba:
-                    
+        self.verbose = verbose
+        self.device = device
+        self.chunk_size = chunk_size
+
+    def init_proba(self, proba_type, kappa=0.0, phase=0.0, ksi=None, **kwargs):
+        """sets the connection profile Pij, evaluated only on sampled (i, j) pairs"""
+
+        self.proba_type = proba_type
+        self.kappa = float(kappa)
+        self.phase = float(phase)
+
+        if "cos" in proba_type:
+            if "spec" in proba_type:
+                self.kappa = self.kappa / math.sqrt(self.Kb)
+                self.phase = 0.0
+        elif "lr" == proba_type:
+            if ksi is None:
+                raise ValueError("low rank sparse connectivity needs ksi (PHI0)")
+            # Pij = 1 + kappa * a_i . b_j / sqrt(Kb) (see Connectivity.low_rank_proba)
+            ksi = ksi.to(self.device, torch.float64)
+            if ksi.shape[0] == 4:
+                self.ksi_a = ksi[[0, 2]]
+                self.ksi_b = ksi[[1, 3]]
+            else:
+                self.ksi_a = ksi
+                self.ksi_b = ksi
+
+            self.ksi_b_max = self.ksi_b.max(dim=1).values.unsqueeze(-1)
+            self.ksi_b_min = self.ksi_b.min(dim=1).values.unsqueeze(-1)
+        elif "von_mises" in proba_type:
+            i0 = torch.special.i0(torch.tensor(self.kappa, dtype=torch.float64))
+            self.norm = 1.0 / i0.item() / 2.0 / math.pi
+
+    def get_proba(self, rows, cols):
+        """returns Pij for the postsynaptic rows and presynaptic cols (same shape)"""
+
+        if "cos" in self.proba_type or "von_mises" in self.proba_type:
+            theta = 2.0 * math.pi * rows / self.Na
+            phi = 2.0 * math.pi * cols / self.Nb
+
+            if "cos" in self.proba_type:
+                return 1.0 + self.kappa * torch.cos(theta - phi - self.phase)
+
+            return self.norm * torch.exp(self.kappa * torch.cos(theta - phi))
+
+        if "lr" == self.proba_type:
+            Lij = (self.ksi_a[:, rows] * self.ksi_b[:, cols]).sum(0)
+            return 1.0 + self.kappa * Lij / math.sqrt(self.Kb)
+
+        return torch.ones(rows.shape, dtype=torch.float64, device=self.device)
+
+    def get_bound(self, rows):
+        """returns an upper bound of Pij over j for each postsynaptic row"""
+
+        rows = rows.to(torch.float64)
+
+        if "cos" in self.proba_type:
+            bound = 1.0 + abs(self.kappa)
+        elif "von_mises" in self.proba_type:
+            bound = self.norm * math.exp(abs(self.kappa))
+        elif "lr" == self.proba_type:
+            a = self.ksi_a[:, rows.long()]
+            Lmax = torch.maximum(a * self.ksi_b_max, a * self.ksi_b_min).sum(0)
+            Lmin = torch.minimum(a * self.ksi_b_max, a * self.ksi_b_min).sum(0)
+            if self.kappa >= 0:
+                return 1.0 + self.kappa * Lmax / math.sqrt(self.Kb)
+            return 1.0 + self.kappa * Lmin / math.sqrt(self.Kb)
+        elif "gaussian" in self.proba_type:
+            # Pij ~ N(0, 1) iid, each entry is Bernoulli with the marginal probability
+            c = self.Kb / self.Nb
+            pdf = lambda x: math.exp(-0.5 * x * x) / math.sqrt(2.0 * math.pi)
+            p = c * (pdf(0.0) - pdf(1.0 / c)) + 0.5 * math.erfc(1.0 / c / math.sqrt(2.0))
+            bound = p / c
+        else:
+            bound = 1.0
+
+        return torch.full(rows.shape, bound, dtype=torch.float64, device=self.device)
+
+    def is_uniform(self):
+        return not (
+            "cos" in self.proba_type
+            or "von_mises" in self.proba_type
+            or "lr" == self.proba_type
+        )
+
+    def bernoulli_rows(self, rows):
+        """samples j with probability Kb / Nb * Pij using thinning of a Bernoulli process"""
+
+        p_max = (self.Kb / self.Nb * self.get_bound(rows)).clamp_(min=0.0, max=1.0)
+        p_max = p_max.unsqueeze(-1)
+
+        # geometric gaps between candidates drawn at rate p_max
+        mean = self.Nb * p_max.max().item()
+        n_draw = int(mean + 6.0 * math.sqrt(mean + 1.0) + 10)
+
+        sampler = Geometric(probs=p_max.clamp(min=1e-12))
+        pos = (sampler.sample((n_draw,)).squeeze(-1).T + 1.0).cumsum(1) - 1.0
+
+        # extend rows where the process did not reach the end of the row yet
+        while (pos[:, -1] < self.Nb).any():
+            gaps = sampler.sample((n_draw,)).squeeze(-1).T + 1.0
+            pos = torch.cat((pos, pos[:, -1:] + gaps.cumsum(1)), dim=1)
+
+        mask = pos < self.Nb
+        rows = rows.unsqueeze(-1).expand_as(pos)[mask]
+        cols = pos[mask].long()
+
+        if not self.is_uniform():
+            proba = (self.Kb / self.Nb * self.get_proba(rows, cols)).clamp_(0.0, 1.0)
+            accept = torch.rand(cols.shape, dtype=torch.float64, device=self.device)
+            accept = accept * p_max.expand_as(pos)[mask] < proba
+            rows, cols = rows[accept], cols[accept]
+
+        return rows, cols
+
+    def fixed_rows(self, rows, n_cand=None):
+        """
+        samples exactly Kb distinct j per row with weights proportional to Pij
+        returns the sorted presynaptic indices as a (len(rows), Kb) tensor
+        """
+
+        K = int(round(self.Kb))
+        if K > self.Nb:
+            raise ValueError("fixed in degree K=%d larger than Nb=%d" % (K, self.Nb))
+
+        if n_cand is None:
+            n_cand = 2 * K + 10
+
+        n_rows = rows.shape[0]
+        cands = torch.randint(0, self.Nb, (n_rows, n_cand), device=self.device)
+
+        valid = torch.ones(cands.shape, dtype=torch.bool, device=self.device)
+        if not self.is_uniform():
+            # rejection sampling of the profile
+            Pij = self.get_proba(rows.unsqueeze(-1).expand_as(cands), cands)
+            bound = self.get_bound(rows).unsqueeze(-1)
+            accept = torch.rand(cands.shape, dtype=torch.float64, device=self.device)
+            valid = accept * bound < Pij.clamp_(min=0.0)
+
+        # remove duplicates
+        cands = torch.where(valid, cands, self.Nb).sort(dim=1).values
+        cands[:, 1:][cands[:, 1:] == cands[:, :-1]] = self.Nb
+        valid = cands < self.Nb
+
+        # redo rows without enough candidates with more candidates
+        done = valid.sum(1) >= K
+        cols = torch.empty((n_rows, K), dtype=cands.dtype, device=self.device)
+        if not done.all():
+            cols[~done] = self.fixed_rows(rows[~done], 2 * n_cand)
+
+        # choose K candidates at random among the distinct ones
+        keys = torch.rand(cands[done].shape, device=self.device)
+        keys[~valid[done]] = 2.0
+        idx = keys.topk(K, dim=1, largest=False).indices
+        cols[done] = cands[done].gather(1, idx).sort(dim=1).values
+
+        return cols
+
+    def sample(self, proba_type="None", fixed_degree=0, **kwargs):
+        """
+        yields the connections (rows, cols) of chunks of postsynaptic rows,
+        sorted by row then col, see forward for the parameters
+        """
+
+        self.init_proba(proba_type, **kwargs)
+
+        if fixed_degree:
+            n_cand = 2 * int(round(self.Kb)) + 10
+        else:
+            n_cand = int(self.Kb * 1.5) + 10
+
+        chunk = max(1, self.chunk_size // n_cand)
+
+        for start in range(0, self.Na, chunk):
+            rows = torch.arange(
+                start, min(start + chunk, self.Na), device=self.device
+            )
+            if fixed_degree:
+                cols = self.fixed_rows(rows)
+                rows = rows.repeat_interleave(cols.shape[1])
+                cols = cols.reshape(-1)
+            else:
+                rows, cols = self.bernoulli_rows(rows)
+
+            yield rows, cols
+
+    def forward(self, proba_type="None", fixed_degree=0, **kwargs):
+        """
+        returns connectivity Cij as a torch.sparse_csr_tensor of ones
+        :param proba_type: string 'None', 'cosine', 'cosine_spec', 'von_mises' or 'lr'
+        :param fixed_degree: bool, exactly Kb inputs per neuron instead of Bernoulli draws
+        :param kappa: float
+        :param phase: float
+        :param ksi: tensor, low rank vectors
+        """
+
+        rows_list, cols_list = [], []
+        for rows, cols in self.sample(proba_type, fixed_degree, **kwargs):
+            rows_list.append(rows)
+            cols_list.append(cols)
+
+        rows = torch.cat(rows_list)
+        cols = torch.cat(cols_list)
+        del rows_list, cols_list
+
+        if self.verbose:
+            print("sparse block", (self.Na, self.Nb), "mean in degree", cols.shape[0] / self.Na)
+
+        return to_csr(rows, cols, torch.ones(cols.shape, device=self.device), (self.Na, self.Nb))
+
+    def __call__(self, proba_type="None", fixed_degree=0, **kwargs):
+        return self.forward(proba_type, fixed_degree, **kwargs)
+
+
+def to_csr(rows, cols, values, size):
+    """returns a CSR tensor from (rows, cols, values) already sorted by row then col"""
+
+    counts = torch.bincount(rows, minlength=size[0])
+    crow = torch.cat((counts.new_zeros(1), counts.cumsum(0)))
+
+    return torch.sparse_csr_tensor(crow, cols, values, size=size)
+
+
+def cat_blocks(blocks, csumNa, N):
+    """
+    Assembles a dict {(i_pop, j_pop): csr block} into a single (N, N) CSR matrix.
+    csumNa holds the offsets of each population.
+    Each entry is scattered to its final position, without sorting.
+    """
+
+    n_pop = len(csumNa) - 1
+    counts = [
+        [blocks[(i_pop, j_pop)].crow_indices().diff() for j_pop in range(n_pop)]
+        for i_pop in range(n_pop)
+    ]
+
+    crow = torch.cat([torch.stack(counts[i_pop]).sum(0) for i_pop in range(n_pop)])
+    crow = torch.cat((crow.new_zeros(1), crow.cumsum(0)))
+
+    nnz = int(crow[-1])
+    device = crow.device
+    cols = torch.empty(nnz, dtype=crow.dtype, device=device)
+    values = torch.empty(nnz, dtype=blocks[(0, 0)].values().dtype, device=device)
+
+    for i_pop in range(n_pop):
+        # start of each row of population i_pop in the full matrix
+        row_start = crow[int(csumNa[i_pop]) : int(csumNa[i_pop + 1])]
+        offset = torch.zeros_like(row_start)
+
+        for j_pop in range(n_pop):
+            block = blocks[(i_pop, j_pop)]
+            block_crow = block.crow_indices()
+
+            rows = torch.repeat_interleave(
+                torch.arange(block.shape[0], device=device), counts[i_pop][j_pop]
+            )
+
+            dest = row_start[rows] + offset[rows]
+            dest = dest + torch.arange(rows.shape[0], device=device) - block_crow[rows]
+
+            cols[dest] = block.col_indices() + int(csumNa[j_pop])
+            values[dest] = block.values()
+
+            offset = offset + counts[i_pop][j_pop]
+
+    return torch.sparse_csr_tensor(crow, cols, values, size=(N, N))
+
+
+def split_block(W, rows, cols):
+    """
+    Splits the block W[rows[0]:rows[1], cols[0]:cols[1]] out of a sparse W
+    (coo, csr or csc), which can not be sliced or assigned by index.
+    returns:
+    W without the entries of the block and the block, both in the layout of W
+    """
+
+    coo = W.to_sparse_coo().coalesce()
+    row, col = coo.indices()
+    values = coo.values()
+
+    inside = (row >= rows[0]) & (row < rows[1]) & (col >= cols[0]) & (col < cols[1])
+
+    rest = torch.sparse_coo_tensor(coo.indices()[:, ~inside], values[~inside], W.shape)
+    block = torch.sparse_coo_tensor(
+        torch.stack((row[inside] - rows[0], col[inside] - cols[0])),
+        values[inside],
+        (rows[1] - rows[0], cols[1] - cols[0]),
+    )
+
+    def to_layout(x):
+        x = x.coalesce()
+        if W.layout == torch.sparse_csr:
+            return x.to_sparse_csr()
+        if W.layout == torch.sparse_csc:
+            return x.to_sparse_csc()
+        return x
+
+    return to_layout(rest), to_layout(block)
+
+
+def event_mm(spikes, Wab_T, pre=None):
+    """
+    returns spikes @ Wab_T[pre] accumulating only the rows of the active
+    presynaptic neurons, so that the cost scales with the number of spikes.
+    :param spikes: float (N_BATCH, N_PRE), zero for silent neurons
+    :param Wab_T: float (N, N_POST), dense or sparse CSR (rows are presynaptic)
+    :param pre: slice, presynaptic rows of Wab_T matching the columns of spikes
+    """
+
+    batch, idx = torch.nonzero(spikes, as_tuple=True)
+    values = spikes[batch, idx]
+
+    if pre is not None:
+        idx = idx + int(pre.start)
+
+    hidden = torch.zeros(
+        (spikes.shape[0], Wab_T.shape[1]), dtype=spikes.dtype, device=spikes.device
+    )
+
+    if Wab_T.layout == torch.sparse_csr:
+        crow = Wab_T.crow_indices()
+        counts = crow[idx + 1] - crow[idx]
+
+        # flat positions of the synapses of each active neuron
+        start = torch.repeat_interleave(crow[idx] - counts.cumsum(0) + counts, counts)
+        syn = start + torch.arange(start.shape[0], device=start.device)
+
+        batch = torch.repeat_interleave(batch, counts)
+        values = torch.repeat_interleave(values, counts) * Wab_T.values()[syn]
+
+        hidden.view(-1).index_add_(
+            0, batch * Wab_T.shape[1] + Wab_T.col_indices()[syn], values
+        )
+    else:
+        hidden.index_add_(0, batch, values.unsqueeze(-1) * Wab_T[idx])
+
+    return hidden
@@ -0,0 +1,236 @@
+from itertools import product
+
+import torch
+
+# layout of each parameter that can be swept along the batch dimension
+# 'block': (N_POP, N_POP), 'pop': (N_POP,), 'stim': (N_STIM,), 'scalar': ()
+SWEEP_PARAMS = {
+    "Jab": "block",
+    "GAIN": "scalar",
+    "Ja0": "pop",
+    "I0": "stim",
+    "THRESH": "pop",
+    "TAU_SYN": "pop",
+    "USE": "scalar",
+    "TAU_FAC": "scalar",
+    "J_STP": "scalar",
+}
+
+# model attributes derived from the swept parameters
+SWEEP_ATTRS = [
+    "N_BATCH",
+    "Jab_scale",
+    "Ja0",
+    "I0",
+    "thresh",
+    "EXP_DT_TAU_SYN",
+    "DT_TAU_SYN",
+    "USE",
+    "TAU_FAC",
+    "J_STP",
+]
+
+
+def grid(**axes):
+    """
+    Cartesian product of parameter values, the first axis varies slowest.
+    axes: name=list of values, a value is a scalar or has the shape of the parameter.
+    returns:
+    params: dict name=tensor (N_BATCH, ...) with N_BATCH the product of the axes lengths,
+    to be passed to set_sweep
+    """
+
+    names = list(axes.keys())
+    values = [[torch.as_tensor(v) for v in axes[name]] for name in names]
+
+    params = {name: [] for name in names}
+    for idx in product(*[range(len(v)) for v in values]):
+        for name, vals, i in zip(names, values, idx):
+            params[name].append(vals[i])
+
+    return {name: torch.stack(params[name]).to(torch.get_default_dtype()) for name in names}
+
+
+def get_size(model, layout):
+    if layout == "block":
+        return (model.N_POP, model.N_POP)
+    if layout == "pop":
+        return (model.N_POP,)
+    if layout == "stim":
+        return (len(model.N_STIM_ON),)
+    return ()
+
+
+def to_batch(model, value, layout, N_BATCH):
+    """returns value as a tensor (N_BATCH, *size), 1d values are shared by all populations"""
+
+    size = get_size(model, layout)
+    value = torch.as_tensor(value, device=model.device).to(torch.get_default_dtype())
+
+    if value.dim() == 1:
+        return value.view((N_BATCH,) + (1,) * len(size)).expand((N_BATCH,) + size)
+
+    # Jab can be flat as in the configuration files
+    return value.reshape((N_BATCH,) + size)
+
+
+def per_neuron(model, value):
+    """expands (N_BATCH, N_POP) to (N_BATCH, N_NEURON)"""
+    out = torch.ones((value.shape[0], model.N_NEURON), device=model.device)
+    for i_pop in range(model.N_POP):
+        out[:, model.slices[i_pop]] = value[:, i_pop : i_pop + 1]
+    return out
+
+
+def set_sweep(model, **params):
+    """
+    Sets parameters of model to vectors along the batch dimension so that a
+    full grid of parameters runs in a single forward pass.
+    Weights are not copied: swept Jab blocks and GAIN rescale the products of
+    each presynaptic population with Wab_T (see sweep_mm).
+    Values are in the units of the configuration files and are scaled as in
+    init_const (GAIN / sqrt(Ka) for Jab, M0 * sqrt(K0) for Ja0 ...).
+    args:
+    **params: name=tensor (N_BATCH, ...) for name in SWEEP_PARAMS.
+              Jab (N_BATCH, N_POP, N_POP), Ja0, THRESH, TAU_SYN (N_BATCH, N_POP),
+              I0 (N_BATCH, N_STIM), GAIN, USE, TAU_FAC, J_STP (N_BATCH,).
+              1d values are shared by all populations (or blocks, stimuli).
+              With IF_STP (or IF_BATCH_J) the EtoE block is not in Wab_T:
+              Jab[0, 0] can not be swept, sweep J_STP instead.
+              THRESH only changes the initial rates (initRates) and the fixed
+              points, the time steps use thresh=0 as update_dynamics.
+              Calling set_sweep without params restores the unbatched model.
+    returns:
+    N_BATCH: int
+    """
+
+    for name in params:
+        if name not in SWEEP_PARAMS:
+            raise ValueError(
+                "cannot sweep %s, parameters are %s" % (name, list(SWEEP_PARAMS))
+            )
+
+    # parameters before any sweep
+    if "sweep_base" not in model.__dict__:
+        model.sweep_base = {attr: getattr(model, attr, None) for attr in SWEEP_ATTRS}
+
+    base = model.sweep_base
+    for attr in SWEEP_ATTRS:
+        setattr(model, attr, base[attr])
+
+    # specialized time steps hold the integration constants
+    model.__dict__.pop("step_cache", None)
+
+    if not params:
+        return model.N_BATCH
+
+    sizes = {torch.as_tensor(v).shape[0] for v in params.values()}
+    if len(sizes) > 1:
+        raise ValueError("swept parameters have different batch sizes %s" % sizes)
+
+    N_BATCH = sizes.pop()
+    p = {
+        name: to_batch(model, value, SWEEP_PARAMS[name], N_BATCH)
+        for name, value in params.items()
+    }
+
+    model.N_BATCH = N_BATCH
+    sqrt_Ka = torch.sqrt(model.Ka)
+
+    # recurrent weights
+    if "Jab" in p or "GAIN" in p:
+        Jab = model.Jab.unsqueeze(0)
+        gain = p.get("GAIN", torch.full((N_BATCH,), float(model.GAIN), device=model.device))
+
+        if "Jab" in p:
+            Jab_new = p["Jab"] * gain[:, None, None] / sqrt_Ka
+        else:
+            Jab_new = Jab * (gain / model.GAIN)[:, None, None]
+
+        if torch.any((Jab == 0) & (Jab_new != 0)):
+            raise ValueError("cannot sweep Jab blocks that are 0 in Wab_T")
+
+        # the EtoE block is in W_stp_T (W_batch_T), only GAIN rescales it
+        if (model.IF_STP or model.IF_BATCH_J) and not torch.allclose(
+            Jab_new[:, 0, 0], Jab[:, 0, 0] * gain / model.GAIN
+        ):
+            raise ValueError(
+                "cannot sweep Jab[0, 0] with IF_STP or IF_BATCH_J, the EtoE block is not in Wab_T (sweep J_STP)"
+            )
+
+        scale = torch.where(Jab == 0, torch.ones_like(Jab_new), Jab_new / Jab)
+
+        # one product with Wab_T if the scale only depends on the postsynaptic population
+        n_pre = 1 if torch.all(scale == scale[..., :1]) else model.N_POP
+
+        model.Jab_scale = torch.stack([per_neuron(model, scale[..., j]) for j in range(n_pre)])
+
+    # stp
+    if "J_STP" in p:
+        gain = p.get("GAIN", torch.full((N_BATCH,), float(model.GAIN), device=model.device))
+        model.J_STP = (p["J_STP"] * gain / sqrt_Ka[0]).unsqueeze(-1)
+    elif "GAIN" in p and base["J_STP"] is not None:
+        model.J_STP = base["J_STP"] * (p["GAIN"] / model.GAIN).unsqueeze(-1)
+
+    if "USE" in p:
+        model.USE = p["USE"]
+    if "TAU_FAC" in p:
+        model.TAU_FAC = p["TAU_FAC"]
+
+    # ff inputs, Ja0 is (N_BATCH, N_POP, 1) and I0[i] is (N_BATCH, 1)
+    if "Ja0" in p:
+        Ja0 = p["Ja0"]
+        if model.LIVE_FF_UPDATE:
+            Ja0 = model.M0 * sqrt_Ka[0] * Ja0
+        model.Ja0 = Ja0.unsqueeze(-1)
+
+    if "I0" in p:
+        model.I0 = p["I0"].T.unsqueeze(-1)
+
+    # transfer function and synaptic time constants
+    # (thresh is used by initRates and fixed_point only)
+    if "THRESH" in p:
+        model.thresh = per_neuron(model, p["THRESH"])
+
+    if "TAU_SYN" in p:
+        model.EXP_DT_TAU_SYN = per_neuron(model, torch.exp(-model.DT / p["TAU_SYN"]))
+        model.DT_TAU_SYN = per_neuron(model, model.DT / p["TAU_SYN"])
+
+    return N_BATCH
+
+
+def sweep_mm(model, rates, Wab_T):
+    """
+    Recurrent input with Jab blocks batched by model.Jab_scale (N_PRE, N_BATCH, N_NEURON).
+    Each presynaptic population is multiplied with its rows of Wab_T and the
+    product is rescaled per batch and postsynaptic neuron.
+    """
+
+    Jab_scale = model.Jab_scale
+
+    if model.SPARSE == "full":
+        recurrent = torch.sparse.mm
+    elif model.SPARSE == "semi":
+
+        def recurrent(rates, Wab_T):
+            return (Wab_T @ rates.T).T
+
+    else:
+        recurrent = torch.matmul
+
+    if Jab_scale.shape[0] == 1:
+        return recurrent(rates, Wab_T) * Jab_scale[0]
+
+    hidden = 0
+    for j_pop in range(Jab_scale.shape[0]):
+        sl = model.slices[j_pop]
+
+        if model.SPARSE not in ("full", "semi"):
+            hidden = hidden + (rates[:, sl] @ Wab_T[sl]) * Jab_scale[j_pop]
+        else:
+            # sparse layouts can not be sliced by rows, other populations are masked
+            rates_j = torch.zeros_like(rates)
+            rates_j[:, sl] = rates[:, sl]
+            hidden = hidden + recurrent(rates_j, Wab_T) * Jab_scale[j_pop]
+
+    return hidden
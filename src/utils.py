@@ -25,10 +25,12 @@ def set_seed(seed):
         torch.cuda.manual_seed_all(seed)
 
 def clear_cache():
-    for obj in gc.get_objects():
-        if torch.is_tensor(obj):
-            del obj
-    
-    # Manually triggering the garbage collector afterwards
+    """
+    collects garbage and releases the cached cuda memory. Not called in forward
+    or __init__ anymore (a full collection is slow in a large python process),
+    the step buffers are reused instead (see workspace.py).
+    """
     gc.collect()
-    torch.cuda.empty_cache()
+
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
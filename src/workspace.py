@@ -0,0 +1,32 @@
+import torch
+
+
+class Workspace:
+    """
+    Class: Workspace
+    Buffers of the time steps (hidden state, net input, rates) allocated once
+    for the batch shape and reused across steps and forward passes, so that a
+    forward pass without autograd does not allocate them at every step
+    (see engine.make_step_inplace). A buffer is allocated again when the
+    batch shape or the precision change.
+    Parameters:
+        device: torch.device
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.buffers = {}
+
+    def __call__(self, name, shape, dtype):
+        """returns the buffer name of size shape"""
+        buffer = self.buffers.get(name)
+
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = torch.empty(shape, device=self.device, dtype=dtype)
+            self.buffers[name] = buffer
+
+        return buffer
+
+    def clear(self):
+        """frees the buffers"""
+        self.buffers = {}